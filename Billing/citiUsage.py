@@ -15,152 +15,77 @@
 
 
 __author__ = 'jonhall'
-import os, logging, logging.config, os.path, argparse, calendar, pytz, yaml
+import os, sys, copy, json, logging, logging.config, os.path, argparse, calendar, pytz, yaml, subprocess
 from datetime import datetime, tzinfo, timezone
-import pandas as pd
-import numpy as np
-import ibm_boto3
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.relativedelta import *
-from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalSearchV2
-from ibm_platform_services.resource_controller_v2 import *
-from ibm_cloud_sdk_core import ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_botocore.client import Config, ClientError
 from dotenv import load_dotenv
-from yaml import Loader
-
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.startup import importTimer, logImportTimes
+from accountusage.logs import setup_logging
+from accountusage.clients import ClientFactory
+from accountusage.cache import populateTagCache, listAllResourceInstances, populateResourceCache
+from accountusage.tags import getTagSet
+from accountusage.cos import writeFiletoCos
+from accountusage.metrics import getRunMetrics, stage, timedStage
+from accountusage.predicates import column, select
+from accountusage.appconf import YamlLoader, loadAppConf
+
 def readAppConf(filename):
     """
-    Read application Configuration into Dictionary
+    Read application Configuration into Dictionary, validated and compiled, from the configuration cache if unchanged
     :param filename: filename of application configuration in YAML format
-    :return:
+    :return: list of applications
     """
+    return loadAppConf(filename)
 
-    stream = open(filename, 'r')
-    applicationConf = yaml.load(stream, Loader=Loader)
-    return applicationConf
-def getAccountId(IC_API_KEY):
-    ##########################################################
-    ## Get AccountId for this API Key
-    ##########################################################
-
-    try:
-        api_key = iam_identity_service.get_api_keys_details(
-          iam_api_key=IC_API_KEY
-        ).get_result()
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    return api_key["account_id"]
-def createSDK(IC_API_KEY):
+def readTrueUpConf(filename):
     """
-    Create SDK clients
+    Read variable usage services of the TrueUp and compile them into a lookup table of service metric to contract category
+    :param filename: filename of variable usage service configuration in YAML format
+    :return: dataframe of resource_id, rule_metric (any for every metric of the service) and contract_category
     """
-    global usage_reports_service, resource_controller_service, iam_identity_service, global_search_service
-
-    try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        iam_identity_service = IamIdentityV1(authenticator=authenticator)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
+    with open(filename, 'r') as stream:
+        services = yaml.load(stream, Loader=YamlLoader)
+    rules = []
+    for service in services or []:
+        if not isinstance(service, dict) or "service_id" not in service or "metrics" not in service:
+            logging.error("Variable service {} in {} requires a service_id and metrics.".format(service, filename))
+            quit(1)
+        metrics = [service["metrics"]] if isinstance(service["metrics"], str) else service["metrics"]
+        for metric in metrics:
+            rules.append({"resource_id": service["service_id"], "rule_metric": metric, "contract_category": service.get("category", "variable")})
+    return pd.DataFrame(rules, columns=["resource_id", "rule_metric", "contract_category"]).drop_duplicates(["resource_id", "rule_metric"])
 
-    try:
-        usage_reports_service = UsageReportsV4(authenticator=authenticator)
-        usage_reports_service.enable_retries(max_retries=5, retry_interval=1.0)
-        usage_reports_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
+""" Contract allocations are calculated quarterly from the contract start of June 2022 (june, july, august), (sept, oct, nov), (dec, jan, feb), (march, april, may) """
+CONTRACT_QUARTER_START = 6
 
-    try:
-        resource_controller_service = ResourceControllerV2(authenticator=authenticator)
-        resource_controller_service.enable_retries(max_retries=5, retry_interval=1.0)
-        resource_controller_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
+""" Filters of server usage rows, compiled once and shared by the tabs and contract charges """
+VIRTUAL_SERVER_HOURS = (column("service_id") == "is.instance") & column("metric").isin(["VCPU_HOURS", "INSTANCE_HOURS_MULTI_TENANT"])
+BARE_METAL_SERVER_HOURS = (column("service_id") == "is.bare-metal-server") & (column("metric") == "BARE_METAL_SERVER_HOURS")
+SYMPHONY_WORKERS = column("instance_role").contains("symphony-worker")
+SCALE_STORAGE = column("instance_role").contains("scale-storage")
 
-    try:
-        global_search_service = GlobalSearchV2(authenticator=authenticator)
-        global_search_service.enable_retries(max_retries=5, retry_interval=1.0)
-        global_search_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-def prePopulateTagCache():
+def reportMonths(start, end):
     """
-    Pre Populate Tagging data into cache
+    List months from start to end month
+    :return: list of months in YYYY-MM format
     """
-    logging.info("Tag Cache being pre-populated with tags.")
-    search_cursor = None
-    items = []
-    while True:
-        response = global_search_service.search(query='tags:*',
-                                                search_cursor=search_cursor,
-                                                fields=["tags"],
-                                                limit=1000)
-        scan_result = response.get_result()
-
-        items = items + scan_result["items"]
-        if "search_cursor" not in scan_result:
-            break
-        else:
-            search_cursor = scan_result["search_cursor"]
-
-    tag_cache = {}
-    for resource in items:
-        resourceId = resource["crn"]
-        tag_cache[resourceId] = resource["tags"]
-
-    return tag_cache
-def prePopulateResourceCache():
-        """
-        Retrieve all Resources for account from resource controller and pre-populate cache
-        """
-        logging.info("Resource_cache being pre-populated with active resources in account.")
-        all_results = []
-        pager = ResourceInstancesPager(
-            client=resource_controller_service,
-            limit=50
-        )
-
-        try:
-            while pager.has_next():
-                next_page = pager.get_next()
-                assert next_page is not None
-                all_results.extend(next_page)
-            logging.debug("resource_instance={}".format(all_results))
-        except ApiException as e:
-            logging.error(
-                "API Error.  Can not retrieve instances {}: {}".format(str(e.code),
-                                                                                  e.message))
-            quit(1)
-
-        resource_cache = {}
-        for resource in all_results:
-            resourceId = resource["crn"]
-            resource_cache[resourceId] = resource
+    months = []
+    while start <= end:
+        months.append(start.strftime("%Y-%m"))
+        start += relativedelta(months=+1)
+    return months
 
-        return resource_cache
+def contractQuarter(month):
+    """
+    Contract quarter of month
+    :param month: month in YYYY-MM format
+    :return: quarter as first and last month of quarter (ie 2022-06 to 2022-08)
+    """
+    month = datetime.strptime(month, "%Y-%m")
+    first = month - relativedelta(months=(month.month - CONTRACT_QUARTER_START) % 3)
+    return "{} to {}".format(first.strftime("%Y-%m"), (first + relativedelta(months=+2)).strftime("%Y-%m"))
 def getAccountUsage(start, end):
     """
     Get IBM Cloud Service from account for range of months.
@@ -173,7 +98,7 @@ def getAccountUsage(start, end):
         start += relativedelta(months=+1)
 
         try:
-            usage = usage_reports_service.get_account_usage(
+            usage = clients.usage_reports.get_account_usage(
                 account_id=accountId,
                 billingmonth=usageMonth,
                 names=True
@@ -233,24 +158,20 @@ def getAccountUsage(start, end):
                     data.append(row.copy())
 
 
-    accountUsage = pd.DataFrame(data, columns=['account_id', "account_name", 'month', 'currency_code', 'billing_country', 'resource_id', 'resource_name',
-                    'billable_charges', 'billable_rated_charges', 'plan_id', 'plan_name', 'pricing_region', 'metric', 'unit_name', 'quantity',
-                    'rateable_quantity','cost', 'rated_cost', 'discount', 'price'])
+    accountUsage = typedFrame(data, ACCOUNT_USAGE_SCHEMA)
 
     return accountUsage
 def getInstancesUsage(start,end):
     """
     Get instances resource usage for month of specific resource_id
     """
-    global tag_cache, resource_cache
-
     def getResourceInstancefromCloud(resourceId):
         """
         Retrieve Resource Details from resource controller if not in cache
         """
         logging.debug("Requesting resource data from resource controller for {}".format(resourceId))
         try:
-            resource_instance = resource_controller_service.get_resource_instance(
+            resource_instance = clients.resource_controller.get_resource_instance(
                 id=resourceId).get_result()
             logging.debug("resource_instance={}".format(resource_instance))
         except ApiException as e:
@@ -270,16 +191,14 @@ def getInstancesUsage(start,end):
         return resource_cache[resourceId]
     def getTags(resourceId):
         """
-        Check Tag Cache for Resource
+        Check Tag Index for Resource
         """
-        if resourceId not in tag_cache:
+        if resourceId not in tag_cache["crn"]:
             logging.debug("Cache miss for Tag {}".format(resourceId))
-            tags = []
-        else:
-            tags = tag_cache[resourceId]
-        return tags
+        return getTagSet(tag_cache, resourceId)
 
     data = []
+    pages = []
     nytz = pytz.timezone('America/New_York')
     limit = 100  ## set limit of record returned
 
@@ -288,11 +207,25 @@ def getInstancesUsage(start,end):
         usageMonth = start.strftime("%Y-%m")
         start += relativedelta(months=+1)
         recordstart = 1
+        """ Resume from the page after the last page committed to the checkpoint """
+        resumeOffset = None
+        if checkpoint is not None:
+            pageKey = checkpoint.unitKey(unitAccount, usageMonth)
+            frames, resumeOffset, recordstart = checkpoint.readPages(pageKey)
+            pages.extend(frames)
+            if resumeOffset == "":
+                continue
         """ Read first Group of records """
         try:
-            instances_usage = usage_reports_service.get_resource_usage_account(
-                account_id=accountId,
-                billingmonth=usageMonth, names=True, limit=limit).get_result()
+            if resumeOffset is None:
+                instances_usage = clients.usage_reports.get_resource_usage_account(
+                    account_id=accountId,
+                    billingmonth=usageMonth, names=True, limit=limit).get_result()
+            else:
+                logging.info("Resuming Instance {} Usage for {} from record {}.".format(usageMonth, accountName, recordstart))
+                instances_usage = clients.usage_reports.get_resource_usage_account(
+                    account_id=accountId,
+                    billingmonth=usageMonth, names=True, limit=limit, start=resumeOffset).get_result()
         except ApiException as e:
             logging.error("Fatal Error with get_resource_usage_account: {}".format(e))
             quit(1)
@@ -422,15 +355,11 @@ def getInstancesUsage(start,end):
 
                 # get tags attached to instance from cache or resource controller
                 tags = getTags(instance["resource_instance_id"])
-                logging.debug("Instance {} tags: {}".format(instance["resource_instance_id"], tags))
+                logging.debug("Instance {} tags: {}".format(instance["resource_instance_id"], tags["tags"]))
 
-                # parse role tag into comma delimited list
-                if len(tags) > 0:
-                    role = ",".join([str(item.split(":")[1]) for item in tags if "role:" in item])
-                    audit = ",".join([str(item.split(":")[1]) for item in tags if "audit:" in item])
-                else:
-                    role = ""
-                    audit = ""
+                # role and audit are parsed once per distinct tag set
+                role = tags["role"]
+                audit = tags["audit"]
 
 
                 row_addition = {
@@ -502,6 +431,18 @@ def getInstancesUsage(start,end):
                     row = row | row_addition
                     data.append(row.copy())
 
+            """
+            Type parsed rows in batches of pages so only one batch is held as row dictionaries.  With a checkpoint each page is
+            typed and committed as it is parsed, so a failed run resumes from the last page
+            """
+            if checkpoint is not None:
+                pages.append(typedFrame(data, INSTANCE_USAGE_SCHEMA))
+                data = []
+                checkpoint.commitPage(pageKey, pages[-1], nextoffset, recordstart + limit)
+            elif len(data) >= BATCH_ROWS or nextoffset == "":
+                pages.append(typedFrame(data, INSTANCE_USAGE_SCHEMA))
+                data = []
+
             if nextoffset != "":
                 recordstart = recordstart + limit
                 if recordstart + limit > instances_usage["count"]:
@@ -512,7 +453,7 @@ def getInstancesUsage(start,end):
                                                                                               recordstop,
                                                                                               instances_usage["count"]))
                 try:
-                    instances_usage = usage_reports_service.get_resource_usage_account(
+                    instances_usage = clients.usage_reports.get_resource_usage_account(
                         account_id=accountId,
                         billingmonth=usageMonth, names=True,limit=limit, start=nextoffset).get_result()
                 except ApiException as e:
@@ -526,13 +467,184 @@ def getInstancesUsage(start,end):
             else:
                 break
 
-        instancesUsage = pd.DataFrame(data, columns=['account_id', "account_name", "month", "service_name", "service_id", "instance_name","instance_id", "plan_name", "plan_id", "region", "pricing_region",
-                                                 "resource_group_name","resource_group_id", "billable", "pricing_country", "billing_country", "currency_code", "pricing_plan_id", "provision_date",
-                                                 "instance_created_at", "instance_updated_at", "instance_deleted_at", "instance_state", "instance_profile", "cpu_family",
-                                                 "numberOfVirtualCPUs", "MemorySizeMiB", "NodeName", "NumberOfGPUs", "NumberOfInstStorageDisks", "availability_zone", "BMnumberofCores", "BMnumberofSockets", "BMbandwidth",
-                                                 "instance_role", "audit", "metric", "metric_name", "unit", "unit_name", "quantity", "cost", "rated_cost", "rateable_quantity", "estimated_days", "price", "discount"])
+    instancesUsage = concatFrames(pages, INSTANCE_USAGE_SCHEMA).reset_index(drop=True)
 
     return instancesUsage
+def collectUnit(apikeys, unit):
+    """
+    Collect account usage and instance usage of one work unit
+    :param apikeys: list of apikey and name of each account
+    :param unit: work unit with index of account in apikeys and month (YYYY-MM)
+    :return: account usage, instances usage
+    """
+    global clients, accountId, accountName, tag_cache, resource_cache, unitAccount
+    """ Consecutive units of the same account reuse its clients and caches """
+    if unitAccount != unit["account"]:
+        account = apikeys[unit["account"]]
+        clients = ClientFactory(account["apikey"])
+        accountId = clients.getAccountId()
+        accountName = account["name"]
+        logging.info("Tag Cache being pre-populated with tags for {} AccountId: {}.".format(accountName, accountId))
+        with stage("tag cache", accountName):
+            tag_cache = populateTagCache(clients)
+        logging.info("Resource_cache being pre-populated with active resources for {} AccountId: {}.".format(accountName, accountId))
+        with stage("resource cache", accountName):
+            resource_cache = populateResourceCache(listAllResourceInstances(clients))
+        unitAccount = unit["account"]
+
+    month = datetime.strptime(unit["month"], "%Y-%m")
+    with stage("account usage", accountName):
+        accountUsage = getAccountUsage(month, month)
+    with stage("instance usage", accountName):
+        instancesUsage = getInstancesUsage(month, month)
+    return accountUsage, instancesUsage
+def runWorker(queue, apikeys):
+    """
+    Collect work units from queue until it is empty, writing output partitioned by month and account
+    :param queue: WorkQueue shared with coordinator
+    :param apikeys: list of apikey and name of each account
+    :return: number of units collected
+    """
+    collected = 0
+    while True:
+        unit = queue.claim()
+        if unit is None:
+            break
+        logging.info("Worker {} collecting {} of account {} for {}.".format(queue.worker, unit["name"], unit["account"], unit["month"]))
+        with queue.heartbeat(unit):
+            accountUsage, instancesUsage = collectUnit(apikeys, unit)
+        partition = [("month", unit["month"]), ("account", accountId)]
+        queue.writePartition("accountUsage", unit, partition, accountUsage)
+        queue.writePartition("instancesUsage", unit, partition, instancesUsage)
+        queue.complete(unit)
+        collected = collected + 1
+    logging.info("Worker {} collected {} work units.".format(queue.worker, collected))
+    return collected
+def workUnits(apikeys, start, end):
+    """
+    Split accounts and months into work units, in account then month order
+    :return: list of work units with index of account in apikeys and month (YYYY-MM)
+    """
+    months = reportMonths(start, end)
+    return [{"account": account, "month": month} for account in range(len(apikeys)) for month in months]
+def mergeUnits(units, read):
+    """
+    Merge output of work units per account in month order, indexed per account as getAccountUsage and getInstancesUsage are,
+    adding the account usage of each unit to the usage aggregate
+    :param units: work units in account then month order
+    :param read: function returning account usage and instances usage of a unit
+    :return: account usage, instances usage in the same order as a single pass per account
+    """
+    accountUsage = []
+    instancesUsage = []
+    for account in sorted(set(unit["account"] for unit in units)):
+        frames = [read(unit) for unit in units if unit["account"] == account]
+        for frame in frames:
+            usageAggregate.update(frame[0])
+        accountUsage.append(concatFrames([frame[0] for frame in frames]).reset_index(drop=True))
+        instancesUsage.append(concatFrames([frame[1] for frame in frames]).reset_index(drop=True))
+    return concatFrames(accountUsage, ACCOUNT_USAGE_SCHEMA), concatFrames(instancesUsage, INSTANCE_USAGE_SCHEMA)
+def runShards(apikeys, start, end):
+    """
+    Split accounts and months into work units, run them on local and remote workers and merge their output
+    :param apikeys: list of apikey and name of each account
+    :return: account usage, instances usage in the same order as a single process run
+    """
+    queue = WorkQueue(args.queue)
+    units = workUnits(apikeys, start, end)
+    names = queue.create(units)
+    logging.info("Queued {} work units for {} accounts in {}.".format(len(units), len(apikeys), args.queue))
+
+    """ Local workers run this script with --worker, workers on other hosts are started the same way against a shared queue """
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--queue", os.path.abspath(args.queue), "--conf", os.path.abspath(args.conf)]
+    for option in ["metrics", "prometheus", "profile_dir"]:
+        if getattr(args, option):
+            command.extend(["--" + option, os.path.abspath(getattr(args, option))])
+    if args.profile:
+        command.extend(["--profile", args.profile, "--profiler", args.profiler, "--profile_every", str(args.profile_every)])
+        command.append("--profile_memory" if args.profile_memory else "--no-profile_memory")
+    processes = [subprocess.Popen(command) for worker in range(args.workers)]
+    if not queue.wait(len(units), processes, timeout=args.queue_timeout):
+        quit(1)
+    for process in processes:
+        process.wait()
+
+    for name, unit in zip(names, units):
+        unit["name"] = name
+    return mergeUnits(units, lambda unit: (queue.readPartitions("accountUsage", [unit["name"]]),
+                                           queue.readPartitions("instancesUsage", [unit["name"]])))
+def runCheckpointed(apikeys, start, end):
+    """
+    Collect work units in order, committing progress to the checkpoint so a failed run can be resumed with --resume
+    :param apikeys: list of apikey and name of each account
+    :return: account usage, instances usage
+    """
+    global checkpoint
+    units = workUnits(apikeys, start, end)
+    run = {"start": start.strftime("%Y-%m"), "end": end.strftime("%Y-%m"), "accounts": [account["name"] for account in apikeys]}
+    checkpoint = Checkpoint(args.checkpoint, run, args.resume)
+    for unit in units:
+        key = checkpoint.unitKey(unit["account"], unit["month"])
+        if checkpoint.isComplete(key):
+            logging.info("Reusing checkpointed usage of {} for {}.".format(apikeys[unit["account"]]["name"], unit["month"]))
+            continue
+        accountUsage, instancesUsage = collectUnit(apikeys, unit)
+        checkpoint.completeUnit(key, {"accountUsage": accountUsage, "instancesUsage": instancesUsage})
+
+    usage = mergeUnits(units, lambda unit: (checkpoint.readPartition(checkpoint.unitKey(unit["account"], unit["month"]), "accountUsage"),
+                                            checkpoint.readPartition(checkpoint.unitKey(unit["account"], unit["month"]), "instancesUsage")))
+    checkpoint.remove()
+    checkpoint = None
+    return usage
+def writeMetrics(suffix=None):
+    """
+    Write run metrics to the --metrics and --prometheus files
+    :param suffix: added to filenames before the extension (ie worker name), so workers write separate files
+    """
+    def filename(name):
+        root, extension = os.path.splitext(name)
+        return "{}.{}{}".format(root, suffix, extension) if suffix else name
+
+    if args.metrics:
+        getRunMetrics().writeJson(filename(args.metrics))
+    if args.prometheus:
+        getRunMetrics().writePrometheus(filename(args.prometheus))
+    return
+@timedStage
+def calculateServerDays(instancesUsage):
+    """
+    Calculate the exact billable days of each server from its lifetime in the usage month, replacing the estimate of
+    ROUNDUP(hours / 24), and flag servers whose usage hours disagree with their lifetime
+    :param instancesUsage: typed instance usage dataframe
+    :return: instancesUsage with the columns of SERVER_DAYS_SCHEMA, missing for rows that are not servers
+    """
+    logging.info("Calculating server days from instance lifetimes.")
+    """ Servers are the rows days were estimated for, Virtual Server and Bare Metal hours """
+    servers = instancesUsage["estimated_days"].notna().to_numpy()
+    start, end = lifetimeInMonth(parseTimestamps(instancesUsage["instance_created_at"]), parseTimestamps(instancesUsage["instance_deleted_at"]),
+                                 instancesUsage["month"])
+    lifetimeHours = intervalHours(start, end)
+    billableDays = intervalDays(start, end)
+
+    """ VCPU_HOURS are metered per vCPU, hours of the server are the vCPU hours / vCPUs """
+    quantity = instancesUsage["quantity"].to_numpy(dtype=float)
+    vcpus = instancesUsage["numberOfVirtualCPUs"].astype("float64").to_numpy()
+    perVcpu = (instancesUsage["metric"] == "VCPU_HOURS").to_numpy() & (vcpus > 0)
+    usageHours = np.where(perVcpu, quantity / np.where(perVcpu, vcpus, 1), quantity)
+
+    check = lifetimeCheck(usageHours, lifetimeHours)
+    """ Servers without a creation time keep the estimate """
+    billableDays = np.where(np.isnan(billableDays), instancesUsage["estimated_days"].astype("float64").to_numpy(), billableDays)
+    flagged = servers & (check != "")
+    if flagged.any():
+        logging.warning("Usage hours of {} servers disagree with their lifetime, see the ServerDays tab.".format(
+            instancesUsage.loc[flagged, "instance_id"].nunique()))
+
+    return instancesUsage.assign(usage_hours=pd.array(np.where(servers, usageHours, np.nan), dtype="Float32"),
+                                 lifetime_hours=pd.array(np.where(servers, lifetimeHours, np.nan), dtype="Float32"),
+                                 billable_days=pd.array(np.where(servers, billableDays, np.nan), dtype="Float32"),
+                                 lifetime_check=pd.Categorical(np.where(servers, check, None)))
+@timedStage
 def createServiceDetail(paasUsage):
     """
     Write Service Usage detail tab to excel
@@ -551,6 +663,7 @@ def createServiceDetail(paasUsage):
     totalrows,totalcols=paasUsage.shape
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
+@timedStage
 def createInstancesDetailTab(instancesUsage):
     """
     Write detail tab to excel
@@ -569,9 +682,34 @@ def createInstancesDetailTab(instancesUsage):
     totalrows,totalcols=instancesUsage.shape
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
-def createUsageSummaryTab(paasUsage):
+@timedStage
+def createPriceTiersTab(priceTiers):
+    """
+    Write price tier table referenced by price_id of the detail tabs to excel
+    """
+    logging.info("Creating PriceTiers tab.")
+
+    priceTiers.to_excel(writer, "PriceTiers", index=False)
+    worksheet = writer.sheets['PriceTiers']
+    format2 = workbook.add_format({'align': 'left'})
+    format3 = workbook.add_format({'num_format': '#,##0'})
+    format4 = workbook.add_format({'num_format': '$#,##0.00000'})
+    worksheet.set_column("A:A", 10, format2)
+    worksheet.set_column("B:B", 40, format2)
+    worksheet.set_column("C:D", 30, format2)
+    worksheet.set_column("E:F", 15, format3)
+    worksheet.set_column("G:G", 15, format4)
+    totalrows, totalcols = priceTiers.shape
+    worksheet.autofilter(0, 0, totalrows, totalcols - 1)
+    return
+@timedStage
+def createUsageSummaryTab(usageAggregate):
+    """
+    Create Usage Summary tab of cost by account, service and month
+    :param usageAggregate: dataframe of account usage aggregated by account, month, resource, plan and metric
+    """
     logging.info("Creating Usage Summary tab.")
-    usageSummary = pd.pivot_table(paasUsage, index=["account_name", "resource_name"],
+    usageSummary = pivotTable(usageAggregate, index=["account_name", "resource_name"],
                                     columns=["month"],
                                     values=["cost"],
                                     aggfunc=np.sum, margins=True, margins_name="Total",
@@ -584,9 +722,14 @@ def createUsageSummaryTab(paasUsage):
     format2 = workbook.add_format({'align': 'left'})
     worksheet.set_column("A:A", 35, format2)
     worksheet.set_column("B:ZZ", 18, format1)
-def createMetricSummary(paasUsage):
+@timedStage
+def createMetricSummary(usageAggregate):
+    """
+    Create Metric Plan Summary tab of rateable quantity and cost by account, service, plan, metric and month
+    :param usageAggregate: dataframe of account usage aggregated by account, month, resource, plan and metric
+    """
     logging.info("Creating Metric Plan Summary tab.")
-    metricSummaryPlan = pd.pivot_table(paasUsage, index=["account_name", "resource_name", "plan_name", "metric"],
+    metricSummaryPlan = pivotTable(usageAggregate, index=["account_name", "resource_name", "plan_name", "metric"],
                                  columns=["month"],
                                  values=["rateable_quantity", "cost"],
                                  aggfunc=np.sum, margins=True, margins_name="Total",
@@ -605,6 +748,44 @@ def createMetricSummary(paasUsage):
     worksheet.set_column("E:H", 30, format3)
     worksheet.set_column("I:ZZ", 15, format1)
     return
+@timedStage
+def createAnomaliesTab(usageAggregate, months, window, threshold):
+    """
+    Create Anomalies tab of the cost of each account, service and metric in months outside the rolling baseline of the
+    months before, using every month of usage collected and of the usage history as history
+    :param usageAggregate: typed dataframe of account usage aggregated by account, month, resource, plan and metric
+    :param months: months to flag
+    :param window: months of the rolling baseline
+    :param threshold: standard deviations from the baseline of an anomaly
+    """
+    logging.info("Creating Anomalies tab.")
+    history = historyMonths(usageAggregate, months[0])
+    if history < ANOMALY_MIN_PERIODS:
+        logging.warning("Only {} months of usage before {}, {} are required for anomaly baselines.  Anomalies are not flagged until "\
+            "earlier months are collected (--start) or kept in the --anomaly_history file.".format(history, months[0], ANOMALY_MIN_PERIODS))
+    anomalies = detectAnomalies(usageAggregate, months, window=window, threshold=threshold)
+    if len(anomalies) > 0:
+        logging.warning("{} usage anomalies found from {} to {}, see the Anomalies tab.".format(len(anomalies), months[0], months[-1]))
+    anomalies.to_excel(writer, 'Anomalies', index=False)
+    worksheet = writer.sheets['Anomalies']
+    format1 = workbook.add_format({'num_format': '$#,##0.00'})
+    format2 = workbook.add_format({'align': 'left'})
+    format3 = workbook.add_format({'num_format': '#,##0.00'})
+    worksheet.set_column("A:A", 10, format2)
+    worksheet.set_column("B:F", 30, format2)
+    worksheet.set_column("G:G", 18, format3)
+    worksheet.set_column("H:J", 18, format1)
+    worksheet.set_column("K:K", 10, format2)
+    worksheet.set_column("L:L", 18, format1)
+    worksheet.set_column("M:M", 10, format3)
+    worksheet.set_column("N:N", 10, format2)
+    totalrows, totalcols = anomalies.shape
+    worksheet.autofilter(0, 0, totalrows, totalcols - 1)
+    if history < ANOMALY_MIN_PERIODS:
+        bold = workbook.add_format({'bold': True})
+        worksheet.write(totalrows + 2, 0, "Note: Only {} months of usage history before {}, at least {} are required to flag anomalies.".format(history, months[0], ANOMALY_MIN_PERIODS), bold)
+    return
+@timedStage
 def createVcpuTab(instancesUsage,end):
     """
     Create VCPU deployed by role, account, and az
@@ -612,8 +793,8 @@ def createVcpuTab(instancesUsage,end):
 
     logging.info("Calculating Virtual Server vCPU deployed.")
     usageMonth = datetime.strftime(end, "%Y-%m")
-    servers = instancesUsage.query('service_id == "is.instance" and (metric == "VCPU_HOURS" or metric =="INSTANCE_HOURS_MULTI_TENANT") and instance_role.str.contains("symphony-worker") and month == @usageMonth')
-    vcpu = pd.pivot_table(servers, index=["account_name", "region", "availability_zone", "instance_role", "audit"],
+    servers = select(instancesUsage, VIRTUAL_SERVER_HOURS & SYMPHONY_WORKERS & (column("month") == usageMonth))
+    vcpu = pivotTable(servers, index=["account_name", "region", "availability_zone", "instance_role", "audit"],
                                     values=["instance_id", "numberOfVirtualCPUs"],
                                     aggfunc={"instance_id": "nunique", "numberOfVirtualCPUs": np.sum},
                                     margins=True, margins_name="Total",
@@ -628,6 +809,7 @@ def createVcpuTab(instancesUsage,end):
     worksheet.set_column("A:D", 30, format2)
     worksheet.set_column("E:F", 18, format3)
     return
+@timedStage
 def createBMvcpuTab(instancesUsage,end):
     """
     Create BM VCPU deployed by role, account, and az
@@ -635,8 +817,8 @@ def createBMvcpuTab(instancesUsage,end):
 
     logging.info("Calculating Bare Metal vCPU deployed.")
     usageMonth = datetime.strftime(end, "%Y-%m")
-    servers = instancesUsage.query('service_id == "is.bare-metal-server" and metric == "BARE_METAL_SERVER_HOURS" and instance_role.str.contains("scale-storage") and month == @usageMonth')
-    vcpu = pd.pivot_table(servers, index=["account_name", "region", "availability_zone", "instance_role", "audit"],
+    servers = select(instancesUsage, BARE_METAL_SERVER_HOURS & SCALE_STORAGE & (column("month") == usageMonth))
+    vcpu = pivotTable(servers, index=["account_name", "region", "availability_zone", "instance_role", "audit"],
                                     values=["instance_id", "BMnumberofCores", "BMnumberofSockets"],
                                     aggfunc={"instance_id": "nunique", "BMnumberofCores": np.sum, "BMnumberofSockets": np.sum},
                                     margins=True, margins_name="Total",
@@ -651,6 +833,7 @@ def createBMvcpuTab(instancesUsage,end):
     worksheet.set_column("A:D", 30, format2)
     worksheet.set_column("E:G", 18, format3)
     return
+@timedStage
 def createProvisionAllTab(instancesUsage, end):
     """
     Create Pivot by Original Provision Date
@@ -658,12 +841,12 @@ def createProvisionAllTab(instancesUsage, end):
 
     logging.info("Calculating vCPU by provision date.")
     usageMonth = datetime.strftime(end, "%Y-%m")
-    servers = instancesUsage.query('(service_id == "is.instance" and (metric == "VCPU_HOURS" or metric =="INSTANCE_HOURS_MULTI_TENANT")) or (service_id == "is.bare-metal-server" and metric == "BARE_METAL_SERVER_HOURS") and month == @usageMonth')
+    servers = select(instancesUsage, (VIRTUAL_SERVER_HOURS | BARE_METAL_SERVER_HOURS) & (column("month") == usageMonth))
 
-    vcpu = pd.pivot_table(servers, index=["account_name", "region", "availability_zone", "instance_role", "audit", "instance_profile", "provision_date", "estimated_days"],
+    vcpu = pivotTable(servers, index=["account_name", "region", "availability_zone", "instance_role", "audit", "instance_profile", "provision_date", "billable_days"],
                                     values=["instance_id", "numberOfVirtualCPUs"],
                                     aggfunc={"instance_id": "nunique", "numberOfVirtualCPUs": np.sum},
-                                    fill_value=0).rename(columns={'instance_id': 'instance_count', 'estimated_days': 'days_used'})
+                                    fill_value=0).rename(columns={'instance_id': 'instance_count', 'billable_days': 'days_used'})
 
     new_order = ["instance_count", "numberOfVirtualCPUs"]
     vcpu = vcpu.reindex(new_order, axis=1)
@@ -677,6 +860,7 @@ def createProvisionAllTab(instancesUsage, end):
     #totalrows,totalcols=vcpu.shape
     #worksheet.autofilter(0,0,totalrows,totalcols)
     return
+@timedStage
 def createProvisionScaleTab(instancesUsage, end):
     """
     Create Pivot by Of Scale Servers by Date
@@ -684,14 +868,13 @@ def createProvisionScaleTab(instancesUsage, end):
 
     logging.info("Calculating vCPU by provision date scale storage nodes. only.")
     usageMonth = datetime.strftime(end, "%Y-%m")
-    servers = instancesUsage.query(
-        'service_id == "is.bare-metal-server" and metric == "BARE_METAL_SERVER_HOURS" and instance_role.str.contains("scale-storage") and month == @usageMonth')
+    servers = select(instancesUsage, BARE_METAL_SERVER_HOURS & SCALE_STORAGE & (column("month") == usageMonth))
 
-    vcpu = pd.pivot_table(servers, index=["account_name", "region", "availability_zone", "instance_role", "instance_profile", "audit", "provision_date", "estimated_days"],
+    vcpu = pivotTable(servers, index=["account_name", "region", "availability_zone", "instance_role", "instance_profile", "audit", "provision_date", "billable_days"],
                                     values=["instance_id", "BMnumberofCores", "BMnumberofSockets"],
                                     aggfunc={"instance_id": "nunique", "BMnumberofCores": np.sum, "BMnumberofSockets": np.sum},
                                     margins=True, margins_name="Total",
-                                    fill_value=0).rename(columns={'instance_id': 'instance_count', 'estimated_days': 'days_used',  "BMnumberofCores": "Cores", "BMnumberofSockets": "Sockets"})
+                                    fill_value=0).rename(columns={'instance_id': 'instance_count', 'billable_days': 'days_used',  "BMnumberofCores": "Cores", "BMnumberofSockets": "Sockets"})
 
     new_order = ["instance_count", "Cores", "Sockets"]
     vcpu = vcpu.reindex(new_order, axis=1)
@@ -705,6 +888,7 @@ def createProvisionScaleTab(instancesUsage, end):
     #totalrows,totalcols=vcpu.shape
     #worksheet.autofilter(0,0,totalrows,totalcols)
     return
+@timedStage
 def createProvisionWorkersTab(instancesUsage, end):
     """
     Create Pivot by Original Provision Date
@@ -712,13 +896,13 @@ def createProvisionWorkersTab(instancesUsage, end):
 
     logging.info("Calculating vCPU by provision date symphony-workers only.")
     usageMonth = datetime.strftime(end, "%Y-%m")
-    servers = instancesUsage.query('service_id == "is.instance" and instance_role.str.contains("symphony-worker") and month == @usageMonth and (metric == "VCPU_HOURS" or metric =="INSTANCE_HOURS_MULTI_TENANT")')
+    servers = select(instancesUsage, VIRTUAL_SERVER_HOURS & SYMPHONY_WORKERS & (column("month") == usageMonth))
 
-    vcpu = pd.pivot_table(servers, index=["account_name", "region", "availability_zone", "instance_role", "audit", "instance_profile", "provision_date", "estimated_days"],
+    vcpu = pivotTable(servers, index=["account_name", "region", "availability_zone", "instance_role", "audit", "instance_profile", "provision_date", "billable_days"],
                                     values=["instance_id", "numberOfVirtualCPUs"],
                                     aggfunc={"instance_id": "nunique", "numberOfVirtualCPUs": np.sum},
                                     margins=True, margins_name="Total",
-                                    fill_value=0).rename(columns={'instance_id': 'instance_count', 'estimated_days': 'days_used'})
+                                    fill_value=0).rename(columns={'instance_id': 'instance_count', 'billable_days': 'days_used'})
 
     new_order = ["instance_count", "numberOfVirtualCPUs"]
     vcpu = vcpu.reindex(new_order, axis=1)
@@ -732,179 +916,98 @@ def createProvisionWorkersTab(instancesUsage, end):
     #totalrows,totalcols=vcpu.shape
     #worksheet.autofilter(0,0,totalrows,totalcols)
     return
-def createTrueUp(accountUsage, end):
+@timedStage
+def createServerDaysTab(instancesUsage, end):
     """
-    Calculate table for variable usage items for TrueUp (Appendix F - table 14)
-     - IBM Cloud Object Storage  service_id dff97f5c-bc5e-4455-b470-411c3edbe49c
-     - Direct LInk 2.0 Data Charges service_id 86fb7610-0f92-11ea-a6a3-8b96ed1570d8
-     - IBM Cloud Activity Tracker service_id dcc46a60-e13b-11e8-a015-757410dab16b
-     - IBM Cloud Monitoring service_id 090c2c10-8c38-11e8-bec2-493df9c49eb8
-     - IBM Cloud Secrets Managers service_id ebc0cdb0-af2a-11ea-98c7-29e5db822649
-     - IBM Cloud DNS Service service_id b4ed8a30-936f-11e9-b289-1d079699cbe5
+    Create ServerDays tab of servers whose billable days differ from the hours estimate or whose usage hours disagree with
+    their lifetime in the month
+    """
+
+    logging.info("Creating ServerDays tab.")
+    usageMonth = datetime.strftime(end, "%Y-%m")
+    """ Servers are the rows with a lifetime check, "" where usage hours agree with the lifetime """
+    servers = select(instancesUsage, (column("month") == usageMonth) & column("lifetime_check").notna())
+    servers = servers[(servers["lifetime_check"] != "") | (servers["billable_days"] != servers["estimated_days"])]
+    serverDays = pd.DataFrame(servers, columns=["account_name", "region", "availability_zone", "instance_role", "instance_name", "instance_id",
+                                                "instance_profile", "metric", "instance_created_at", "instance_deleted_at", "instance_state",
+                                                "usage_hours", "lifetime_hours", "estimated_days", "billable_days", "lifetime_check"])
+    serverDays.to_excel(writer, 'ServerDays', index=False)
+    worksheet = writer.sheets['ServerDays']
+    format2 = workbook.add_format({'align': 'left'})
+    format3 = workbook.add_format({'num_format': '#,##0.00'})
+    worksheet.set_column("A:K", 25, format2)
+    worksheet.set_column("L:O", 15, format3)
+    worksheet.set_column("P:P", 20, format2)
+    totalrows, totalcols = serverDays.shape
+    worksheet.autofilter(0, 0, totalrows, totalcols - 1)
+    return
+@timedStage
+def createTrueUp(usageAggregate, months):
+    """
+    Calculate table for variable usage items for TrueUp (Appendix F - table 14) for each month, tab is created for the last month
+    and with more than one month a TrueUp_Quarterly tab of each month and contract quarter.
+    Variable usage services and metrics are configured in the --trueup file (trueup.yaml)
+    :param usageAggregate: dataframe of account usage aggregated by account, month, resource, plan and metric
+    :param months: months of report
     """
     def calculateAllocations(variableServices):
         """
         Based on contract calculate allocations based on hosts.
         Allotments are monthly but calculated quarterly based on contract start of June 2022
         (june, july, august), (sept, oct,nov), (dec,jan,feb), (march, april, may)
-
-         - IBM Cloud Object Storage  service_id dff97f5c-bc5e-4455-b470-411c3edbe49c
-            Will exist accross all accounts. Smart Tier Regional quoted, but not being used.
-
-         - Direct LInk 2.0 Data Charges service_id 86fb7610-0f92-11ea-a6a3-8b96ed1570d8
-            Direct LInk instances should be in HPC Common only
-
-         - Transit Gateway Data Charge  service_id f38a4da0-c353-11e9-83b6-a36a57a97a06
-            Only used by IBM admins
-
-         - IBM Cloud Activity Tracker service_id dcc46a60-e13b-11e8-a015-757410dab16b
-            Provisioned in each account (application).  Are allocations managed per application?
-
-         - IBM Cloud Monitoring service_id 090c2c10-8c38-11e8-bec2-493df9c49eb8
-            Monitoring per account (application).  Allocations accross accounts.
-
-         - IBM Cloud Secrets Managers service_id ebc0cdb0-af2a-11ea-98c7-29e5db822649
-            Should be in HPC Common (currently deployed in ACE), one per region
-
-         - IBM Cloud DNS Service service_id b4ed8a30-936f-11e9-b289-1d079699cbe5
-            Should be one instance in common accounnt, one zone per application, query allocation her compute node
+        Service metrics are classified by contract category from the variable service lookup table compiled from trueup.yaml
         """
 
         table = pd.DataFrame(variableServices,
                              columns=["month", "resource_id", "resource_name", "plan_name",
                                       "metric", "quantity", "rateable_quantity", "cost"]).groupby(
             ["month", "resource_id", "resource_name", "plan_name", "metric"], sort=False,
-            as_index=False).agg({"quantity": np.sum, "rateable_quantity": np.sum, "cost": np.sum})
-
-
-        logging.info("Calculating Variable Usage for {}.".format(billingMonth))
-
-        for index, row in table.iterrows():
-            if row["resource_id"] == objectstorage:
-                """
-                Object Storage
-                Metrics
-                    SMART_TIER_BANDWIDTH - 0 allocted
-                    SMART_TIER_STORAGE - 0 allocted 
-                    SMART_TIER_CLASS_A_CALLS - 0 allocted
-                    SMART_TIER_CLASS_B_CALLS - 0 allocted
-                    SMART_TIER_RETRIEVAL -0 allocted
-                    SMART_TIER_BANDWIDTH - 0 allocted
-                    SMART_TIER_CLASS_A_CALLS - 0 allocted
-                    SMART_TIER_CLASS_B_CALLS - 0 allocted
-                    SMART_TIER_RETRIEVAL - 0 allocted
-                    STANDARD_BANDWIDTH - 0 allocted
-                    STANDARD_CLASS_A_CALLS - 0 allocted
-                    STANDARD_CLASS_B_CALLS - 0 allocted
-                    SMART_TIER_STORAGE - 30GB per compute node
-                    STANDARD_STORAGE - not quoted in contract, but should be combined with Smart Tier storage.
-                Appendix F Table 14 only states a charge for Short Term Storage; originally assumed
-                to be cross Region Standard Tier; but apply to all
-                """
-                table.at[index, "contract_category"] = "variable"
-
-            elif row["resource_id"] == directlink:
-                """
-                Direct LInk 2.0 Data Charges service_id 86fb7610-0f92-11ea-a6a3-8b96ed1570d8
-                Direct LInk instances should be in HPC Common only
-                Metrics
-                    Instance_1Gbps_Metered_Port - In base charge 
-                    GIGABYTE_TRANSMITTED_OUTBOUND - 100GB per compute node
-                """
-                if row["metric"] == "GIGABYTE_TRANSMITTED_OUTBOUND":
-                    table.at[index, "contract_category"] = "variable"
-
-            elif row["resource_id"] == activitytracker:
-                """
-                Activity Tracker
-                Metrics
-                    GIGABYTE_MONTHS - 10 MB per compute node
-                """
-                if row["metric"] == "GIGABYTE_MONTHS":
-                    table.at[index, "contract_category"] = "variable"
-
-            elif row["resource_id"] == monitoringservice:
-                """
-                IBM Cloud Monitoring 
-                METRICS
-                    API_CALL_HOURS  - 0 allocated
-                    TIME_SERIES_HOURS - 66.6K per compute node
-                """
-                if row["metric"] == "TIME_SERIES_HOURS" or row["metric"] == "API_CALL_HOURS":
-                    table.at[index, "contract_category"] = "variable"
+            as_index=False, observed=True).agg({"quantity": np.sum, "rateable_quantity": np.sum, "cost": np.sum})
 
-            elif row["resource_id"] == secretsmanager:
-                """
-                IBM Cloud Secrets Managers 
-                Metrics
-                INSTANCES - fixed, in common one per region - 1 per AZ
-                ACTIVE_SECRETS  - 1 secret per compute node            
-                """
-                if row["metric"] == "ACTIVE_SECRETS":
-                    table.at[index, "contract_category"] = "variable"
 
-            elif row["resource_id"] == dnsservice:
-                """
-                IBM Cloud DNS Service
-                Metrics
-                    MILLION_ITEMS - 100,000 (DNS queries) per compute host
-                    ITEMS - 1 zone per app
-                    NUMBERGLB - 0 allocated
-                    NUMBERPOOLS - 0 allocated
-                    NUMBERHEALTHCHECK - 0 allocated
-                    RESOLVERLOCATIONS - 0 allocated
-                    MILLION_ITEMS_CREXTERNALQUERIES - 0 allocated            
-                """
-                if row["metric"] == "MILLION_ITEMS":
-                    table.at[index, "contract_category"] = "variable"
-            elif row["resource_id"] == transitgateway:
-                """
-                Intention is to have discounted transitgateway, but show actuals
-                """
-                table.at[index, "contract_category"] = "variable"
+        logging.info("Calculating Variable Usage for {} to {}.".format(months[0], billingMonth))
 
+        """
+        Classify each service metric from the variable service lookup table, metrics of services configured with any match "any"
+        """
+        table["rule_metric"] = table["metric"].astype(object).where(~table["resource_id"].isin(select(variableRules, column("rule_metric") == "any")["resource_id"]), "any")
+        table = table.merge(variableRules, how="left", on=["resource_id", "rule_metric"]).drop(columns="rule_metric")
         return table
 
-    global objectstorage, directlink, transitgateway, activitytracker, monitoringservice, secretsmanager, dnsservice, allocationTable, applicationConfiguration
+    global allocationTable
 
-    """
-    Define Service ID's for variable services included in Trueup
-    """
-    objectstorage = "dff97f5c-bc5e-4455-b470-411c3edbe49c"
-    directlink = "86fb7610-0f92-11ea-a6a3-8b96ed1570d8"
-    activitytracker = "dcc46a60-e13b-11e8-a015-757410dab16b"
-    monitoringservice = "090c2c10-8c38-11e8-bec2-493df9c49eb8"
-    secretsmanager = "ebc0cdb0-af2a-11ea-98c7-29e5db822649"
-    dnsservice = "b4ed8a30-936f-11e9-b289-1d079699cbe5"
-    transitgateway = "f38a4da0-c353-11e9-83b6-a36a57a97a06"
-    billingMonth = datetime.strftime(end, "%Y-%m")
+    billingMonth = months[-1]
 
     logging.info("Creating Variable Services tab.")
 
     """
-    get usage for all metrics for each of the services in Appendix F - Table 14 for usage month.
+    get usage for all metrics for each of the services in Appendix F - Table 14 for all usage months.
     """
-    variableServices = accountUsage.query('month == @billingMonth and ' \
-        ' (resource_id == @objectstorage or resource_id == @directlink' \
-        ' or resource_id == @activitytracker or resource_id == @monitoringservice or resource_id == @secretsmanager' \
-        ' or resource_id == @dnsservice or resource_id == @transitgateway)')
+    variableServiceIds = variableRules["resource_id"].unique()
+    variableServices = select(usageAggregate, column("month").isin(months) & column("resource_id").isin(variableServiceIds))
 
     """
-    Build dataframe of each service metric relevant to the allocations
+    Build dataframe of each service metric relevant to the allocations, grouped by month so every month is calculated in one pass
     """
     allocationTable = calculateAllocations(variableServices)
 
     """
     Filter only those allocations which are varaible
     """
-    allocationTable = allocationTable.query('contract_category == "variable"')
-    overage = pd.DataFrame(allocationTable,
+    allocationTable = select(allocationTable, column("contract_category") == "variable")
+
+    """
+    Count compute nodes of each account for every month
+    """
+    workers = select(instancesUsage, VIRTUAL_SERVER_HOURS & SYMPHONY_WORKERS & column("month").isin(months)).groupby(["account_id", "month"], observed=True).size()
+
+    overage = pd.DataFrame(select(allocationTable, column("month") == billingMonth),
                          columns=["month", "resource_id", "resource_name", "plan_name",
                                   "metric", "contract_category", "rateable_quantity", "cost"]).groupby(
         ["resource_id", "resource_name", "plan_name", "metric"], sort=False,
-        as_index=False).agg({"rateable_quantity": np.sum, "cost": np.sum})
+        as_index=False, observed=True).agg({"rateable_quantity": np.sum, "cost": np.sum})
 
-    trueupPivot = pd.pivot_table(overage, index=["resource_name", "metric"],
+    trueupPivot = pivotTable(overage, index=["resource_name", "metric"],
                                        values=["rateable_quantity", "cost"],
                                        aggfunc={"rateable_quantity": np.sum, "cost": np.sum}, margins=True,
                                        fill_value=0)
@@ -924,14 +1027,6 @@ def createTrueUp(accountUsage, end):
     worksheet.set_column("C:C", 18, format3)
     worksheet.set_column("D:D", 18, format1)
 
-    """
-    Adjust to reflect contract allocations 
-    """
-    aceAllocation=11.69
-    simplicitiAllocation=11.69
-    equitiesAllocation=7.49
-    commoditiesAllocation=7.49
-
     """
     Create Manual calculations table at bottom of pivot output
     """
@@ -941,8 +1036,7 @@ def createTrueUp(accountUsage, end):
     subtotals=[]
     for application in applicationConfiguration:
         if "allocation" in application:
-            servers = instancesUsage.query(
-                'account_id == @application["account"] and service_id == "is.instance" and instance_role.str.contains("symphony-worker") and month == @billingMonth and (metric == "VCPU_HOURS" or metric =="INSTANCE_HOURS_MULTI_TENANT")').shape[0]
+            servers = int(workers.get((application["account"], billingMonth), 0))
 
             worksheet.write(row, 0, application["name"], boldtext)
             worksheet.write(row, 1, "Allocated per Compute Node $", boldtext)
@@ -965,40 +1059,98 @@ def createTrueUp(accountUsage, end):
 
     formula = "=(d" + str(actual) + "-d" + str(row + 1) + ")"
     worksheet.write_formula(row+1, 3, formula, bolddollars)
+
+    if len(months) > 1:
+        createTrueUpQuarters(allocationTable, workers, months)
     return
-def createApplicationChargesTabs(instancesUsage, month):
+@timedStage
+def createTrueUpQuarters(allocationTable, workers, months):
     """
-    Routine to create the Application Specific Contract Charges and write them out to Excel Tabs
+    Create TrueUp_Quarterly tab of variable usage, allocations and overage for each month and contract quarter
+    :param allocationTable: dataframe of variable usage of each service metric for each month
+    :param workers: number of compute nodes by account_id and month
+    :param months: months of report
+    :return:
+    """
+
+    logging.info("Creating TrueUp_Quarterly tab.")
+    variableUsage = allocationTable.groupby("month", observed=True)["cost"].sum()
+    data = []
+    for month in months:
+        nodes = 0
+        allocated = 0
+        for application in applicationConfiguration:
+            if "allocation" in application:
+                servers = int(workers.get((application["account"], month), 0))
+                nodes = nodes + servers
+                allocated = allocated + application["allocation"] * servers
+        usage = variableUsage.get(month, 0)
+        data.append({"Quarter": contractQuarter(month), "Month": month, "Compute_Nodes": nodes, "Allocated": allocated,
+                     "Variable_Usage": usage, "Overage": usage - allocated})
+    monthly = pd.DataFrame(data, columns=["Quarter", "Month", "Compute_Nodes", "Allocated", "Variable_Usage", "Overage"])
+
+    """
+    Quarter totals are summed from the monthly results, Months is the number of months of the quarter in the report
+    """
+    quarterly = monthly.groupby("Quarter", sort=False, as_index=False).agg(
+        {"Month": "count", "Compute_Nodes": np.sum, "Allocated": np.sum, "Variable_Usage": np.sum, "Overage": np.sum}).rename(
+        columns={"Month": "Months", "Compute_Nodes": "Compute_Node_Months"})
+
+    sheet_name = "TrueUp_Quarterly"
+    monthly.to_excel(writer, sheet_name=sheet_name, startrow=3, startcol=0, index=False)
+    row = len(monthly.index) + 7
+    quarterly.to_excel(writer, sheet_name=sheet_name, startrow=row, startcol=0, index=False)
+    worksheet = writer.sheets[sheet_name]
+    format1 = workbook.add_format({'num_format': '$#,##0.00'})
+    format2 = workbook.add_format({'align': 'left'})
+    format3 = workbook.add_format({'num_format': '#,##0'})
+    boldtext = workbook.add_format({'bold': True})
+    worksheet.write(0, 0, "Variable Usage Allocation & Trueup by Month and Contract Quarter for {} to {}".format(months[0], months[-1]), boldtext)
+    worksheet.write(row - 1, 0, "Contract Quarters", boldtext)
+    worksheet.set_column("A:B", 20, format2)
+    worksheet.set_column("C:C", 20, format3)
+    worksheet.set_column("D:F", 18, format1)
+    return
+def calculateContractCharges(instancesUsage, month):
+    """
+    Routine to calculate the Application Specific Contract Charges for a month
     :param instancesUsage: dataframe of detailed usage information from Usage & Recource Controller
     :param month: month to calculate charges for
-    :return:
+    :return: dictionary of application name to dataframe of itemized contract charges
     """
-    global applicationConfiguration
-    def calculatePerAccountCharges(appName, appAccount, componentName, chargeName, role, charge_type, profile, regionCharges):
+    return priceContractCharges(countContractCharges(instancesUsage, month), applicationConfiguration, earlyProvisioning)
+@timedStage
+def countContractCharges(instancesUsage, month):
+    """
+    Routine to count the servers and service instances of each Application Specific Contract Charge for a month.
+    Counts do not depend on contract rates or early provisioning, so the same counts are priced for each set of rates
+    :param instancesUsage: dataframe of detailed usage information from Usage & Recource Controller
+    :param month: month to count charges for
+    :return: dictionary of application name to list of (pricing, component index, charge index, table of charge items counted)
+    """
+    def countPerAccountCharges(appName, appAccount, componentName, chargeName, role, profile):
         """
-        Calculate Per Account Charge for Compute components for specific account
+        Count servers or service instances of Per Account Charge for Compute components for specific account
         :param appName: Name of Application
         :param appAccount: Cloud Account to search against
         :param componentName: Name of the Component being charged
         :param chargeName: Name of Charge
         :param role: Tagged Role to search against
-        :param charge_type:  Type of Charge
         :param profile: profile type to search against
-        :param regionCharges: Charges for each region
-        :return:
+        :return: table of charge items counted
         """
 
         logging.info("Creating {} -- {} per Account charges for {}.".format(componentName, chargeName, appName))
 
         if profile == "any":
-            operational = servers.query('(instance_role.str.contains(@role) and account_id == @appAccount)')
+            operational = select(servers, column("instance_role").contains(role) & (column("account_id") == appAccount))
         else:
             # filter to specific profile type if specified
-            operational = servers.query('(instance_role.str.contains(@role) and instance_profile == @profile and account_id == @appAccount)')
+            operational = select(servers, column("instance_role").contains(role) & (column("instance_profile") == profile) & (column("account_id") == appAccount))
 
         table0 = pd.DataFrame(operational,
                               columns=["region", "availability_zone", "instance_id",
-                                       "instance_name", "instance_role"]).groupby(['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],sort=False, as_index=False).agg("count")
+                                       "instance_name", "instance_role"]).groupby(['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],sort=False, as_index=False, observed=True).agg("count")
 
         table0["contract_category"] = "{} - {}".format(componentName, chargeName)
         table0["availability_zone"] = ""  #remove zone because charge is per account
@@ -1006,180 +1158,131 @@ def createApplicationChargesTabs(instancesUsage, month):
         table0["metric"] = type
 
         # Consolidate Table to one row per Region, AZ and contract Category
-        table1 = pd.DataFrame(table0, columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', "metric"],sort=False, as_index=False).agg("count")
-
-        table1["contract_rate"] = ""
-        table1["unit_rate"] = ""
-        # For per account, match to any region
-        for index, row in table1.iterrows():
-            contract_rate = (list(filter(lambda x: x["name"] == "any", regionCharges))[0]["contract_rate"])
-            table1.at[index, "contract_rate"] = contract_rate
-            table1.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-            table1.at[index, "period"] = charge_type
-        table1["estimated_days"] = ""
-        table1["quantity"] = 1
+        table1 = pd.DataFrame(table0, columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', "metric"],sort=False, as_index=False, observed=True).agg("count")
+
         return table1
-    def calculateServicePerAccountCharges(appName, appAccount, componentName, chargeName, role, charge_type, service, regionCharges):
+    def countServicePerAccountCharges(appName, appAccount, componentName, chargeName, role, service):
         """
-        Calculate Per Account Charge for Service components in specified account
+        Count servers or service instances of Per Account Charge for Service components in specified account
         :param appName: Name of Application
         :param appAccount: Cloud Account to search against
         :param componentName: Name of the Component being charged
         :param chargeName: Name of Charge
         :param role: Tagged Role to search against
-        :param charge_type:  Type of Charge
         :param profile: profile type to search against
-        :param regionCharges: Charges for each region
-        :return:
+        :return: table of charge items counted
         """
 
         logging.info("Creating {} -- {} per Account charges for {}.".format(componentName, chargeName, appName))
 
         if role == "any":
             # include all services found.  Note for PerRegion charge # of instances is not used in calculating fixed charged.  Therefore this would only impact charge if there was one.
-            operational = services.query('(service_id.str.contains(@service) and account_id == @appAccount)')
+            operational = select(services, column("service_id").contains(service) & (column("account_id") == appAccount))
         else:
             # filter to specific instance_role if specified
-            operational = services.query('(service_id.str.contains(@service) and (instance_role.str.contains(@role) and account_id == @appAccount)')
+            operational = select(services, column("service_id").contains(service) & column("instance_role").contains(role) & (column("account_id") == appAccount))
 
         table0 = pd.DataFrame(operational,
                               columns=["region", "availability_zone", "instance_id",
-                                       "instance_name", "instance_role"]).groupby(['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],sort=False, as_index=False).agg("count")
+                                       "instance_name", "instance_role"]).groupby(['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],sort=False, as_index=False, observed=True).agg("count")
 
         table0["contract_category"] = "{} - {}".format(componentName, chargeName)
         table0["availability_zone"] = ""  #remove zone because charge is per account
         table0["region"] = "" #remove region because charge is per account.
         table0["metric"] = type
         # Consolidate Table to one row per Region, AZ and contract Category
-        table1 = pd.DataFrame(table0, columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', "metric"],sort=False, as_index=False).agg("count")
-
-        table1["contract_rate"] = ""
-        table1["unit_rate"] = ""
-        # For per account, match to any region
-        for index, row in table1.iterrows():
-            contract_rate = (list(filter(lambda x: x["name"] == "any", regionCharges))[0]["contract_rate"])
-            table1.at[index, "contract_rate"] = contract_rate
-            table1.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-            table1.at[index, "period"] = charge_type
-        table1["estimated_days"] = ""
-        table1["quantity"] = 1
+        table1 = pd.DataFrame(table0, columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', "metric"],sort=False, as_index=False, observed=True).agg("count")
+
         return table1
-    def calculatePerRegionCharges(appName, appAccount, componentName, chargeName, role, charge_type, profile, regionCharges):
+    def countPerRegionCharges(appName, appAccount, componentName, chargeName, role, profile):
         """
-        Calculate Base Per Region Charge for Compute components in account
+        Count servers or service instances of Base Per Region Charge for Compute components in account
         :param appName: Name of Application
         :param appAccount: Cloud Account to search against
         :param componentName: Name of the Component being charged
         :param chargeName: Name of Charge
         :param role: Tagged Role to search against
-        :param charge_type:  Type of Charge
         :param profile: profile type to search against
-        :param regionCharges: Charges for each region
-        :return:
+        :return: table of charge items counted
         """
 
         logging.info("Creating {} -- {} per Region charges for {}.".format(componentName, chargeName, appName))
 
         if profile == "any":
-            operational = servers.query('(instance_role.str.contains(@role) and account_id == @appAccount)')
+            operational = select(servers, column("instance_role").contains(role) & (column("account_id") == appAccount))
         else:
             # filter to specific profile type if specified
-            operational = servers.query('(instance_role.str.contains(@role) and instance_profile == @profile and account_id == @appAccount)')
+            operational = select(servers, column("instance_role").contains(role) & (column("instance_profile") == profile) & (column("account_id") == appAccount))
 
         table0 = pd.DataFrame(operational,
                               columns=["region", "availability_zone", "instance_id",
-                                       "instance_name", "instance_role"]).groupby(['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],sort=False, as_index=False).agg("count")
+                                       "instance_name", "instance_role"]).groupby(['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],sort=False, as_index=False, observed=True).agg("count")
 
         table0["contract_category"] = "{} - {}".format(componentName, chargeName)
         table0["availability_zone"] = ""  #remove zone because charge is per region not per zone
         table0["metric"] = type
 
         # Consolidate Table to one row per Region, AZ and contract Category
-        table1 = pd.DataFrame(table0, columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', "metric"],sort=False, as_index=False).agg("count")
-
-        table1["contract_rate"] = ""
-        table1["unit_rate"] = ""
-        # Lookup contract charges from regionCharges variable
-        for index, row in table1.iterrows():
-            contract_rate = (list(filter(lambda x: x["name"] == row["region"], regionCharges))[0]["contract_rate"])
-            table1.at[index, "contract_rate"] = contract_rate
-            table1.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-            table1.at[index, "period"] = charge_type
-        table1["estimated_days"] = ""
-        table1["quantity"] = 1
+        table1 = pd.DataFrame(table0, columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', "metric"],sort=False, as_index=False, observed=True).agg("count")
+
         return table1
-    def calculateServicePerRegionCharges(appName, appAccount, componentName, chargeName, role, charge_type, service, regionCharges):
+    def countServicePerRegionCharges(appName, appAccount, componentName, chargeName, role, service):
         """
-        Calculate Base Per Region Charge for Service in an account
+        Count servers or service instances of Base Per Region Charge for Service in an account
         :param appName: Name of Application
         :param appAccount: Cloud Account to search against
         :param componentName: Name of the Component being charged
         :param chargeName: Name of Charge
         :param role: Tagged Role to search against
-        :param charge_type:  Type of Charge
         :param service: service_name to search against
-        :param regionCharges: Charges for each region
-        :return:
+        :return: table of charge items counted
         """
 
         logging.info("Creating {} -- {} per Region charges for {}.".format(componentName, chargeName, appName))
         if role == "any":
             # include all services found.  Note for PerRegion charge # of instances is not used in calculating fixed charged.  Therefore this would only impact charge if there was one.
-            operational = services.query('(service_id.str.contains(@service) and account_id == @appAccount)')
+            operational = select(services, column("service_id").contains(service) & (column("account_id") == appAccount))
         else:
             # filter to specific instance_role if specified
-            operational = services.query('(service_id.str.contains(@service) and (instance_role.str.contains(@role) and account_id == @appAccount)')
+            operational = select(services, column("service_id").contains(service) & column("instance_role").contains(role) & (column("account_id") == appAccount))
 
         table0 = pd.DataFrame(operational,
                               columns=["region", "availability_zone", "instance_id",
-                                       "instance_name", "instance_role"]).groupby(['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],sort=False, as_index=False).agg("count")
+                                       "instance_name", "instance_role"]).groupby(['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],sort=False, as_index=False, observed=True).agg("count")
 
         table0["contract_category"] = "{} - {}".format(componentName, chargeName)
         table0["availability_zone"] = ""
         table0["metric"] = type
 
         # Consolidate Table to one row per Region, AZ and contract Category
-        table1 = pd.DataFrame(table0, columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', "metric"],sort=False, as_index=False).agg("count")
-
-        table1["contract_rate"] = ""
-        table1["unit_rate"] = ""
-
-        # Lookup contract charges from regionCharges variable
-        for index, row in table1.iterrows():
-            contract_rate = (list(filter(lambda x: x["name"] == row["region"], regionCharges))[0]["contract_rate"])
-            table1.at[index, "contract_rate"] = contract_rate
-            table1.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-            table1.at[index, "period"] = charge_type
-        table1["estimated_days"] = ""
-        table1["quantity"] = 1
+        table1 = pd.DataFrame(table0, columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', "metric"],sort=False, as_index=False, observed=True).agg("count")
+
         return table1
-    def calculatePerAzCharges(appName, appAccount, componentName, chargeName, role, charge_type, profile, regionCharges):
+    def countPerAzCharges(appName, appAccount, componentName, chargeName, role, profile):
         """
-        Calculate Base Per AZ for Operational Components based on all accounts (charge once if exists in AZ in any account)
+        Count servers or service instances of Base Per AZ for Operational Components based on all accounts (charge once if exists in AZ in any account)
         :param appName: Name of Application
         :param appAccount: Cloud Account to search against
         :param componentName: Name of the Component being charged
         :param chargeName: Name of Charge
         :param role: Tagged Role to search against
-        :param charge_type:  Type of Charge
         :param profile: Profile to search against
-        :param regionCharges: Charges for each region
-        :return:
+        :return: table of charge items counted
         """
 
         logging.info("Creating {} -- {} per AZ charges for {}.".format(componentName, chargeName, appName))
         if profile == "any":
-            operational = servers.query('(instance_role.str.contains(@role))')
+            operational = select(servers, column("instance_role").contains(role))
         else:
             # filter to specific profile type if specified
-            operational = servers.query('(instance_role.str.contains(@role) and instance_profile == @profile)')
+            operational = select(servers, column("instance_role").contains(role) & (column("instance_profile") == profile))
 
         table0 = pd.DataFrame(operational,
                               columns=["region", "availability_zone", "instance_id",
                                        "instance_name", "instance_role"]).groupby(
             ['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],
             sort=False,
-            as_index=False).agg("count")
+            as_index=False, observed=True).agg("count")
 
         table0["contract_category"] = "{} - {}".format(componentName, chargeName)
         table0["metric"] = type
@@ -1188,46 +1291,34 @@ def createApplicationChargesTabs(instancesUsage, month):
         table1 = pd.DataFrame(table0,
                               columns=["region", "availability_zone", "contract_category", "metric"]).groupby(
             ['region', 'availability_zone', 'contract_category', "metric"],
-            sort=False, as_index=False).agg("count")
-
-        table1["contract_rate"] = ""
-        table1["unit_rate"] = ""
-        # Lookup contract charges from regionCharges variable
-        for index, row in table1.iterrows():
-            contract_rate = (list(filter(lambda x: x["name"] == row["region"], regionCharges))[0]["contract_rate"])
-            table1.at[index, "contract_rate"] = contract_rate
-            table1.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-            table1.at[index, "period"] = charge_type
-        table1["estimated_days"] = ""
-        table1["quantity"] = 1
+            sort=False, as_index=False, observed=True).agg("count")
+
         return table1
-    def calculatePerAzPerAppCharges(appName, appAccount, componentName, chargeName, role, charge_type, profile,regionCharges):
+    def countPerAzPerAppCharges(appName, appAccount, componentName, chargeName, role, profile):
         """
-        Calculate Per AZ Per App Components
+        Count servers or service instances of Per AZ Per App Components
         :param appName: Name of Application
         :param appAccount: Cloud Account to search against
         :param componentName: Name of the Component being charged
         :param chargeName: Name of Charge
         :param role: Tagged Role to search against
-        :param charge_type:  Type of Charge
         :param profile: Profile to search against
-        :param regionCharges: Charges for each region
-        :return:
+        :return: table of charge items counted
         """
 
         logging.info("Creating {} -- {} per AZ charges per App for {}.".format(componentName, chargeName, appName))
         if profile == "any":
-            operational = servers.query('(instance_role.str.contains(@role)  and account_id == @appAccount)')
+            operational = select(servers, column("instance_role").contains(role) & (column("account_id") == appAccount))
         else:
             # filter to specific profile type if specified
-            operational = servers.query('(instance_role.str.contains(@role) and instance_profile == @profile and account_id == @appAccount)')
+            operational = select(servers, column("instance_role").contains(role) & (column("instance_profile") == profile) & (column("account_id") == appAccount))
 
         table0 = pd.DataFrame(operational,
                              columns=["region", "availability_zone", "instance_id",
                                       "instance_name", "instance_role"]).groupby(
             ['region', 'availability_zone', 'instance_id', 'instance_name', 'instance_role'],
             sort=False,
-            as_index=False).agg("count")
+            as_index=False, observed=True).agg("count")
 
         table0["contract_category"] = "{} - {}".format(componentName,chargeName)
         table0["metric"] = type
@@ -1235,22 +1326,12 @@ def createApplicationChargesTabs(instancesUsage, month):
         # Consolidate Table to one row per Region, AZ and contract Category
         table1 = pd.DataFrame(table0,
                               columns=["region", "availability_zone", "contract_category", "metric"]).groupby(['region', 'availability_zone', 'contract_category', 'metric'],
-                                                        sort=False, as_index=False).agg("count")
-
-        table1["contract_rate"] = ""
-        table1["unit_rate"] = ""
-        # Lookup contract charges from regionCharges variable
-        for index, row in table1.iterrows():
-            contract_rate = (list(filter(lambda x:x["name"]==row["region"],regionCharges))[0]["contract_rate"])
-            table1.at[index, "contract_rate"] = contract_rate
-            table1.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-            table1.at[index, "period"] = charge_type
-        table1["estimated_days"] = ""
-        table1["quantity"] = 1
+                                                        sort=False, as_index=False, observed=True).agg("count")
+
         return table1
-    def calculatePerNodeCharges(appName, appAccount, componentName, chargeName, role, charge_type, profile,regionCharges, daysInMonth):
+    def countPerNodeCharges(appName, appAccount, componentName, chargeName, role, charge_type, profile, daysInMonth):
         """
-        Calculate Per Node Charges for Application
+        Count servers or service instances of Per Node Charges for Application
         :param appName: Name of Application
         :param appAccount: Cloud Account to search against
         :param componentName: Name of the Component being charged
@@ -1258,70 +1339,41 @@ def createApplicationChargesTabs(instancesUsage, month):
         :param role: Tagged Role to search against
         :param charge_type:  Type of Charge
         :param profile: Profile to search against
-        :param regionCharges: Charges for each region
         :param daysInMonth: days used to determine monthly or daily charge
-        :return: table of itemized contract charges
+        :return: table of charge items counted
         """
 
         logging.info("Creating {} -- {} per Node charges for {}.".format(componentName, chargeName, appName))
         # Filter list of servers by role and account and profile
         if charge_type == "monthly":
             if profile == "any":
-                listofservers = servers.query('(instance_role.str.contains(@role) and account_id == @appAccount and estimated and estimated_days == @daysInMonth)')
+                listofservers = select(servers, column("instance_role").contains(role) & (column("account_id") == appAccount) & (column("billable_days") == daysInMonth))
             else:
-                listofservers = servers.query('(instance_role.str.contains(@role) and instance_profile == @profile and account_id == @appAccount and estimated_days == @daysInMonth)')
+                listofservers = select(servers, column("instance_role").contains(role) & (column("instance_profile") == profile) & (column("account_id") == appAccount) & (column("billable_days") == daysInMonth))
         else:
             if profile == "any":
-                listofservers = servers.query('(instance_role.str.contains(@role) and account_id == @appAccount and estimated_days != daysInMonth)')
+                listofservers = select(servers, column("instance_role").contains(role) & (column("account_id") == appAccount) & (column("billable_days") != daysInMonth))
             else:
-                listofservers = servers.query('(instance_role.str.contains(@role) and instance_profile == @profile and account_id == @appAccount and estimated_days != @daysInMonth)')
+                listofservers = select(servers, column("instance_role").contains(role) & (column("instance_profile") == profile) & (column("account_id") == appAccount) & (column("billable_days") != daysInMonth))
 
         if len(listofservers) == 0:
             logging.warning("No per node servers found for {} role={}, type={}, profile={}".format(appName,role,charge_type,profile))
 
 
         table = pd.DataFrame(listofservers,
-                             columns=["region", "availability_zone", "estimated_days", "instance_id",
+                             columns=["region", "availability_zone", "billable_days", "instance_id",
                                       "instance_name",
                                       "instance_profile"]).groupby(
-            ['region', 'availability_zone', 'estimated_days', 'instance_id', 'instance_name', 'instance_profile'],
+            ['region', 'availability_zone', 'billable_days', 'instance_id', 'instance_name', 'instance_profile'],
             sort=False,
-            as_index=False).agg("count")
+            as_index=False, observed=True).agg("count")
 
         table["contract_category"] = "{} - {}".format(componentName, chargeName)
         table["metric"] = type
-        table["contract_rate"] = ""
-        # Lookup contract charges from regionCharges variable
-        for index, row in table.iterrows():
-            # Get Contract Rate, calculate daily rate of rate * days
-            contract_rate = (list(filter(lambda x:x["name"]==row["region"],regionCharges))[0]["contract_rate"])
-            table.at[index, "period"] = charge_type
-            if charge_type == "monthly":
-                table.at[index, "contract_rate"] = contract_rate
-                table.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-            elif charge_type == "daily":
-                """ Check for early provisioning flag and zero charges if <= early provisioning days specified"""
-                if float(row["estimated_days"]) <= float(earlyProvisioning):
-                    estimated_days = 0
-                else:
-                    estimated_days = row["estimated_days"]
-                table.at[index, "contract_rate"] = float(contract_rate * estimated_days)
-                table.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-            else:
-                logging.error("Invalid charge Type {} for application {} {} --{}.".format(charge_type,appName,componentName,chargeName))
-                quit(1)
-
-        if charge_type == "monthly":
-            table["estimated_days"] = ""
-
-        table1 = pd.DataFrame(table,
-                              columns=["region", "availability_zone", "contract_category", "metric", "period", "estimated_days", "unit_rate", "contract_rate", "instance_id"]).groupby(['region', 'availability_zone', 'contract_category', 'metric', "period", "unit_rate", 'estimated_days'],
-                                                        sort=False, as_index=False).agg({ "contract_rate": np.sum, "instance_id": "count"}).rename(columns={'instance_id': 'quantity'})
-
-        return table1
-    def calculatePerServiceInstanceCharges(appName, appAccount, componentName, chargeName, role, charge_type, service, metric, regionCharges):
+        return table
+    def countPerServiceInstanceCharges(appName, appAccount, componentName, chargeName, role, charge_type, service, metric, profile):
         """
-        Calculate Per Service Charges for Application
+        Count servers or service instances of Per Service Charges for Application
         :param appName: Name of Application
         :param appAccount: Cloud Account to search against
         :param componentName: Name of the Component being charged
@@ -1330,136 +1382,196 @@ def createApplicationChargesTabs(instancesUsage, month):
         :param charge_type:  Type of Charge
         :param service: service id of service to identify
         :param metric: unique metric to count for charge quantity
-        :param regionCharges: Charges for each region
-
-        :return: table of itemized contract charges
+        :param profile: profile type to search against
+        :return: table of charge items counted
         """
 
         logging.info("Creating {} -- {} per service instance charges for {}.".format(componentName, chargeName, appName))
         # Per service instance only support Monthly Charges.  Filter list of servers by role and account and profile
         if profile == "any":
-            listofserviceinstances = services.query('(instance_role.str.contains(@role) and account_id == @appAccount and service_id == @service and metric == @metric)')
+            listofserviceinstances = select(services, column("instance_role").contains(role) & (column("account_id") == appAccount) & (column("service_id") == service) & (column("metric") == metric))
         else:
-            listofserviceinstances = services.query('(account_id == @appAccount and service_id == @service and metric == @metric)')
+            listofserviceinstances = select(services, (column("account_id") == appAccount) & (column("service_id") == service) & (column("metric") == metric))
 
         if len(listofserviceinstances) == 0:
             logging.warning("No service instances found for {} role={}, type={}, service={}, metric={}.".format(appName,role,charge_type,service, metric))
 
         table = pd.DataFrame(listofserviceinstances,
-                             columns=["region", "availability_zone", "estimated_days", "instance_id",
+                             columns=["region", "availability_zone", "billable_days", "instance_id",
                                       "instance_name",
                                       "instance_profile"]).groupby(
-            ['region', 'availability_zone', 'estimated_days', 'instance_id', 'instance_name', 'instance_profile'],
+            ['region', 'availability_zone', 'billable_days', 'instance_id', 'instance_name', 'instance_profile'],
             sort=False,
-            as_index=False).agg("count")
+            as_index=False, observed=True).agg("count")
 
 
         table["contract_category"] = "{} - {}".format(componentName, chargeName)
         table["metric"] = type
-        table["contract_rate"] = ""
-        table["estimated_days"] = ""
-        # Lookup contract charges from regionCharges variable
-        for index, row in table.iterrows():
-            # Get Contract Rate, calculate daily rate of rate * days
-            table.at[index, "period"] = charge_type
-            contract_rate = (list(filter(lambda x:x["name"]==row["region"],regionCharges))[0]["contract_rate"])
-            table.at[index, "contract_rate"] = contract_rate
-            table.at[index, "unit_rate"] = "${:,.2f}".format(contract_rate)
-
-        table1 = pd.DataFrame(table, columns=["region", "availability_zone", "contract_category", "metric", "period", "estimated_days", "unit_rate", "contract_rate", "instance_id"])\
-                                .groupby(['region', 'availability_zone', 'contract_category', 'metric',"period", "unit_rate", 'estimated_days'],
-                                sort=False, as_index=False).agg({"contract_rate": np.sum, "instance_id": "count"}).rename(columns={'instance_id': 'quantity'})
-
-        return table1
+        table["billable_days"] = ""
+        return table
 
     daysInMonth = calendar.monthrange(month.year, month.month)[1]
     billingMonth = datetime.strftime(month, "%Y-%m")
     """Query filters on last month to calculate counts of servers for all contract billing tabs."""
-    servers = instancesUsage.query('month == @billingMonth and (service_id == "is.instance" and (metric == "VCPU_HOURS" or metric =="INSTANCE_HOURS_MULTI_TENANT")) or (service_id == "is.bare-metal-server" and metric == "BARE_METAL_SERVER_HOURS")')
-    services = instancesUsage.query('month == @billingMonth and (service_id != "is.instance" or service_id != "is.bare-metal-server")')
+    servers = select(instancesUsage, (column("month") == billingMonth) & (VIRTUAL_SERVER_HOURS | BARE_METAL_SERVER_HOURS))
+    services = select(instancesUsage, column("month") == billingMonth)
 
 
+    contractCounts = {}
     for application in applicationConfiguration:
 
         appName = application["name"]
-        tabName = application["tab"]
         appAccount = application["account"]
         appComponents = application["components"]
-        logging.info("Calculating {} contract charges for {}.".format(billingMonth,appName))
+        logging.info("Counting {} contract charges for {}.".format(billingMonth,appName))
 
-        """Initialize charges DataFrame"""
-        charges = pd.DataFrame()
+        """Initialize list of counted charges"""
+        counts = []
 
-        for component in appComponents:
+        for componentIndex, component in enumerate(appComponents):
             componentName = component["name"]
             type = component["type"]
             """ Iterate through charges and determine if charge type calculations """
-            for charge in component["charge"]:
+            for chargeIndex, charge in enumerate(component["charge"]):
                 chargeName = charge["name"]
                 role = charge["role"]
                 charge_type = charge["type"]
-                if "profile" in charge:
-                    profile = charge["profile"]
-                else:
-                    profile = ""
-                if "service" in charge:
-                    service = charge["service"]
-                else:
-                    service = ""
-                regionCharge = charge["region"]
-                if "metric" in charge:
-                    metric = charge["metric"]
-                else:
-                    metric = ""
+                profile = charge["profile"]
+                service = charge["service"]
+                metric = charge["metric"]
 
                 if type == "per_account":
-                    """ Determine Per Account Charges """
+                    """ Determine Per Account Charges, priced at the rate of region any """
                     if service != "":
                         """ Calculate charge based on whether compute instance exists """
-                        charges = pd.concat([charges,
-                                             calculateServicePerAccountCharges(appName, appAccount, componentName, chargeName, role,
-                                                                       charge_type, service, regionCharge)])
+                        table = countServicePerAccountCharges(appName, appAccount, componentName, chargeName, role, service)
                     else:
                         """ Calculate charge based on whether service instance exists """
-                        charges = pd.concat([charges,
-                                             calculatePerAccountCharges(appName, appAccount, componentName, chargeName, role,
-                                                                       charge_type, profile, regionCharge)])
+                        table = countPerAccountCharges(appName, appAccount, componentName, chargeName, role, profile)
+                    pricing = "account"
                 elif type == "per_region":
                     """ Determine per Region charges """
                     if service != "":
                         """ Calculate per region charge if service exists in region """
-                        charges = pd.concat([charges,
-                                        calculateServicePerRegionCharges(appName, appAccount, componentName, chargeName, role,
-                                                            charge_type, service, regionCharge)])
+                        table = countServicePerRegionCharges(appName, appAccount, componentName, chargeName, role, service)
                     else:
                         """ Calculate per region charge if compute exists in any zone in region """
-                        charges = pd.concat([charges,
-                                        calculatePerRegionCharges(appName, appAccount, componentName, chargeName, role,
-                                                            charge_type, profile, regionCharge)])
-
+                        table = countPerRegionCharges(appName, appAccount, componentName, chargeName, role, profile)
+                    pricing = "region"
                 elif type == "per_az":
                     """ Determine per AZ charges (compute only) """
-                    charges = pd.concat([charges,
-                                         calculatePerAzCharges(appName, appAccount, componentName, chargeName, role,
-                                                               charge_type, profile, regionCharge)])
+                    table = countPerAzCharges(appName, appAccount, componentName, chargeName, role, profile)
+                    pricing = "region"
                 elif type == "per_az_per_app":
                     """ Determine per AZ charges (compute only) """
-                    charges = pd.concat([charges,
-                                         calculatePerAzPerAppCharges(appName, appAccount, componentName, chargeName, role,
-                                                               charge_type, profile, regionCharge)])
+                    table = countPerAzPerAppCharges(appName, appAccount, componentName, chargeName, role, profile)
+                    pricing = "region"
                 elif type == "per_node":
                     """ Determine per node charges should be calculated """
-                    charges = pd.concat([charges,
-                                         calculatePerNodeCharges(appName, appAccount, componentName, chargeName, role,
-                                                                 charge_type, profile, regionCharge, daysInMonth)])
+                    table = countPerNodeCharges(appName, appAccount, componentName, chargeName, role, charge_type, profile, daysInMonth)
+                    pricing = "node"
                 elif type == "per_service_instance":
                     """ Determine per service instance charges should be calculated requires (metric and role) need to be set """
-                    charges = pd.concat([charges,calculatePerServiceInstanceCharges(appName, appAccount, componentName, chargeName, role,
-                                                                 charge_type, service, metric, regionCharge)])
+                    table = countPerServiceInstanceCharges(appName, appAccount, componentName, chargeName, role, charge_type, service, metric, profile)
+                    pricing = "service_instance"
                 else:
                     """ contract charge type not recognized """
                     logging.error("Unrecognized Charge Type of {} in {}.  Unable to generate billing data.".format(type, appName))
                     quit(1)
+                counts.append((pricing, componentIndex, chargeIndex, table))
+
+        contractCounts[appName] = counts
+    return contractCounts
+@timedStage
+def priceContractCharges(contractCounts, configuration, early):
+    """
+    Routine to price counted Application Specific Contract Charges at the contract rates of a configuration
+    :param contractCounts: counted charges of each application from countContractCharges
+    :param configuration: application configuration with the contract rates to price at (apps.yaml)
+    :param early: early provisioning days, daily charges of servers used for this number of days or less are not charged
+    :return: dictionary of application name to dataframe of itemized contract charges
+    """
+    def contractRates(table, regionCharges, appName, chargeName, region=None):
+        """
+        Contract rate of each charge item by region, or of the region specified for every item
+        """
+        rates = {}
+        """ The first rate configured for a region is used """
+        for regionCharge in reversed(regionCharges):
+            rates[regionCharge["name"]] = regionCharge["contract_rate"]
+        regions = pd.Series(region, index=table.index, dtype=object) if region is not None else table["region"]
+        missing = set(regions) - set(rates)
+        if missing:
+            logging.error("No contract rate for region {} of {} in {}.  Unable to generate billing data.".format(", ".join(map(str, missing)), chargeName, appName))
+            quit(1)
+        return regions.map(rates).astype(float)
+
+    contractCharges = {}
+    for application in configuration:
+        appName = application["name"]
+
+        """Initialize charges DataFrame"""
+        charges = pd.DataFrame()
+        for pricing, componentIndex, chargeIndex, counted in contractCounts[appName]:
+            charge = application["components"][componentIndex]["charge"][chargeIndex]
+            charge_type = charge["type"]
+            table = counted.copy()
+            if pricing in ("account", "region"):
+                """ Fixed charge per account, region or zone, for per account match to any region """
+                table["contract_rate"] = contractRates(table, charge["region"], appName, charge["name"], "any" if pricing == "account" else None)
+                table["unit_rate"] = table["contract_rate"].map("${:,.2f}".format)
+                table["period"] = charge_type
+                table["billable_days"] = ""
+                table["quantity"] = 1
+            else:
+                """ Per node and per service instance charges, calculate daily rate of rate * days """
+                contract_rate = contractRates(table, charge["region"], appName, charge["name"])
+                table["period"] = charge_type
+                table["unit_rate"] = contract_rate.map("${:,.2f}".format)
+                if pricing == "service_instance" or charge_type == "monthly":
+                    table["contract_rate"] = contract_rate
+                elif charge_type == "daily":
+                    """ Check for early provisioning flag and zero charges if <= early provisioning days specified"""
+                    billable_days = table["billable_days"].astype(float)
+                    table["contract_rate"] = contract_rate * billable_days.where(billable_days > float(early), 0)
+                else:
+                    logging.error("Invalid charge Type {} for application {} {} --{}.".format(charge_type, appName, application["components"][componentIndex]["name"], charge["name"]))
+                    quit(1)
+                if pricing == "node" and charge_type == "monthly":
+                    table["billable_days"] = ""
+                table = pd.DataFrame(table, columns=["region", "availability_zone", "contract_category", "metric", "period", "billable_days", "unit_rate", "contract_rate", "instance_id"])\
+                                .groupby(['region', 'availability_zone', 'contract_category', 'metric', "period", "unit_rate", 'billable_days'],
+                                sort=False, as_index=False, observed=True).agg({"contract_rate": np.sum, "instance_id": "count"}).rename(columns={'instance_id': 'quantity'})
+            charges = pd.concat([charges, table])
+
+        contractCharges[appName] = charges
+    return contractCharges
+def contractTotal(charges):
+    """
+    Total of itemized contract charges of an application
+    """
+    if "contract_rate" not in charges:
+        return 0
+    return charges["contract_rate"].sum()
+def estimatedSupport(ratedCost):
+    """
+    Support charges calculated as 10% of list usage @ 75% discount
+    """
+    return ratedCost * .10 * .25
+@timedStage
+def createApplicationChargesTabs(contractCharges, month):
+    """
+    Routine to write the Application Specific Contract Charges out to Excel Tabs
+    :param contractCharges: dictionary of application name to dataframe of itemized contract charges for month
+    :param month: month charges were calculated for
+    :return:
+    """
+
+    billingMonth = datetime.strftime(month, "%Y-%m")
+    for application in applicationConfiguration:
+        appName = application["name"]
+        tabName = application["tab"]
+        charges = contractCharges[appName]
 
         """ Setup worksheet formatting"""
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
@@ -1469,14 +1581,14 @@ def createApplicationChargesTabs(instancesUsage, month):
         sheet_name = tabName
 
         """Create Pivot for Charges by Region AZ """
-        chargesPivot = pd.pivot_table(charges, index=["metric", "region", "availability_zone", "contract_category", "period", "unit_rate", "estimated_days", "quantity"],
+        chargesPivot = pivotTable(charges, index=["metric", "region", "availability_zone", "contract_category", "period", "unit_rate", "billable_days", "quantity"],
                                       values=["contract_rate"],
                                       aggfunc={"contract_rate": np.sum},
                                       fill_value=0)
 
         """ Write Application ChargesPivot Table to Excel Tab"""
 
-        totalCharges = charges["contract_rate"].sum()
+        totalCharges = contractTotal(charges)
         totalrows, totalcols = chargesPivot.shape
         chargesPivot.to_excel(writer, sheet_name=sheet_name, startrow=3, startcol=0)
         worksheet = writer.sheets[sheet_name]
@@ -1495,42 +1607,45 @@ def createApplicationChargesTabs(instancesUsage, month):
         worksheet.set_column("F:F", 18, format1)
         worksheet.set_column("G:H", 18, format3)
         worksheet.set_column("I:I", 18, format1)
-        application["contractTotal"] = totalCharges
     return
-def createReconciliation(accountUsage, month):
+@timedStage
+def createReconciliation(usageAggregate, months, contractCharges):
     """
-    Create a reconcilation view that compare Account Usage Charges w/support against Citi billing categories
-    :param accountUsage: dataframe of detailed usage information from Usage & Recource Controller
-    :param month: month to calculate charges for
+    Create a reconcilation view that compare Account Usage Charges w/support against Citi billing categories for the last month,
+    and with more than one month a RECONCILE_Quarterly view of each month and contract quarter
+    :param usageAggregate: dataframe of account usage aggregated by account, month, resource, plan and metric
+    :param months: months to reconcile
+    :param contractCharges: dictionary of month to contract charges of each application calculated for month
     :return:
     """
-    global applicationConfiguration
 
-    # Sum account service usage for each account by billing month
-    billingMonth = month.strftime("%Y-%m")
+    # Sum account service usage for each account by billing month in one pass
+    billingMonth = months[-1]
+    accountCharges = select(usageAggregate, column("month").isin(months)).groupby(["month", "account_id"], observed=True).agg({"cost": np.sum, "rated_cost": np.sum})
     data = []
 
-    for application in applicationConfiguration:
+    for month in months:
+        for application in applicationConfiguration:
 
-        appName = application["name"]
-        appAccount = application["account"]
-        contractCharges = application["contractTotal"]
-        logging.info("Calculating {} Reconciliation for {}.".format(billingMonth,appName))
+            appName = application["name"]
+            appAccount = application["account"]
+            contractCharge = contractTotal(contractCharges[month][appName])
+            logging.info("Calculating {} Reconciliation for {}.".format(month,appName))
 
-        """Sum discounted cost for usage charges"""
-        usage = accountUsage.query('month == @billingMonth and account_id == @appAccount')["cost"].sum()
+            """Sum discounted cost for usage charges"""
+            usage = accountCharges["cost"].get((month, appAccount), 0)
 
-        """Sum rated_cost to calculate Support charges.  Support charges calculated as 10% of list usage @ 75% discount"""
-        support = accountUsage.query('month == @billingMonth and account_id == @appAccount')["rated_cost"].sum() * .10 * .25
+            """Sum rated_cost to calculate Support charges.  Support charges calculated as 10% of list usage @ 75% discount"""
+            support = estimatedSupport(accountCharges["rated_cost"].get((month, appAccount), 0))
 
-        """
-        Build table & dataframe from usage and billing for reconciliation purposes
-        """
-        data.append({"Category": appName, "Billing": contractCharges, "Usage": usage, "Estimated_Support": support, "TotalUsage_w/support": usage + support, "Delta": contractCharges - usage - support })
+            """
+            Build table & dataframe from usage and billing for reconciliation purposes
+            """
+            data.append({"Quarter": contractQuarter(month), "Month": month, "Category": appName, "Billing": contractCharge, "Usage": usage, "Estimated_Support": support, "TotalUsage_w/support": usage + support, "Delta": contractCharge - usage - support })
 
 
-    reconcile = pd.DataFrame(data, columns=['Category', 'Billing', 'Usage', 'Estimated_Support', 'TotalUsage_w/support', 'Delta'])
-    reconcilePivot = pd.pivot_table(reconcile, index=["Category"],
+    reconcile = pd.DataFrame(data, columns=['Quarter', 'Month', 'Category', 'Billing', 'Usage', 'Estimated_Support', 'TotalUsage_w/support', 'Delta'])
+    reconcilePivot = pd.pivot_table(select(reconcile, column("Month") == billingMonth), index=["Category"],
                                     values=["Billing", "Usage", 'Estimated_Support', 'TotalUsage_w/support', 'Delta'],
                                     aggfunc={"Billing": np.sum, "Usage": np.sum, 'Estimated_Support': np.sum, 'TotalUsage_w/support': np.sum, 'Delta': np.sum},
                                     margins=True, margins_name="Total",
@@ -1547,60 +1662,141 @@ def createReconciliation(accountUsage, month):
     worksheet.write(0, 0, "Account Usage vs Application Billing for {}".format(billingMonth), bold)
     worksheet.set_column("A:A", 35, format2)
     worksheet.set_column("B:F", 18, format1)
-    return
-def writeFiletoCos(localfile, upload):
-    """"
-    Write Files to COS
-    """
 
-    def multi_part_upload(bucket_name, item_name, file_path):
-        """"
-        Write Files to COS
+    if len(months) > 1:
         """
-        try:
-            logging.info("Starting file transfer for {0} to bucket: {1}".format(item_name, bucket_name))
-            # set 5 MB chunks
-            part_size = 1024 * 1024 * 5
-
-            # set threadhold to 15 MB
-            file_threshold = 1024 * 1024 * 15
-
-            # set the transfer threshold and chunk size
-            transfer_config = ibm_boto3.s3.transfer.TransferConfig(
-                multipart_threshold=file_threshold,
-                multipart_chunksize=part_size
-            )
-
-            # the upload_fileobj method will automatically execute a multi-part upload
-            # in 5 MB chunks for all files over 15 MB
-            with open(file_path, "rb") as file_data:
-                cos.Object(bucket_name, item_name).upload_fileobj(
-                    Fileobj=file_data,
-                    Config=transfer_config
-                )
-            logging.info("Transfer for {0} complete".format(item_name))
-        except ClientError as be:
-            logging.error("CLIENT ERROR: {0}".format(be))
-        except Exception as e:
-            logging.error("Unable to complete multi-part upload: {0}".format(e))
-        return
-
-    cos = ibm_boto3.resource("s3",
-                             ibm_api_key_id=args.COS_APIKEY,
-                             ibm_service_instance_id=args.COS_INSTANCE_CRN,
-                             config=Config(signature_version="oauth"),
-                             endpoint_url=args.COS_ENDPOINT
-                             )
-    multi_part_upload(args.COS_BUCKET, upload, "./" + localfile)
+        Quarter totals are summed from the monthly reconciliation of each application
+        """
+        quarterly = reconcile.groupby(["Quarter", "Category"], sort=False, as_index=False).agg(
+            {"Billing": np.sum, "Usage": np.sum, 'Estimated_Support': np.sum, 'TotalUsage_w/support': np.sum, 'Delta': np.sum})
+        sheet_name = "RECONCILE_Quarterly"
+        reconcile.to_excel(writer, sheet_name=sheet_name, startrow=3, startcol=0, index=False)
+        row = len(reconcile.index) + 7
+        quarterly.to_excel(writer, sheet_name=sheet_name, startrow=row, startcol=1, index=False)
+        worksheet = writer.sheets[sheet_name]
+        worksheet.write(0, 0, "Account Usage vs Application Billing by Month and Contract Quarter for {} to {}".format(months[0], billingMonth), bold)
+        worksheet.write(row - 1, 0, "Contract Quarters", bold)
+        worksheet.set_column("A:B", 20, format2)
+        worksheet.set_column("C:C", 35, format2)
+        worksheet.set_column("D:H", 18, format1)
+    return
+def readVariants(filename):
+    """
+    Read contract what-if variants
+    :param filename: filename of variants in YAML format
+    :return: list of variants, each with a name and optionally early provisioning days and contract rate changes
+    """
+    with open(filename, 'r') as stream:
+        variants = yaml.load(stream, Loader=YamlLoader)
+    if not isinstance(variants, list) or len(variants) == 0:
+        logging.error("No variants found in {}.".format(filename))
+        quit(1)
+    for variant in variants:
+        if not isinstance(variant, dict) or "name" not in variant:
+            logging.error("Variant {} in {} requires a name.".format(variant, filename))
+            quit(1)
+        for rate in variant.get("rates", []):
+            if "contract_rate" not in rate and "factor" not in rate:
+                logging.error("Rate {} of variant {} requires a contract_rate or factor.".format(rate, variant["name"]))
+                quit(1)
+    return variants
+def applyVariant(variant):
+    """
+    Apply contract rate changes of a variant to a copy of the application configuration
+    Each rate change applies to the contract rates matching its optional application (name or tab), component, charge and region
+    :param variant: variant with rates to change
+    :return: application configuration with the rates of variant
+    """
+    configuration = copy.deepcopy(applicationConfiguration)
+    for rate in variant.get("rates", []):
+        matched = 0
+        for application in configuration:
+            if "application" in rate and rate["application"] not in (application["name"], application["tab"]):
+                continue
+            for component in application["components"]:
+                if "component" in rate and rate["component"] != component["name"]:
+                    continue
+                for charge in component["charge"]:
+                    if "charge" in rate and rate["charge"] != charge["name"]:
+                        continue
+                    for regionCharge in charge["region"]:
+                        if "region" in rate and rate["region"] != regionCharge["name"]:
+                            continue
+                        if "contract_rate" in rate:
+                            regionCharge["contract_rate"] = rate["contract_rate"]
+                        if "factor" in rate:
+                            regionCharge["contract_rate"] = regionCharge["contract_rate"] * rate["factor"]
+                        matched = matched + 1
+        if matched == 0:
+            logging.warning("Rate {} of variant {} does not match any contract rate.".format(rate, variant["name"]))
+    return configuration
+@timedStage
+def simulateVariants(instancesUsage, usageAggregate, month, variants):
+    """
+    Price the contract charges of a month for each variant of contract rates and early provisioning and reconcile them against
+    account usage.  Servers are counted once and the variants are priced in parallel from the same counts.
+    :param instancesUsage: dataframe of detailed usage information from Usage & Recource Controller
+    :param usageAggregate: dataframe of account usage aggregated by account, month, resource, plan and metric
+    :param month: month to simulate
+    :param variants: list of variants from readVariants
+    :return: dataframe of contract billing of each application, total billing, change from current contract and reconciliation of each variant
+    """
+    billingMonth = datetime.strftime(month, "%Y-%m")
+    contractCounts = countContractCharges(instancesUsage, month)
+    accountCharges = select(usageAggregate, column("month") == billingMonth).groupby("account_id", observed=True).agg({"cost": np.sum, "rated_cost": np.sum})
+    usage = 0
+    for application in applicationConfiguration:
+        if application["account"] in accountCharges.index:
+            usage = usage + accountCharges.at[application["account"], "cost"] + estimatedSupport(accountCharges.at[application["account"], "rated_cost"])
+
+    def simulate(variant):
+        early = variant.get("early", earlyProvisioning)
+        logging.info("Pricing {} contract charges for variant {}.".format(billingMonth, variant["name"]))
+        contractCharges = priceContractCharges(contractCounts, applyVariant(variant), early)
+        row = {"Variant": variant["name"], "Early": early}
+        for application in applicationConfiguration:
+            row[application["name"]] = contractTotal(contractCharges[application["name"]])
+        row["Billing"] = sum(row[application["name"]] for application in applicationConfiguration)
+        return row
+
+    """ The current contract is priced first as the baseline of the comparison """
+    with ThreadPoolExecutor(max_workers=min(len(variants) + 1, os.cpu_count() or 1)) as executor:
+        rows = list(executor.map(simulate, [{"name": "current contract"}] + variants))
+    comparison = pd.DataFrame(rows)
+    comparison["Change"] = comparison["Billing"] - comparison.at[0, "Billing"]
+    comparison["TotalUsage_w/support"] = usage
+    comparison["Delta"] = comparison["Billing"] - usage
+    return comparison
+def createWhatIfTab(comparison, month):
+    """
+    Write comparison of contract what-if variants to Excel Tab
+    :param comparison: dataframe from simulateVariants
+    :param month: month simulated
+    """
+    sheet_name = "WhatIf"
+    comparison.to_excel(writer, sheet_name=sheet_name, startrow=3, startcol=0, index=False)
+    worksheet = writer.sheets[sheet_name]
+    format1 = workbook.add_format({'num_format': '$#,##0.00'})
+    format2 = workbook.add_format({'align': 'left'})
+    bold = workbook.add_format({'bold': True})
+    worksheet.write(0, 0, "Contract Billing What-If Variants for {}".format(datetime.strftime(month, "%Y-%m")), bold)
+    worksheet.set_column("A:A", 35, format2)
+    worksheet.set_column("B:B", 10, format2)
+    worksheet.set_column(2, len(comparison.columns) - 1, 20, format1)
     return
-
 if __name__ == "__main__":
     setup_logging()
     load_dotenv()
     parser = argparse.ArgumentParser(description="Calculate Citi Usage and Billing per contract.")
     parser.add_argument("--conf", default=os.environ.get('conf', 'apps.yaml'), help="Filename for application configuraiton file (default = apps.yaml)")
+    parser.add_argument("--trueup", default=os.environ.get('trueup', 'trueup.yaml'), help="Filename for variable usage services of the TrueUp (default = trueup.yaml)")
+    parser.add_argument("--simulate", help="Filename of contract what-if variants, price the contract charges of the last month for each variant instead of creating the report.")
+    parser.add_argument("--simulate_output", default=os.environ.get('simulate_output', 'whatif.xlsx'), help="Filename for Excel output of --simulate.")
     parser.add_argument("--output", default=os.environ.get('output', 'citiUsage.xlsx'), help="Filename for Excel output file. (include extension of .xlsx)")
     parser.add_argument("--early", default=os.environ.get('early', 0), help="Ignore early provisioning by specified number of day.")
+    parser.add_argument("--anomaly_window", type=int, default=int(os.environ.get('anomaly_window', 6)), help="Months of the rolling baseline of usage anomalies.")
+    parser.add_argument("--anomaly_history", default=os.environ.get('anomaly_history', 'usageHistory.pkl'), help="Filename of usage history kept across runs for anomaly baselines (empty for none).")
+    parser.add_argument("--anomaly_threshold", type=float, default=float(os.environ.get('anomaly_threshold', 3.0)), help="Standard deviations from the rolling baseline of a usage anomaly.")
     parser.add_argument("--cos", "--COS", action=argparse.BooleanOptionalAction, help="Upload output to COS.")
     parser.add_argument("--load", action=argparse.BooleanOptionalAction, help="Load dataframes from pkl files.")
     parser.add_argument("--save", action=argparse.BooleanOptionalAction, help="Store dataframes to pkl files.")
@@ -1611,8 +1807,62 @@ if __name__ == "__main__":
     parser.add_argument("--COS_ENDPOINT", default=os.environ.get('COS_ENDPOINT', None), help="COS endpoint to use to write output tp Object Storage.")
     parser.add_argument("--COS_INSTANCE_CRN", default=os.environ.get('COS_INSTANCE_CRN', None), help="COS Instance CRN to use to write output to Object Storage.")
     parser.add_argument("--COS_BUCKET", default=os.environ.get('COS_BUCKET', None), help="COS Bucket name to use to write output to Object Storage.")
+    parser.add_argument("--resume", action=argparse.BooleanOptionalAction, help="Resume collection from checkpoint of a failed run.")
+    parser.add_argument("--checkpoint", default=os.environ.get('checkpoint', 'checkpoint'), help="Checkpoint directory of collection progress.")
+    parser.add_argument("--shard", action=argparse.BooleanOptionalAction, help="Split accounts and months into work units run by worker processes.")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get('workers', 4)), help="Number of local worker processes for --shard (0 if workers run only on other hosts).")
+    parser.add_argument("--worker", action=argparse.BooleanOptionalAction, help="Run as worker collecting work units from queue.")
+    parser.add_argument("--queue", default=os.environ.get('queue', 'shards'), help="Work queue directory, shared by coordinator and workers.")
+    parser.add_argument("--queue_timeout", type=int, default=int(os.environ.get('queue_timeout', 3600)), help="Seconds without a work unit done after which --shard gives up.")
+    parser.add_argument("--importtime", action=argparse.BooleanOptionalAction, help="Log time taken by imports at startup.")
+    parser.add_argument("--metrics", default=os.environ.get('metrics', None), help="Filename for JSON run metrics of each stage and account.")
+    parser.add_argument("--prometheus", default=os.environ.get('prometheus', None), help="Filename for run metrics in Prometheus text format.")
+    parser.add_argument("--profile", default=os.environ.get('profile', None), help="Comma separated stages to profile (ie instance_usage,createApplicationChargesTabs), or all.")
+    parser.add_argument("--profile_dir", default=os.environ.get('profile_dir', 'profile'), help="Directory for profiles of stages.")
+    parser.add_argument("--profiler", choices=["sample", "cprofile"], default=os.environ.get('profiler', 'sample'), help="Sampling profiler writing folded stacks for flame graphs, or cProfile writing pstats files.")
+    parser.add_argument("--profile_every", type=int, default=int(os.environ.get('profile_every', 1)), help="Profile the first and then every Nth call of each stage.")
+    parser.add_argument("--profile_memory", action=argparse.BooleanOptionalAction, help="Track allocations of profiled stages with tracemalloc.")
     args = parser.parse_args()
-    applicationConfiguration = readAppConf(args.conf)
+
+    """ Configuration is validated before anything else is imported or collected, workers do not price charges """
+    if not args.worker:
+        applicationConfiguration = readAppConf(args.conf)
+
+    with importTimer("pandas"):
+        import pandas as pd
+        import numpy as np
+        from accountusage.schema import ACCOUNT_USAGE_SCHEMA, INSTANCE_USAGE_SCHEMA, BATCH_ROWS, applySchema, typedFrame, concatFrames, reportFrame, pivotTable
+        from accountusage.aggregates import UsageAggregate, AGGREGATE_SCHEMA
+        from accountusage.intervals import SERVER_DAYS_SCHEMA, parseTimestamps, lifetimeInMonth, intervalHours, intervalDays, lifetimeCheck
+        from accountusage.prices import PRICE_TIER_SCHEMA, normalizePrices, priceSchema
+        from accountusage.anomalies import detectAnomalies, loadUsageHistory, saveUsageHistory, historyMonths, MIN_PERIODS as ANOMALY_MIN_PERIODS
+    if args.importtime:
+        logImportTimes()
+
+    if args.shard or args.worker:
+        from accountusage.shards import WorkQueue
+    else:
+        from accountusage.checkpoint import Checkpoint
+    if args.profile:
+        from accountusage.profiling import StageProfiler
+        """ Workers sharing the profile directory write to a directory of their own """
+        profileDir = os.path.join(args.profile_dir, WorkQueue(args.queue).worker) if args.worker else args.profile_dir
+        getRunMetrics().profiler = StageProfiler(args.profile.split(","), profileDir, args.profiler, every=args.profile_every, memory=args.profile_memory)
+    if args.worker or not args.load:
+        with importTimer("ibm_cloud_sdk_core"):
+            from ibm_cloud_sdk_core import ApiException
+    if args.worker:
+        APIKEYS = os.environ.get('APIKEYS', None)
+        if APIKEYS == None:
+            logging.error("Workers require the same APIKEYS environment variable as the coordinator.")
+            quit(1)
+        unitAccount = None
+        checkpoint = None
+        queue = WorkQueue(args.queue)
+        runWorker(queue, json.loads(APIKEYS))
+        writeMetrics(queue.worker)
+        quit()
+    variableRules = readTrueUpConf(args.trueup)
 
     if args.month != None:
         start = datetime.strptime(args.month, "%Y-%m")
@@ -1641,10 +1891,14 @@ if __name__ == "__main__":
         logging.error("This usage report can only be used with previous months.  Current month results are not complete until after the 2nd of the following month.")
         quit(1)
 
+    """ Aggregate of account usage by account, month, resource, plan and metric, updated as each account's month is merged """
+    usageAggregate = UsageAggregate()
     if args.load:
         logging.info("Retrieving Usage and Instance data from stored data file")
-        accountUsage = pd.read_pickle("accountUsage.pkl")
-        instancesUsage = pd.read_pickle("instanceUsage.pkl")
+        """ Files saved before typed collection are converted to the typed schema """
+        accountUsage = applySchema(pd.read_pickle("accountUsage.pkl"), ACCOUNT_USAGE_SCHEMA)
+        instancesUsage = applySchema(pd.read_pickle("instanceUsage.pkl"), INSTANCE_USAGE_SCHEMA)
+        usageAggregate.update(accountUsage)
     else:
         APIKEYS = os.environ.get('APIKEYS', None)
         if APIKEYS == None:
@@ -1657,44 +1911,50 @@ if __name__ == "__main__":
             """
             try:
                 apikeys = json.loads(APIKEYS)
-            except ValueError as e:
+            except ValueError:
                 logging.error("Invalid List of APIKEYS.  The list should be in the format " \
                     "containing an apikey and name for each account.  example [{'apikey': key, 'name': account_name}]")
                 quit(1)
 
             """
-            Establish Dataframes for data, and iterate through accounts.
+            Pull Account Usage from Start to End Months at Account Summary and Instance Detail level for each account,
+            committing progress to the checkpoint (use --resume to continue a failed run)
             """
-            instancesUsage = pd.DataFrame()
-            accountUsage = pd.DataFrame()
-            for account in apikeys:
-                apikey = account["apikey"]
-                createSDK(apikey)
-                accountId = getAccountId(apikey)
-                accountName = account["name"]
-                logging.info("Retrieving Usage and Instance data from {} AccountId: {}.".format(accountName, accountId))
-                """
-                Pre-populate Account Data to accelerate report generation
-                """
-                tag_cache = prePopulateTagCache()
-                resource_cache = prePopulateResourceCache()
-
-                """
-                Pull Account Usage from Start to End Months at Account Summary and Instance Detail level
-                """
-                accountUsage = pd.concat([accountUsage, getAccountUsage(start, end)])
-                instancesUsage = pd.concat([instancesUsage, getInstancesUsage(start, end)])
+            unitAccount = None
+            if args.shard:
+                accountUsage, instancesUsage = runShards(apikeys, start, end)
+            else:
+                accountUsage, instancesUsage = runCheckpointed(apikeys, start, end)
 
-                """
-                Save Datatables for report generation testing (use --LOAD to reload without API pull)
-                """
+            """
+            Save Datatables for report generation testing (use --LOAD to reload without API pull)
+            """
             if args.save:
                 accountUsage.to_pickle("accountUsage.pkl")
                 instancesUsage.to_pickle("instanceUsage.pkl")
 
     """
-    Generate Excel Report based on data pulled
+    Generate Excel Report based on data pulled, from the column types the tabs were written for
     """
+    """ Price lists are normalized into a table of price tiers, usage rows keep the price_id of their price list """
+    (accountUsage, instancesUsage), priceTiers = normalizePrices([accountUsage, instancesUsage])
+    accountUsage = reportFrame(accountUsage, priceSchema(ACCOUNT_USAGE_SCHEMA))
+    instancesUsage = reportFrame(calculateServerDays(instancesUsage), priceSchema(INSTANCE_USAGE_SCHEMA) | SERVER_DAYS_SCHEMA)
+    priceTiers = reportFrame(priceTiers, PRICE_TIER_SCHEMA)
+    aggregateUsage = reportFrame(usageAggregate.frame(), AGGREGATE_SCHEMA)
+
+    if args.simulate:
+        """ Compare contract charges of the last month for each variant instead of creating the report """
+        comparison = simulateVariants(instancesUsage, aggregateUsage, end, readVariants(args.simulate))
+        logging.info("What-if comparison for {}:\n{}".format(datetime.strftime(end, "%Y-%m"), comparison.to_string(index=False)))
+        writer = pd.ExcelWriter(args.simulate_output, engine='xlsxwriter')
+        workbook = writer.book
+        createWhatIfTab(comparison, end)
+        with stage("write excel"):
+            writer.close()
+        writeMetrics()
+        logging.info("What-if simulation is complete.")
+        quit()
     # set variables to track billing for RECONCILE tab
     commonBilling = 0
     aceBilling = 0
@@ -1711,20 +1971,38 @@ if __name__ == "__main__":
     workbook = writer.book
     createServiceDetail(accountUsage)
     createInstancesDetailTab(instancesUsage)
-    createUsageSummaryTab(accountUsage)
-    createMetricSummary(accountUsage)
-    createTrueUp(accountUsage, end)
+    createPriceTiersTab(priceTiers)
+    createUsageSummaryTab(aggregateUsage)
+    createMetricSummary(aggregateUsage)
+    months = reportMonths(start, end)
+    """ Usage of this run replaces the months of the usage history it collected again """
+    usageHistory = UsageAggregate()
+    if args.anomaly_history:
+        history = loadUsageHistory(args.anomaly_history)
+        if history is not None:
+            usageHistory.update(history)
+    usageHistory.update(usageAggregate.frame())
+    if args.anomaly_history:
+        saveUsageHistory(args.anomaly_history, usageHistory.frame())
+    createAnomaliesTab(usageHistory.frame(), months, args.anomaly_window, args.anomaly_threshold)
+    createTrueUp(aggregateUsage, months)
     createVcpuTab(instancesUsage, end)
     createBMvcpuTab(instancesUsage, end)
     createProvisionAllTab(instancesUsage, end)
     createProvisionWorkersTab(instancesUsage, end)
     createProvisionScaleTab(instancesUsage, end)
-    createApplicationChargesTabs(instancesUsage, end)
-    createReconciliation(accountUsage, end)
-    writer.close()
+    createServerDaysTab(instancesUsage, end)
+    """ Contract charges are calculated once for each month, for the tear sheets of the last month and the reconciliation of every month """
+    contractCharges = {month: calculateContractCharges(instancesUsage, datetime.strptime(month, "%Y-%m")) for month in months}
+    createApplicationChargesTabs(contractCharges[months[-1]], end)
+    createReconciliation(aggregateUsage, months, contractCharges)
+    with stage("write excel"):
+        writer.close()
     """ If --COS then copy files with report end month + timestamp to COS """
     if args.cos:
         """ Write output to COS"""
         logging.info("Writing Pivot Tables to COS.")
-        writeFiletoCos(file_name + ".xlsx", file_name + "_" + datetime.strftime(end, "%Y-%m") + timestamp + ".xlsx")
+        with stage("upload"):
+            writeFiletoCos(file_name + ".xlsx", file_name + "_" + datetime.strftime(end, "%Y-%m") + timestamp + ".xlsx", args.COS_APIKEY, args.COS_INSTANCE_CRN, args.COS_ENDPOINT, args.COS_BUCKET)
+    writeMetrics()
     logging.info("Billing Report is complete.")
@@ -15,15 +15,12 @@
 
 
 __author__ = 'jonhall'
-import os, logging, logging.config, os.path, argparse, pytz
+import os, sys, json, logging, logging.config, os.path, argparse, pytz
 from datetime import datetime, tzinfo, timezone
-import pandas as pd
-import numpy as np
-from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalTaggingV1, GlobalSearchV2
-from ibm_cloud_sdk_core import ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_platform_services.resource_controller_v2 import *
 from dotenv import load_dotenv
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.startup import importTimer, logImportTimes
+from accountusage.tokens import getTokenManager
 
 def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
     # read logging.json for log parameters to be ued by script
@@ -43,15 +40,19 @@ def getAccountId(IC_API_KEY):
     ## Get AccountId for this API Key
     ##########################################################
 
-    try:
+    def lookupAccountId():
         api_key = iam_identity_service.get_api_keys_details(
           iam_api_key=IC_API_KEY
         ).get_result()
+        return api_key["account_id"]
+
+    try:
+        accountId = getTokenManager().getAccountId(IC_API_KEY, lookupAccountId)
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
 
-    return api_key["account_id"]
+    return accountId
 
 def attachTag(resource_crn, tag):
     """
@@ -81,7 +82,7 @@ def createSDK(IC_API_KEY):
     global resource_controller_service, global_tagging_service, iam_identity_service, global_search_service, usage_reports_service
 
     try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
+        authenticator = getTokenManager().getAuthenticator(IC_API_KEY)
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
@@ -125,8 +126,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tag CRN's in an account with audit tag.")
     parser.add_argument("--input", default=os.environ.get('input', 'tags.xlsx'), help="Filename Excel input file for list of resources and tags. (including extension of .xlsx)")
     parser.add_argument("--debug", action=argparse.BooleanOptionalAction, help="Set Debug level for logging.")
+    parser.add_argument("--importtime", action=argparse.BooleanOptionalAction, help="Log time taken by imports at startup.")
     args = parser.parse_args()
 
+    with importTimer("pandas"):
+        import pandas as pd
+    with importTimer("ibm_platform_services"):
+        from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalTaggingV1, GlobalSearchV2
+        from ibm_platform_services.resource_controller_v2 import ResourceControllerV2
+        from ibm_cloud_sdk_core import ApiException
+    if args.importtime:
+        logImportTimes()
+
     if args.debug:
         log = logging.getLogger()
         log.handlers[0].setLevel(logging.DEBUG)
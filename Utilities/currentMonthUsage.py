@@ -15,183 +15,25 @@
 
 
 __author__ = 'jonhall'
-import os, logging, logging.config, os.path, argparse, pytz
+import os, sys, json, logging, logging.config, os.path, argparse
 from datetime import datetime, tzinfo, timezone
-import pandas as pd
-import numpy as np
-import ibm_boto3
-from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalSearchV2
-from ibm_cloud_sdk_core import ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_platform_services.resource_controller_v2 import *
-from ibm_botocore.client import Config, ClientError
-from ibm_vpc import VpcV1
 from dotenv import load_dotenv
-from urllib import parse
-
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
-def getAccountId(IC_API_KEY):
-    ##########################################################
-    ## Get AccountId for this API Key
-    ##########################################################
-
-    try:
-        api_key = iam_identity_service.get_api_keys_details(
-          iam_api_key=IC_API_KEY
-        ).get_result()
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    return api_key["account_id"]
-def populateTagCache():
-    ##########################################################
-    ## Populate Tagging data into cache
-    ##########################################################
-
-    search_cursor = None
-    items = []
-    while True:
-        response = global_search_service.search(query='tags:*',
-                                                search_cursor=search_cursor,
-                                                fields=["tags"],
-                                                limit=1000)
-
-
-        scan_result = response.get_result()
-
-        items = items + scan_result["items"]
-        if "search_cursor" not in scan_result:
-            break
-        else:
-            search_cursor = scan_result["search_cursor"]
-
-    tag_cache = {}
-    for resource in items:
-        resourceId = resource["crn"]
-        tag_cache[resourceId] = resource["tags"]
-
-    return tag_cache
-def populateInstanceCache():
-    """
-    Get VPC instance information and create cache from each VPC regional endpoint
-    """
-    endpoints = [vpc_service_us_south, vpc_service_us_east, vpc_service_ca_tor]
-    items = []
-
-    for endpoint in endpoints:
-        """ Get virtual servers """
-        instances = endpoint.list_instances()
-        while True:
-            try:
-                result = instances.get_result()
-            except ApiException as e:
-                logging.error("List VPC virtual server instances with status code{}:{}".format(str(e.code), e.message))
-                quit(1)
-
-            items = items + result["instances"]
-            if "next" not in result:
-                break
-            else:
-                next = dict(parse.parse_qsl(parse.urlsplit(result["next"]["href"]).query))
-                instances = endpoint.list_instances(start=next["start"])
-
-        """ Get Bare Metal"""
-        instances = endpoint.list_bare_metal_servers()
-        while True:
-            try:
-                result = instances.get_result()
-            except ApiException as e:
-                logging.error("List BM server instances with status code{}:{}".format(str(e.code), e.message))
-                quit(1)
-
-            items = items + result["bare_metal_servers"]
-            if "next" not in result:
-                break
-            else:
-                next = dict(parse.parse_qsl(parse.urlsplit(result["next"]["href"]).query))
-                instances = endpoint.list_bare_metal_servers(start=next["start"])
-
-
-    instance_cache = {}
-    for resource in items:
-        crn = resource["crn"]
-        instance_cache[crn] = resource
-
-    return instance_cache
-def createSDK(IC_API_KEY):
-    """
-    Create SDK clients
-    """
-    global resource_controller_service, iam_identity_service, global_search_service, usage_reports_service, vpc_service_us_south, vpc_service_us_east, vpc_service_ca_tor
-
-    try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        iam_identity_service = IamIdentityV1(authenticator=authenticator)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        usage_reports_service = UsageReportsV4(authenticator=authenticator)
-        usage_reports_service.enable_retries(max_retries=5, retry_interval=1.0)
-        usage_reports_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        resource_controller_service = ResourceControllerV2(authenticator=authenticator)
-        resource_controller_service.enable_retries(max_retries=5, retry_interval=1.0)
-        resource_controller_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        global_search_service = GlobalSearchV2(authenticator=authenticator)
-        global_search_service.enable_retries(max_retries=5, retry_interval=1.0)
-        global_search_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        vpc_service_us_south = VpcV1(authenticator=authenticator)
-        vpc_service_us_south.set_service_url('https://us-south.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        vpc_service_us_east = VpcV1(authenticator=authenticator)
-        vpc_service_us_east.set_service_url('https://us-east.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        vpc_service_ca_tor = VpcV1(authenticator=authenticator)
-        vpc_service_ca_tor.set_service_url('https://ca-tor.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.startup import importTimer, logImportTimes
+from accountusage.logs import setup_logging
+from accountusage.clients import ClientFactory
+from accountusage.cache import populateTagCache, updateTagCache, populateVPCInstanceCache, updateVPCInstanceCache, listAllResourceInstances
+from accountusage.tags import removeTags
+from accountusage.cos import writeFiletoCos
+from accountusage.metrics import getRunMetrics, stage, timedStage
+from accountusage.predicates import column, select
+
+""" Resource controller services of the VPC servers reported """
+VPC_SERVICES = ["is.instance", "is.bare-metal-server"]
+
+""" Filters of servers, compiled once and shared by the tabs and service views """
+SYMPHONY_WORKERS = (column("service_id") == "is.instance") & column("instance_role").contains("symphony-worker")
+SCALE_STORAGE = (column("service_id") == "is.bare-metal-server") & column("instance_role").contains("scale-storage")
 
 def getCurrentMonthAccountUsage():
     """
@@ -202,7 +44,7 @@ def getCurrentMonthAccountUsage():
     usageMonth = datetime.now().strftime("%Y-%m")
 
     try:
-        usage = usage_reports_service.get_account_usage(
+        usage = clients.usage_reports.get_account_usage(
             account_id=accountId,
             billingmonth=usageMonth,
             names=True
@@ -263,254 +105,79 @@ def getCurrentMonthAccountUsage():
                     'rateable_quantity','cost', 'rated_cost', 'discount', 'price'])
 
     return accountUsage
-def listAllResourceInstances(resource_type):
-    """
-    Retrieve all Resources for account from resource controller fore resource_type
-    """
-    all_results = []
-    pager = ResourceInstancesPager(
-        client=resource_controller_service,
-        resource_id=resource_type,
-        limit=20
-    )
-
-    try:
-        while pager.has_next():
-            next_page = pager.get_next()
-            assert next_page is not None
-            all_results.extend(next_page)
-        logging.debug("resource_instance={}".format(all_results))
-    except ApiException as e:
-            logging.error(
-                "API Error.  Can not retrieve instances of type {} {}: {}".format(resource_type, str(e.code),
-                                                                                         e.message))
-            quit(1)
-    return all_results
-def getTags(resourceId):
+@timedStage
+def parseResources(accountName, resources):
     """
-    Check Tag_Cache for Resource tags which may have been retrieved previously
+    Parse Resource JSON into server detail
     """
-    global tag_cache
-    if resourceId not in tag_cache:
-        logging.debug("Cache miss for Tag {}".format(resourceId))
-        tag = []
-    else:
-        tag = tag_cache[resourceId]
-    return tag
-def getInstance(instance):
-    """
-    Check Tag_Cache for Resource tags which may have been retrieved previously
-    """
-    global instance_cache
-    if instance not in instance_cache:
-        logging.warning("Cache miss for VPC instance {}".format(instance))
-        instance_data = []
-    else:
-        instance_data = instance_cache[instance]
-    return instance_data
-
-def parseResources(accoutName, resources):
+    resourceDetail = normalizeResources(accountName, resources, tag_cache, instance_cache)
+    """ Report zero where resource has no vCPU, memory, GPU, core or socket count """
+    for name in ["numberOfVirtualCPUs", "MemorySizeMiB", "NumberOfGPUs", "BMnumberofCores", "BMnumberofSockets"]:
+        resourceDetail[name] = resourceDetail[name].mask(resourceDetail[name] == "", 0)
+
+    return resourceDetail[['account_id', "account_name", "service_id", "instance_id", "name", "resource_group_id", "region_id",
+                           "provision_date", "deprovision_date", "instance_created_at", "instance_updated_at", "instance_deleted_at",
+                           "instance_state", "lifecycleAction",  "instance_profile", "cpu_family", "boot_volume_attachment",
+                           "region", "vpc", "availability_zone", "primary_network_interface_subnet", "primary_network_interface_primary_ip",
+                           "numberOfVirtualCPUs", "MemorySizeMiB", "numa_count", "total_network_bandwidth", "total_volume_bandwidth", "NodeName", "NumberOfGPUs",
+                           "NumberOfInstStorageDisks", "BMnumberofCores", "BMnumberofSockets", "BMbandwidth", "BMDisks", "BMRawStorage", "capacity", "iops",
+                           "OSName", "OSVendor", "OSVersion", "instance_role", "audit"]]
+
+def collectAccount(account, state=None):
     """
-    Parse Resource JSON
+    Collect month to date usage and VPC servers of an account
+    :param account: dictionary with apikey and name of account
+    :param state: account state of previous collection to refresh incrementally, None to collect all servers
+    :return: account usage, resources, account state (clients, tag and VPC instance caches and servers by CRN)
     """
-
-    data = []
-    nytz = pytz.timezone('America/New_York')
-    for resource_instance in resources:
-        row = {
-            "account_id": resource_instance["account_id"],
-            "account_name": accountName,
-            "service_id": resource_instance["resource_id"],
-            "instance_id": resource_instance["id"],
-            "resource_group_id": resource_instance["resource_group_id"],
-            "region_id": resource_instance["region_id"],
-            "name": resource_instance["name"]
-        }
-
-        if "created_at" in resource_instance:
-            created_at = resource_instance["created_at"]
-            """Create Provision Date Field using US East Timezone for Zulu conversion"""
-            provisionDate = pd.to_datetime(created_at, format="%Y-%m-%dT%H:%M:%S.%f").astimezone(nytz)
-            provisionDate = provisionDate.strftime("%Y-%m-%d")
-        else:
-            created_at = ""
-            provisionDate = ""
-
-        if "updated_at" in resource_instance:
-            updated_at = resource_instance["updated_at"]
-        else:
-            updated_at = ""
-
-        if "deleted_at" in resource_instance:
-            deleted_at = resource_instance["deleted_at"]
-            """Create deProvision Date Field using US East Timezone for Zulu conversion"""
-            if deleted_at != None:
-                deprovisionDate = pd.to_datetime(deleted_at, format="%Y-%m-%dT%H:%M:%S.%f").astimezone(nytz)
-                deprovisionDate = deprovisionDate.strftime("%Y-%m-%d")
+    global clients, accountId, accountName, tag_cache, instance_cache
+    if state is None or state["updated"] is None:
+        state = {"clients": state["clients"] if state is not None else ClientFactory(account["apikey"]),
+                 "updated": None, "tag_cache": None, "instance_cache": None, "servers": {}}
+    clients = state["clients"]
+    accountId = clients.getAccountId()
+    accountName = account["name"]
+    updated = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    if state["updated"] is None:
+        """ Tags of all resources are searched at a full collection, refreshes only search the CRNs of changed servers """
+        logging.info("Caching Tag Data for {} AccountId: {}.".format(accountName, accountId))
+        with stage("tag cache", accountName):
+            state["tag_cache"] = populateTagCache(clients)
+        logging.info("Caching VPC Instance Data for {} AccountId: {}.".format(accountName, accountId))
+        with stage("instance cache", accountName):
+            state["instance_cache"] = populateVPCInstanceCache(clients)
+    tag_cache = state["tag_cache"]
+    instance_cache = state["instance_cache"]
+    logging.info("Retrieving Month to Date Account Usage for {}: {}.".format(accountName, accountId))
+    with stage("account usage", accountName):
+        accountUsage = getCurrentMonthAccountUsage()
+
+    with stage("resources", accountName):
+        resources = pd.DataFrame()
+        for service in VPC_SERVICES:
+            if state["updated"] is None:
+                logging.info("Retrieving current list of {} from {} AccountId: {}.".format(service, accountName, accountId))
+                for resource in listAllResourceInstances(clients, service):
+                    state["servers"][resource["crn"]] = resource
             else:
-                deprovisionDate = ""
-        else:
-            deleted_at = ""
-            deprovisionDate = ""
-
-        if "state" in resource_instance:
-            state = resource_instance["state"]
-        else:
-            state = ""
-
-        az = ""
-        region = ""
-        profile = ""
-        cpuFamily = ""
-        numberOfVirtualCPUs = 0
-        MemorySizeMiB = 0
-        NodeName = ""
-        NumberOfGPUs = 0
-        NumberOfInstStorageDisks = ""
-        NumberofCores = 0
-        NumberofSockets = 0
-        Bandwidth = ""
-        OSName = ""
-        OSVendor = ""
-        OSVersion =""
-        LifecycleAction = ""
-        Capacity = ""
-        IOPS = ""
-
-        if "extensions" in resource_instance:
-            if "VirtualMachineProperties" in resource_instance["extensions"]:
-                profile = resource_instance["extensions"]["VirtualMachineProperties"]["Profile"]
-                cpuFamily = resource_instance["extensions"]["VirtualMachineProperties"]["CPUFamily"]
-                numberOfVirtualCPUs = resource_instance["extensions"]["VirtualMachineProperties"]["NumberOfVirtualCPUs"]
-                MemorySizeMiB = resource_instance["extensions"]["VirtualMachineProperties"]["MemorySizeMiB"]
-                NodeName = resource_instance["extensions"]["VirtualMachineProperties"]["NodeName"]
-                NumberOfGPUs = resource_instance["extensions"]["VirtualMachineProperties"]["NumberOfGPUs"]
-                NumberOfInstStorageDisks = resource_instance["extensions"]["VirtualMachineProperties"][
-                    "NumberOfInstStorageDisks"]
-                OSName = resource_instance["extensions"]["VirtualMachineProperties"]["OSName"]
-                OSVendor = resource_instance["extensions"]["VirtualMachineProperties"]["OSVendor"]
-                OSVersion = resource_instance["extensions"]["VirtualMachineProperties"]["OSVersion"]
-
-            elif "BMServerProperties" in resource_instance["extensions"]:
-                profile = resource_instance["extensions"]["BMServerProperties"]["Profile"]
-                MemorySizeMiB = resource_instance["extensions"]["BMServerProperties"]["MemorySizeMiB"]
-                NodeName = resource_instance["extensions"]["BMServerProperties"]["NodeName"]
-                NumberofCores = resource_instance["extensions"]["BMServerProperties"]["NumberOfCores"]
-                NumberofSockets = resource_instance["extensions"]["BMServerProperties"]["NumberOfSockets"]
-                Bandwidth = resource_instance["extensions"]["BMServerProperties"]["Bandwidth"]
-                OSName = resource_instance["extensions"]["BMServerProperties"]["OSName"]
-                OSVendor = resource_instance["extensions"]["BMServerProperties"]["OSVendor"]
-                OSVersion = resource_instance["extensions"]["BMServerProperties"]["OSVersion"]
-
-            elif "VolumeInfo" in resource_instance["extensions"]:
-                Capacity = resource_instance["extensions"]["VolumeInfo"]["Capacity"]
-                IOPS = resource_instance["extensions"]["VolumeInfo"]["IOPS"]
-
-            if "Resource" in resource_instance["extensions"]:
-                if "AvailabilityZone" in resource_instance["extensions"]["Resource"]:
-                    az = resource_instance["extensions"]["Resource"]["AvailabilityZone"]
-                if "Location" in resource_instance["extensions"]["Resource"]:
-                    region = resource_instance["extensions"]["Resource"]["Location"]["Region"]
-                if "LifecycleAction" in resource_instance["extensions"]["Resource"]:
-                    LifecycleAction = resource_instance["extensions"]["Resource"]["LifecycleAction"]
-
-        # Lookup instance related detaail from VPC cache
-        numa_count = ""
-        boot_volume_attachment = ""
-        primary_network_interface_primary_ip = ""
-        primary_network_interface_subnet = ""
-        vpc= ""
-        total_network_bandwidth = ""
-        total_volume_bandwidth = ""
-        if resource_instance["resource_id"] == "is.instance" or resource_instance["resource_id"] == "is.bare-metal-server":
-            """ Check VPC Cache """
-            instance = getInstance(resource_instance["id"])
-            if "numa_count" in instance:
-                numa_count = instance["numa_count"]
-            if "boot_volume_attachment" in instance:
-                boot_volume_attachment = instance["boot_volume_attachment"]["name"]
-            if "primary_network_interface" in instance:
-                primary_network_interface_primary_ip = instance["primary_network_interface"]["primary_ip"]["address"]
-                primary_network_interface_subnet = instance["primary_network_interface"]["subnet"]["name"]
-            if "total_network_bandwidth" in instance:
-                total_network_bandwidth = instance["total_network_bandwidth"]
-            if "total_volume_bandwidth" in instance:
-                total_volume_bandwidth = instance["total_volume_bandwidth"]
-            if "vpc" in instance:
-                vpc = instance["vpc"]["name"]
-
-        bm_disks = ""
-        BMRawStorage = ""
-        if resource_instance["resource_id"] == "is.bare-metal-server":
-            if "disks" in instance:
-                bm_disks = len(instance["disks"])
-                BMRawStorage = 0
-                for storage in instance["disks"]:
-                    if storage["interface_type"] == "nvme":
-                        BMRawStorage = BMRawStorage + float(storage["size"])
-
-        # get tags attached to instance from cache or resource controller
-        tags = getTags(resource_instance["id"])
-        # parse role tag into comma delimited list
-        if len(tags) > 0:
-            role = ",".join([str(item.split(":")[1]) for item in tags if "role:" in item])
-            audit = ",".join([str(item.split(":")[1]) for item in tags if "audit:" in item])
-        else:
-            role = ""
-            audit = ""
-
-        row_addition = {
-            "provision_date": provisionDate,
-            "deprovision_date": deprovisionDate,
-            "instance_created_at": created_at,
-            "instance_updated_at": updated_at,
-            "instance_deleted_at": deleted_at,
-            "instance_state": state,
-            "instance_profile": profile,
-            "cpu_family": cpuFamily,
-            "boot_volume_attachment": boot_volume_attachment,
-            "region": region,
-            "vpc": vpc,
-            "availability_zone": az,
-            "primary_network_interface_subnet": primary_network_interface_subnet,
-            "primary_network_interface_primary_ip": primary_network_interface_primary_ip,
-            "numberOfVirtualCPUs": numberOfVirtualCPUs,
-            "MemorySizeMiB": MemorySizeMiB,
-            "numa_count": numa_count,
-            "total_network_bandwidth": total_network_bandwidth ,
-            "total_volume_bandwidth": total_volume_bandwidth ,
-            "NodeName": NodeName,
-            "NumberOfGPUs": NumberOfGPUs,
-            "NumberOfInstStorageDisks": NumberOfInstStorageDisks,
-            "lifecycleAction": LifecycleAction,
-            "BMnumberofCores": NumberofCores,
-            "BMnumberofSockets": NumberofSockets,
-            "BMbandwidth": Bandwidth,
-            "BMDisks": bm_disks,
-            "BMRawStorage": BMRawStorage,
-            "OSName": OSName,
-            "OSVendor": OSVendor,
-            "OSVersion": OSVersion,
-            "capacity": Capacity,
-            "iops": IOPS,
-            "instance_role": role,
-            "audit": audit,
-        }
-
-        # combine original row with additions
-
-        row = row | row_addition
-        data.append(row.copy())
-
-    resourceDetail = pd.DataFrame(data, columns=['account_id', "account_name", "service_id", "instance_id", "name", "resource_group_id", "region_id",
-                                                 "provision_date", "deprovision_date", "instance_created_at", "instance_updated_at", "instance_deleted_at",
-                                                 "instance_state", "lifecycleAction",  "instance_profile", "cpu_family", "boot_volume_attachment",
-                                                 "region", "vpc", "availability_zone", "primary_network_interface_subnet", "primary_network_interface_primary_ip",
-                                                 "numberOfVirtualCPUs", "MemorySizeMiB", "numa_count", "total_network_bandwidth", "total_volume_bandwidth", "NodeName", "NumberOfGPUs",
-                                                 "NumberOfInstStorageDisks", "BMnumberofCores", "BMnumberofSockets", "BMbandwidth", "BMDisks", "BMRawStorage", "capacity", "iops",
-                                                 "OSName", "OSVendor", "OSVersion", "instance_role", "audit"])
-    return resourceDetail
-
+                """ Only servers changed since the previous collection are retrieved and merged by CRN """
+                logging.info("Retrieving {} updated since {} from {} AccountId: {}.".format(service, state["updated"], accountName, accountId))
+                changed = listAllResourceInstances(clients, service, updated_from=state["updated"])
+                for resource in changed:
+                    state["servers"][resource["crn"]] = resource
+                for resource in listAllResourceInstances(clients, service, updated_from=state["updated"], state="removed"):
+                    state["servers"].pop(resource["crn"], None)
+                    instance_cache.pop(resource["crn"], None)
+                    removeTags(tag_cache, resource["crn"])
+                updateVPCInstanceCache(clients, instance_cache, changed)
+                with stage("tag cache", accountName):
+                    updateTagCache(clients, tag_cache, [resource["crn"] for resource in changed])
+            resources = pd.concat([resources, parseResources(accountName, [resource for resource in state["servers"].values() if resource["resource_id"] == service])])
+    state["updated"] = updated
+    return accountUsage, resources, state
+
+@timedStage
 def createServerListTab(paasUsage):
     """
     Write Service Usage detail tab to excel
@@ -523,14 +190,11 @@ def createServerListTab(paasUsage):
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
 
-def createWorkerVcpuTab(instancesUsage):
+def calculateWorkerVcpu(instancesUsage):
     """
-    Create VCPU deployed by role, account, and az
+    Calculate VCPU deployed by role, account, and az
     """
-
-    logging.info("Calculating Virtual Server vCPU deployed.")
-
-    servers = instancesUsage.query('service_id == "is.instance"  and instance_role.str.contains("symphony-worker")')
+    servers = select(instancesUsage, SYMPHONY_WORKERS)
     vcpu = pd.pivot_table(servers, index=["account_name",  "region", "availability_zone", "instance_role"],
                                     values=["instance_id", "numberOfVirtualCPUs"],
                                     aggfunc={"instance_id": "nunique", "numberOfVirtualCPUs": np.sum},
@@ -538,7 +202,15 @@ def createWorkerVcpuTab(instancesUsage):
                                     fill_value=0).rename(columns={'instance_id': 'instance_count'})
 
     new_order = ["instance_count", "numberOfVirtualCPUs"]
-    vcpu = vcpu.reindex(new_order, axis=1)
+    return vcpu.reindex(new_order, axis=1)
+@timedStage
+def createWorkerVcpuTab(instancesUsage):
+    """
+    Create VCPU deployed by role, account, and az
+    """
+
+    logging.info("Calculating Virtual Server vCPU deployed.")
+    vcpu = calculateWorkerVcpu(instancesUsage)
     vcpu.to_excel(writer, 'SymphonyWorkerVCPU')
     worksheet = writer.sheets['SymphonyWorkerVCPU']
     format2 = workbook.add_format({'align': 'left'})
@@ -546,13 +218,11 @@ def createWorkerVcpuTab(instancesUsage):
     worksheet.set_column("A:D", 30, format2)
     worksheet.set_column("E:F", 18, format3)
     return
-def createScaleCpuTab(instancesUsage):
+def calculateScaleCpu(instancesUsage):
     """
-    Create BM VCPU deployed by role, account, and az
+    Calculate BM cores and sockets deployed by role, account, and az
     """
-
-    logging.info("Calculating Bare Metal vCPU deployed.")
-    servers = instancesUsage.query('service_id == "is.bare-metal-server" and instance_role.str.contains("scale-storage")')
+    servers = select(instancesUsage, SCALE_STORAGE)
     vcpu = pd.pivot_table(servers, index=["account_name", "region", "availability_zone", "instance_role"],
                                     values=["instance_id", "BMnumberofCores", "BMnumberofSockets"],
                                     aggfunc={"instance_id": "nunique", "BMnumberofCores": np.sum, "BMnumberofSockets": np.sum},
@@ -560,7 +230,15 @@ def createScaleCpuTab(instancesUsage):
                                     fill_value=0).rename(columns={'instance_id': 'instance_count', "BMnumberofCores": "Cores", "BMnumberofSockets": "Sockets"})
 
     new_order = ["instance_count", "Cores", "Sockets"]
-    vcpu = vcpu.reindex(new_order, axis=1)
+    return vcpu.reindex(new_order, axis=1)
+@timedStage
+def createScaleCpuTab(instancesUsage):
+    """
+    Create BM VCPU deployed by role, account, and az
+    """
+
+    logging.info("Calculating Bare Metal vCPU deployed.")
+    vcpu = calculateScaleCpu(instancesUsage)
     vcpu.to_excel(writer, 'ScaleBareMetalCores')
     worksheet = writer.sheets['ScaleBareMetalCores']
     format2 = workbook.add_format({'align': 'left'})
@@ -568,13 +246,14 @@ def createScaleCpuTab(instancesUsage):
     worksheet.set_column("A:D", 30, format2)
     worksheet.set_column("E:G", 18, format3)
     return
+@timedStage
 def createProvisionAllTab(instancesUsage):
     """
     Create Pivot by Original Provision Date
     """
 
     logging.info("Calculating vCPU by provision date.")
-    servers = instancesUsage.query('(service_id == "is.instance") or (service_id == "is.bare-metal-server")')
+    servers = select(instancesUsage, column("service_id").isin(VPC_SERVICES))
 
     vcpu = pd.pivot_table(servers, index=["audit","account_name", "region", "availability_zone", "instance_role", "instance_profile", "provision_date", "deprovision_date"],
                                     values=["instance_id", "numberOfVirtualCPUs"],
@@ -591,14 +270,14 @@ def createProvisionAllTab(instancesUsage):
     worksheet.set_column("A:G", 30, format2)
     worksheet.set_column("H:J", 18, format3)
     return
+@timedStage
 def createProvisionScaleTab(instancesUsage):
     """
     Create Pivot by Of Scale Servers by Date
     """
 
     logging.info("Calculating vCPU by provision date scale storage nodes only.")
-    servers = instancesUsage.query(
-        'service_id == "is.bare-metal-server" and instance_role.str.contains("scale-storage")')
+    servers = select(instancesUsage, SCALE_STORAGE)
 
     vcpu = pd.pivot_table(servers, index=["account_name", "region", "availability_zone", "instance_role", "instance_profile", "provision_date", "deprovision_date"],
                                     values=["instance_id", "BMnumberofCores", "BMnumberofSockets"],
@@ -616,13 +295,14 @@ def createProvisionScaleTab(instancesUsage):
     worksheet.set_column("A:F", 30, format2)
     worksheet.set_column("G:I", 18, format3)
     return
+@timedStage
 def createProvisionWorkersTab(instancesUsage):
     """
     Create Pivot by Original Provision Date
     """
 
     logging.info("Calculating vCPU by provision date symphony-workers only.")
-    servers = instancesUsage.query('service_id == "is.instance" and instance_role.str.contains("symphony-worker")')
+    servers = select(instancesUsage, SYMPHONY_WORKERS)
 
     vcpu = pd.pivot_table(servers, index=["account_name", "region", "availability_zone", "instance_role", "instance_profile", "provision_date", "deprovision_date"],
                                     values=["instance_id", "numberOfVirtualCPUs"],
@@ -639,12 +319,18 @@ def createProvisionWorkersTab(instancesUsage):
     worksheet.set_column("A:F", 30, format2)
     worksheet.set_column("G:I", 18, format3)
     return
-def createUsageSummaryTab(paasUsage):
-    logging.info("Creating Usage Summary tab.")
-    usageSummary = pd.pivot_table(paasUsage, index=["account_name", "resource_name"],
+def calculateUsageSummary(paasUsage):
+    """
+    Calculate month to date cost by account and service
+    """
+    return pd.pivot_table(paasUsage, index=["account_name", "resource_name"],
                                     values=["cost"],
                                     aggfunc=np.sum, margins=True, margins_name="Total",
                                     fill_value=0)
+@timedStage
+def createUsageSummaryTab(paasUsage):
+    logging.info("Creating Usage Summary tab.")
+    usageSummary = calculateUsageSummary(paasUsage)
 
     usageSummary.to_excel(writer, 'UsageSummary', startcol=0, startrow=2)
     worksheet = writer.sheets['UsageSummary']
@@ -655,6 +341,94 @@ def createUsageSummaryTab(paasUsage):
     worksheet.set_column("A:A", 60, format2)
     worksheet.set_column("B:B", 35, format2)
     worksheet.set_column("C:J", 18, format1)
+@timedStage
+def createBurnRateTab(burnRate):
+    """
+    Write burn rate and projected month end cost tab to excel
+    """
+    logging.info("Creating Burn Rate Projection tab.")
+    total = pd.DataFrame([burnRate.sum()], index=pd.MultiIndex.from_tuples([("Total", "")], names=burnRate.index.names))
+    burnRate = pd.concat([burnRate, total])
+    burnRate.to_excel(writer, 'BurnRateProjection', startcol=0, startrow=2)
+    worksheet = writer.sheets['BurnRateProjection']
+    boldtext = workbook.add_format({'bold': True, 'bg_color': '#FFFF00'})
+    worksheet.write(0, 0, "WARNING: Month end cost projected from usage snapshots up to {}".format(datetime.now().strftime("%Y-%m-%d @ %H:%M")), boldtext)
+    format1 = workbook.add_format({'num_format': '$#,##0.00'})
+    format2 = workbook.add_format({'align': 'left'})
+    worksheet.set_column("A:A", 60, format2)
+    worksheet.set_column("B:B", 35, format2)
+    worksheet.set_column("C:E", 18, format1)
+    return
+def loadUsageHistory(filename, month):
+    """
+    Load monthly cost of each account and service from account usage saved by citiUsage.py --save
+    :param filename: pkl file of account usage
+    :param month: current month (YYYY-MM), only months before it are history
+    :return: dataframe of account_name, resource_name, month and cost
+    """
+    try:
+        usage = pd.read_pickle(filename)
+    except FileNotFoundError:
+        logging.error("Usage history {} not found.".format(filename))
+        quit(1)
+    usage = usage[FORECAST_KEYS + ["month", "cost"]].astype({"account_name": object, "resource_name": object, "month": str, "cost": float})
+    usage = usage[usage["month"] < month]
+    return usage.groupby(FORECAST_KEYS + ["month"], sort=False, dropna=False, as_index=False)["cost"].sum()
+
+def getForecastHistory(history, store, month):
+    """
+    Monthly cost of the months before month, from the usage history and the months of the usage snapshots
+    :param history: monthly cost from loadUsageHistory, None without --history
+    :param store: usage snapshot store, None without --snapshot
+    :param month: current month (YYYY-MM)
+    :return: dataframe of account_name, resource_name, month and cost
+    """
+    frames = [] if history is None else [history]
+    if store is not None:
+        """ Snapshots of a month end before it does, the usage history is used for months it has """
+        snapshots = getMonthlyCost(store, month)
+        if history is not None:
+            snapshots = snapshots[~snapshots["month"].isin(history["month"])]
+        frames.append(snapshots)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=FORECAST_KEYS + ["month", "cost"])
+    return pd.concat(frames, ignore_index=True)
+
+def calculateForecast(accountUsage, history, burnRate):
+    """
+    Forecast month end and next quarter cost of each account and service
+    :param accountUsage: dataframe of month to date usage
+    :param history: monthly cost of the months before the current month from getForecastHistory
+    :param burnRate: projected month end cost from getBurnRate, None without --snapshot
+    :return: dataframe of forecasts from forecastUsage
+    """
+    month, elapsed = monthElapsed(datetime.now())
+    usage = pd.concat([history, accountUsage[FORECAST_KEYS + ["month", "cost"]]], ignore_index=True)
+    projected = burnRate.reset_index() if burnRate is not None else None
+    return forecastUsage(usage, month, elapsed, projected, window=args.forecast_window)
+@timedStage
+def createForecastTab(forecast):
+    """
+    Write month end and next quarter cost forecast tab to excel
+    """
+    logging.info("Creating Cost Forecast tab.")
+    total = forecast.select_dtypes("number").sum().to_frame().T.assign(account_name="Total", resource_name="", history_months=np.nan, model="")
+    forecast = pd.concat([forecast, total[forecast.columns]], ignore_index=True)
+    forecast.to_excel(writer, 'CostForecast', startcol=0, startrow=2, index=False)
+    worksheet = writer.sheets['CostForecast']
+    boldtext = workbook.add_format({'bold': True, 'bg_color': '#FFFF00'})
+    worksheet.write(0, 0, "WARNING: Month end and next quarter cost forecast from usage up to {}".format(datetime.now().strftime("%Y-%m-%d @ %H:%M")), boldtext)
+    format1 = workbook.add_format({'num_format': '$#,##0.00'})
+    format2 = workbook.add_format({'align': 'left'})
+    format3 = workbook.add_format({'num_format': '#,##0'})
+    worksheet.set_column("A:A", 60, format2)
+    worksheet.set_column("B:B", 35, format2)
+    worksheet.set_column("C:C", 18, format3)
+    worksheet.set_column("D:G", 18, format1)
+    worksheet.set_column("H:H", 25, format2)
+    worksheet.set_column("I:N", 18, format1)
+    return
+@timedStage
 def createMetricSummary(paasUsage):
     logging.info("Creating Metric Plan Summary tab.")
     metricSummaryPlan = pd.pivot_table(paasUsage, index=["account_name", "resource_name", "plan_name", "metric"],
@@ -677,50 +451,14 @@ def createMetricSummary(paasUsage):
     worksheet.set_column("E:E", 30, format3)
     worksheet.set_column("F:ZZ", 15, format1)
     return
-def writeFiletoCos(localfile, upload):
-    """"
-    Write Files to COS
-    """
-
-    def multi_part_upload(bucket_name, item_name, file_path):
-        """"
-        Write Files to COS
-        """
-        try:
-            logging.info("Starting file transfer for {0} to bucket: {1}".format(item_name, bucket_name))
-            # set 5 MB chunks
-            part_size = 1024 * 1024 * 5
-
-            # set threadhold to 15 MB
-            file_threshold = 1024 * 1024 * 15
-
-            # set the transfer threshold and chunk size
-            transfer_config = ibm_boto3.s3.transfer.TransferConfig(
-                multipart_threshold=file_threshold,
-                multipart_chunksize=part_size
-            )
-
-            # the upload_fileobj method will automatically execute a multi-part upload
-            # in 5 MB chunks for all files over 15 MB
-            with open(file_path, "rb") as file_data:
-                cos.Object(bucket_name, item_name).upload_fileobj(
-                    Fileobj=file_data,
-                    Config=transfer_config
-                )
-            logging.info("Transfer for {0} complete".format(item_name))
-        except ClientError as be:
-            logging.error("CLIENT ERROR: {0}".format(be))
-        except Exception as e:
-            logging.error("Unable to complete multi-part upload: {0}".format(e))
-        return
-
-    cos = ibm_boto3.resource("s3",
-                             ibm_api_key_id=args.COS_APIKEY,
-                             ibm_service_instance_id=args.COS_INSTANCE_CRN,
-                             config=Config(signature_version="oauth"),
-                             endpoint_url=args.COS_ENDPOINT
-                             )
-    multi_part_upload(args.COS_BUCKET, upload, "./" + localfile)
+def writeMetrics():
+    """
+    Write run metrics to the --metrics and --prometheus files
+    """
+    if args.metrics:
+        getRunMetrics().writeJson(args.metrics)
+    if args.prometheus:
+        getRunMetrics().writePrometheus(args.prometheus)
     return
 
 if __name__ == "__main__":
@@ -741,15 +479,61 @@ if __name__ == "__main__":
     parser.add_argument("--COS_BUCKET", default=os.environ.get('COS_BUCKET', None),
                         help="COS Bucket name to use to write output to Object Storage.")
 
+    parser.add_argument("--snapshot", action=argparse.BooleanOptionalAction, help="Record usage snapshot and include burn rate projection tab.")
+    parser.add_argument("--snapshot_store", default=os.environ.get('snapshot_store', 'usageSnapshots.pkl'), help="Filename of usage snapshot store.")
+    parser.add_argument("--burn_days", type=int, default=int(os.environ.get('burn_days', 7)), help="Number of days in burn rate window.")
+    parser.add_argument("--forecast", action=argparse.BooleanOptionalAction, help="Include month end and next quarter cost forecast tab.")
+    parser.add_argument("--history", default=os.environ.get('history', None), help="Filename of account usage pkl file saved by citiUsage.py --save, monthly usage history of forecasts.")
+    parser.add_argument("--forecast_window", type=int, default=int(os.environ.get('forecast_window', 6)), help="Number of months of forecast linear trend and model selection.")
+    parser.add_argument("--serve", action=argparse.BooleanOptionalAction, help="Run as a service serving month to date views over local HTTP.")
+    parser.add_argument("--host", default=os.environ.get('host', '127.0.0.1'), help="Address for service to listen on.")
+    parser.add_argument("--port", type=int, default=int(os.environ.get('port', 8080)), help="Port for service to listen on.")
+    parser.add_argument("--refresh", type=float, default=float(os.environ.get('refresh', 15)), help="Minutes between service refreshes.")
+    parser.add_argument("--full_refresh", type=float, default=float(os.environ.get('full_refresh', 24 * 60)), help="Minutes between full refreshes of all servers.")
+    parser.add_argument("--importtime", action=argparse.BooleanOptionalAction, help="Log time taken by imports at startup.")
+    parser.add_argument("--metrics", default=os.environ.get('metrics', None), help="Filename for JSON run metrics of each stage and account.")
+    parser.add_argument("--prometheus", default=os.environ.get('prometheus', None), help="Filename for run metrics in Prometheus text format.")
+    parser.add_argument("--profile", default=os.environ.get('profile', None), help="Comma separated stages to profile (ie parseResources,write_excel), or all.")
+    parser.add_argument("--profile_dir", default=os.environ.get('profile_dir', 'profile'), help="Directory for profiles of stages.")
+    parser.add_argument("--profiler", choices=["sample", "cprofile"], default=os.environ.get('profiler', 'sample'), help="Sampling profiler writing folded stacks for flame graphs, or cProfile writing pstats files.")
+    parser.add_argument("--profile_every", type=int, default=int(os.environ.get('profile_every', 1)), help="Profile the first and then every Nth call of each stage.")
+    parser.add_argument("--profile_memory", action=argparse.BooleanOptionalAction, help="Track allocations of profiled stages with tracemalloc.")
     args = parser.parse_args()
 
+    with importTimer("pandas"):
+        import pandas as pd
+        import numpy as np
+    with importTimer("accountusage.resources"):
+        from accountusage.resources import normalizeResources
+    with importTimer("accountusage.snapshots"):
+        from accountusage.snapshots import loadUsageSnapshots, saveUsageSnapshots, appendUsageSnapshot, getBurnRate, getMonthlyCost
+    with importTimer("accountusage.forecast"):
+        from accountusage.forecast import FORECAST_KEYS, forecastUsage, monthElapsed
+    if args.importtime:
+        logImportTimes()
+    if args.profile:
+        from accountusage.profiling import StageProfiler
+        getRunMetrics().profiler = StageProfiler(args.profile.split(","), args.profile_dir, args.profiler, every=args.profile_every, memory=args.profile_memory)
+
     if args.debug:
         log = logging.getLogger()
         log.handlers[0].setLevel(logging.DEBUG)
         log.handlers[1].setLevel(logging.DEBUG)
 
+    if args.serve:
+        if args.load:
+            logging.error("--serve refreshes data from the APIs and can not be used with --load.")
+            quit(1)
+        from accountusage.service import ViewService
+
+    history = None
+    if args.forecast and args.history:
+        history = loadUsageHistory(args.history, datetime.now().strftime("%Y-%m"))
+
     APIKEYS = os.environ.get('APIKEYS', None)
     if not args.load:
+        with importTimer("ibm_cloud_sdk_core"):
+            from ibm_cloud_sdk_core import ApiException
         if APIKEYS == None:
             logging.error("You must specify apikey and name for each account in .env file or APIKEYS environment variable.")
             quit(1)
@@ -762,33 +546,76 @@ if __name__ == "__main__":
             except ValueError as e:
                 logging.error("Invalid List of APIKEYS.")
                 quit(1)
+            accounts = []
             for account in APIKEYS:
                 if "apikey" in account:
-                    apikey = account["apikey"]
-                    createSDK(apikey)
-                    accountId = getAccountId(apikey)
                     if "name" in account:
-                        accountName = account["name"]
-                        logging.info("Caching Tag Data for {} AccountId: {}.".format(accountName, accountId))
-                        tag_cache = populateTagCache()
-                        logging.info("Caching VPC Instance Data for {} AccountId: {}.".format(accountName, accountId))
-                        instance_cache = populateInstanceCache()
-                        logging.info("Retrieving Month to Date Account Usage for {}: {}.".format(accountName, accountId))
-                        accountUsage = pd.concat([accountUsage, getCurrentMonthAccountUsage()])
-                        logging.info("Retrieving current list of Virtual Servers from {} AccountId: {}.".format(accountName, accountId))
-                        resources = pd.concat([resources, parseResources(accountName, listAllResourceInstances("is.instance"))])
-                        logging.info("Retrieving current list of Bare Metal Servers from {} AccountId: {}.".format(accountName, accountId))
-                        resources = pd.concat([resources, parseResources(accountName, listAllResourceInstances("is.bare-metal-server"))])
+                        accounts.append(account)
                     else:
                         logging.error("No Name for Account found.")
                 else:
                     logging.error("No APIKEY found.")
                     quit(1)
+
+            if args.serve:
+                """ Keep account state between refreshes and collect all servers again every full_refresh minutes """
+                states = [None] * len(accounts)
+                fullRefresh = max(round(args.full_refresh / args.refresh), 1)
+                store = loadUsageSnapshots(args.snapshot_store) if args.snapshot else None
+
+                def refreshViews(refreshes):
+                    accountUsage = pd.DataFrame()
+                    resources = pd.DataFrame()
+                    for i, account in enumerate(accounts):
+                        if refreshes % fullRefresh == 0 and states[i] is not None:
+                            states[i]["updated"] = None
+                        usage, servers, states[i] = collectAccount(account, states[i])
+                        accountUsage = pd.concat([accountUsage, usage])
+                        resources = pd.concat([resources, servers])
+                    views = {"UsageSummary": calculateUsageSummary(accountUsage),
+                             "SymphonyWorkerVCPU": calculateWorkerVcpu(resources),
+                             "ScaleBareMetalCores": calculateScaleCpu(resources)}
+                    if store is not None:
+                        appendUsageSnapshot(store, accountUsage, datetime.now())
+                        saveUsageSnapshots(args.snapshot_store, store)
+                        views["BurnRateProjection"] = getBurnRate(store, datetime.now().strftime("%Y-%m"), args.burn_days)
+                    if args.forecast:
+                        views["CostForecast"] = calculateForecast(accountUsage, getForecastHistory(history, store, datetime.now().strftime("%Y-%m")),
+                                                                  views.get("BurnRateProjection")).set_index(FORECAST_KEYS)
+                    writeMetrics()
+                    return views
+
+                ViewService(refreshViews, args.refresh * 60, args.host, args.port).run()
+                quit()
+
+            for account in accounts:
+                usage, servers, state = collectAccount(account)
+                accountUsage = pd.concat([accountUsage, usage])
+                resources = pd.concat([resources, servers])
     else:
         logging.info("Retrieving Usage and Instance data from stored data file")
         accountUsage = pd.read_pickle("accountUsage.pkl")
         resources = pd.read_pickle("resources.pkl")
 
+    burnRate = None
+    store = None
+    if args.snapshot:
+        store = loadUsageSnapshots(args.snapshot_store)
+        if args.load:
+            logging.warning("Usage snapshots require current usage data and are not recorded with --load.")
+        else:
+            changed = appendUsageSnapshot(store, accountUsage, datetime.now())
+            saveUsageSnapshots(args.snapshot_store, store)
+            logging.info("Usage snapshot recorded with {} changed usage records.".format(changed))
+        burnRate = getBurnRate(store, datetime.now().strftime("%Y-%m"), args.burn_days)
+
+    forecast = None
+    if args.forecast:
+        forecastHistory = getForecastHistory(history, store, datetime.now().strftime("%Y-%m"))
+        if len(forecastHistory) == 0:
+            logging.warning("No usage history to forecast from, month end cost is projected from month to date usage only.")
+        forecast = calculateForecast(accountUsage, forecastHistory, burnRate)
+
     if args.save:
         accountUsage.to_pickle("accountUsage.pkl")
         resources.to_pickle("resources.pkl")
@@ -802,6 +629,10 @@ if __name__ == "__main__":
     writer = pd.ExcelWriter(file_name + ".xlsx", engine='xlsxwriter')
     workbook = writer.book
     createUsageSummaryTab(accountUsage)
+    if burnRate is not None:
+        createBurnRateTab(burnRate)
+    if forecast is not None:
+        createForecastTab(forecast)
     createMetricSummary(accountUsage)
     createWorkerVcpuTab(resources)
     createScaleCpuTab(resources)
@@ -809,11 +640,14 @@ if __name__ == "__main__":
     createProvisionWorkersTab(resources)
     createProvisionScaleTab(resources)
     createServerListTab(resources)
-    writer.close()
+    with stage("write excel"):
+        writer.close()
 
     """ If --COS then copy files with report end month + timestamp to COS """
     if args.cos:
         """ Write output to COS"""
         logging.info("Writing Pivot Tables to COS.")
-        writeFiletoCos(file_name + ".xlsx", file_name + timestamp + ".xlsx")
+        with stage("upload"):
+            writeFiletoCos(file_name + ".xlsx", file_name + timestamp + ".xlsx", args.COS_APIKEY, args.COS_INSTANCE_CRN, args.COS_ENDPOINT, args.COS_BUCKET)
+    writeMetrics()
     logging.info("Current Server Resource Report is complete.")
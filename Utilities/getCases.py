@@ -15,16 +15,16 @@
 
 
 __author__ = 'jonhall'
-import os, logging, logging.config, os.path, argparse, pytz
+import os, sys, json, logging, logging.config, os.path, argparse, pytz, pickle
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, tzinfo, timezone
-import pandas as pd
-import numpy as np
-from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalTaggingV1, GlobalSearchV2
-from ibm_cloud_sdk_core import ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_platform_services.resource_controller_v2 import *
-from ibm_platform_services.case_management_v1 import *
 from dotenv import load_dotenv
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.startup import importTimer, logImportTimes
+from accountusage.tokens import getTokenManager
+
+""" Largest page size accepted by the case management API """
+CASE_PAGE_LIMIT = 100
 
 def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
     # read logging.json for log parameters to be ued by script
@@ -39,29 +39,33 @@ def setup_logging(default_path='logging.json', default_level=logging.info, env_k
     else:
         logging.basicConfig(level=default_level)
 
-def getAccountId(IC_API_KEY):
+def getAccountId(IC_API_KEY, iam_identity_service):
     ##########################################################
     ## Get AccountId for this API Key
     ##########################################################
 
-    try:
+    def lookupAccountId():
         api_key = iam_identity_service.get_api_keys_details(
           iam_api_key=IC_API_KEY
         ).get_result()
+        return api_key["account_id"]
+
+    try:
+        accountId = getTokenManager().getAccountId(IC_API_KEY, lookupAccountId)
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
 
-    return api_key["account_id"]
+    return accountId
 
 def createSDK(IC_API_KEY):
     """
     Create SDK clients
+    Clients are returned rather than stored globally so accounts can be synced concurrently.
     """
-    global iam_identity_service, case_management_service
 
     try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
+        authenticator = getTokenManager().getAuthenticator(IC_API_KEY)
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
@@ -81,14 +85,83 @@ def createSDK(IC_API_KEY):
         logging.error("API exception {}.".format(str(e)))
         quit()
 
-def getCases():
+    return iam_identity_service, case_management_service
+
+def getCases(case_management_service, since=None):
+    """
+    Get cases for account sorted by most recently updated first
+    :param case_management_service: case management client for account
+    :param since: updated_at watermark of last sync, only cases updated at or after it are returned (None for all cases)
+    :return: list of cases
+    """
     all_results = []
-    pager = GetCasesPager(client=case_management_service, limit=10)
-    while pager.has_next():
-        next_page = pager.get_next()
-        assert next_page is not None
-        all_results.extend(next_page)
+    pager = GetCasesPager(client=case_management_service, sort="~updated_at", limit=CASE_PAGE_LIMIT)
+    try:
+        while pager.has_next():
+            next_page = pager.get_next()
+            if not next_page:
+                break
+            if since is None:
+                all_results.extend(next_page)
+                continue
+            """
+            Pages are in descending updated_at order, so stop at first case older than watermark.  Cases updated at the
+            watermark are fetched again, as cases updated in the same second may not all have been synced
+            """
+            updated = [case for case in next_page if case["updated_at"] >= since]
+            all_results.extend(updated)
+            if len(updated) < len(next_page):
+                break
+    except ApiException as e:
+        logging.error("API exception {}.".format(str(e)))
+        quit()
     return all_results
+def loadCaseStore(filename):
+    """
+    Load local case store
+    :param filename: pickle file of case store
+    :return: dictionary of accounts, each with name, watermark and cases keyed by case number
+    """
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    return {"accounts": {}}
+def saveCaseStore(filename, store):
+    """
+    Save local case store
+    """
+    with open(filename, "wb") as f:
+        pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return
+def syncAccountCases(account, store, full=False):
+    """
+    Retrieve cases updated since the stored watermark for a single account
+    :param account: dictionary with apikey and name of account
+    :param store: local case store (read only, merged by caller)
+    :param full: ignore watermark and retrieve all cases
+    :return: accountId, account name, list of new or updated cases
+    """
+    apikey = account["apikey"]
+    iam_identity_service, case_management_service = createSDK(apikey)
+    accountId = getAccountId(apikey, iam_identity_service)
+    since = None
+    if not full and accountId in store["accounts"]:
+        since = store["accounts"][accountId]["watermark"]
+    logging.info("Getting cases for account {} updated since {}.".format(accountId, since))
+    cases = getCases(case_management_service, since)
+    logging.info("Retrieved {} new or updated cases for account {}.".format(len(cases), accountId))
+    return accountId, account["name"], cases
+def mergeCases(store, accountId, accountName, cases):
+    """
+    Merge new or updated cases into case store and advance account watermark
+    """
+    entry = store["accounts"].setdefault(accountId, {"name": accountName, "watermark": None, "cases": {}})
+    entry["name"] = accountName
+    for case in cases:
+        entry["cases"][case["number"]] = case
+        if entry["watermark"] is None or case["updated_at"] > entry["watermark"]:
+            entry["watermark"] = case["updated_at"]
+    return
 def parseCases(account, account_name, cases):
     data =[]
     for case in cases:
@@ -190,49 +263,68 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Get Account Cases.")
     parser.add_argument("--output", default=os.environ.get('output', 'cases.xlsx'), help="Filename Excel input file for list of resources and tags. (including extension of .xlsx)")
     parser.add_argument("--debug", action=argparse.BooleanOptionalAction, help="Set Debug level for logging.")
+    parser.add_argument("--store", default=os.environ.get('store', 'cases.pkl'), help="Filename of local case store used for incremental sync.")
+    parser.add_argument("--load", action=argparse.BooleanOptionalAction, help="Create Cases tab from local case store without syncing.")
+    parser.add_argument("--full", action=argparse.BooleanOptionalAction, help="Ignore sync watermark and retrieve all cases.")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get('threads', 8)), help="Number of accounts to sync concurrently.")
+    parser.add_argument("--importtime", action=argparse.BooleanOptionalAction, help="Log time taken by imports at startup.")
     args = parser.parse_args()
 
+    with importTimer("pandas"):
+        import pandas as pd
+    if not args.load:
+        with importTimer("ibm_platform_services"):
+            from ibm_platform_services import IamIdentityV1
+            from ibm_platform_services.case_management_v1 import CaseManagementV1, GetCasesPager
+            from ibm_cloud_sdk_core import ApiException
+    if args.importtime:
+        logImportTimes()
+
     if args.debug:
         log = logging.getLogger()
         log.handlers[0].setLevel(logging.DEBUG)
         log.handlers[1].setLevel(logging.DEBUG)
 
-    APIKEYS = os.environ.get('APIKEYS', None)
+    store = loadCaseStore(args.store)
+    if not args.load:
+        APIKEYS = os.environ.get('APIKEYS', None)
 
-    if APIKEYS == None:
-        logging.error("You must specify apikey and name for each account in .env file or APIKEYS environment variable.")
-        quit()
-    else:
-        """ Convert to List of JSON variable """
-        try:
-            APIKEYS = json.loads(APIKEYS)
-        except ValueError as e:
-            logging.error("Invalid List of APIKEYS.")
+        if APIKEYS == None:
+            logging.error("You must specify apikey and name for each account in .env file or APIKEYS environment variable.")
             quit()
+        else:
+            """ Convert to List of JSON variable """
+            try:
+                APIKEYS = json.loads(APIKEYS)
+            except ValueError as e:
+                logging.error("Invalid List of APIKEYS.")
+                quit()
 
+            for account in APIKEYS:
+                if "apikey" not in account:
+                    logging.error("No Apikey found.")
+                    quit()
 
-        """" Loop through specified accounts and get cases """
-        cases_df = pd.DataFrame()
-        for account in APIKEYS:
-            if "apikey" in account:
-                apikey = account["apikey"]
-                createSDK(apikey)
-                accountId = getAccountId(apikey)
-                logging.info("Getting cases for account {}.".format(accountId))
-                cases = getCases()
-                logging.info("Parsing cases for account {}.".format(accountId))
-                cases_df = pd.concat([cases_df, parseCases(accountId, account["name"], cases)])
-            else:
-                logging.error("No Apikey found.")
-                quit()
+            """" Sync accounts concurrently, then merge results into case store """
+            with ThreadPoolExecutor(max_workers=max(1, args.threads)) as executor:
+                results = list(executor.map(lambda account: syncAccountCases(account, store, args.full), APIKEYS))
+            for accountId, accountName, cases in results:
+                mergeCases(store, accountId, accountName, cases)
+            saveCaseStore(args.store, store)
+
+    """ Build Cases tab from local case store """
+    cases_df = pd.DataFrame()
+    for accountId, entry in store["accounts"].items():
+        logging.info("Parsing cases for account {}.".format(accountId))
+        cases_df = pd.concat([cases_df, parseCases(accountId, entry["name"], entry["cases"].values())])
 
-        output = args.output
-        split_tup = os.path.splitext(args.output)
-        """ remove file extension """
-        file_name = split_tup[0]
-        writer = pd.ExcelWriter(file_name + ".xlsx", engine='xlsxwriter')
-        workbook = writer.book
-        writeCases(cases_df)
-        writer.close()
+    output = args.output
+    split_tup = os.path.splitext(args.output)
+    """ remove file extension """
+    file_name = split_tup[0]
+    writer = pd.ExcelWriter(file_name + ".xlsx", engine='xlsxwriter')
+    workbook = writer.book
+    writeCases(cases_df)
+    writer.close()
 
     logging.info("Getting Cases Complete.")
@@ -15,354 +15,156 @@
 
 
 __author__ = 'jonhall'
-import os, logging, logging.config, os.path, argparse, pytz
+import os, sys, json, logging, logging.config, os.path, argparse, pickle, hashlib
 from datetime import datetime, tzinfo, timezone
-import pandas as pd
-import numpy as np
-import ibm_boto3
-from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalSearchV2
-from ibm_cloud_sdk_core import ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_platform_services.resource_controller_v2 import *
-from ibm_botocore.client import Config, ClientError
-from ibm_vpc import VpcV1
 from dotenv import load_dotenv
-from urllib import parse
-
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
-def getAccountId(IC_API_KEY):
-    ##########################################################
-    ## Get AccountId for this API Key
-    ##########################################################
-
-    try:
-        api_key = iam_identity_service.get_api_keys_details(
-          iam_api_key=IC_API_KEY
-        ).get_result()
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    return api_key["account_id"]
-def populateTagCache():
-    ##########################################################
-    ## Populate Tagging data into cache
-    ##########################################################
-
-    search_cursor = None
-    items = []
-    while True:
-        response = global_search_service.search(query='tags:*',
-                                                search_cursor=search_cursor,
-                                                fields=["tags"],
-                                                limit=1000)
-
-
-        scan_result = response.get_result()
-
-        items = items + scan_result["items"]
-        if "search_cursor" not in scan_result:
-            break
-        else:
-            search_cursor = scan_result["search_cursor"]
-
-    tag_cache = {}
-    for resource in items:
-        resourceId = resource["crn"]
-        tag_cache[resourceId] = resource["tags"]
-
-    return tag_cache
-def populateInstanceCache():
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.startup import importTimer, logImportTimes
+from accountusage.logs import setup_logging
+from accountusage.clients import ClientFactory
+from accountusage.cache import populateTagCache, listAllResourceInstances
+from accountusage.cos import writeFiletoCos
+
+def parseResources(accountName, resources):
     """
-    Get VPC instance information and create cache from each VPC regional endpoint
+    Parse Resource JSON into list of resources with role and audit tags
     """
-    endpoints = [vpc_service_us_south, vpc_service_us_east, vpc_service_ca_tor]
-    items = []
-
-    for endpoint in endpoints:
-        """ Get virtual servers """
-        instances = endpoint.list_instances()
-        while True:
-            try:
-                result = instances.get_result()
-            except ApiException as e:
-                logging.error("List VPC virtual server instances with status code{}:{}".format(str(e.code), e.message))
-                quit(1)
-
-            items = items + result["instances"]
-            if "next" not in result:
-                break
-            else:
-                next = dict(parse.parse_qsl(parse.urlsplit(result["next"]["href"]).query))
-                instances = endpoint.list_instances(start=next["start"])
-
-        """ Get Bare Metal"""
-        instances = endpoint.list_bare_metal_servers()
-        while True:
-            try:
-                result = instances.get_result()
-            except ApiException as e:
-                logging.error("List BM server instances with status code{}:{}".format(str(e.code), e.message))
-                quit(1)
-
-            items = items + result["bare_metal_servers"]
-            if "next" not in result:
-                break
-            else:
-                next = dict(parse.parse_qsl(parse.urlsplit(result["next"]["href"]).query))
-                instances = endpoint.list_bare_metal_servers(start=next["start"])
-
+    resourceDetail = normalizeResources(accountName, resources, tag_cache)
+    return resourceDetail[['account_id', "account_name", "service_id", "instance_id", "name", "region_id",
+                           "instance_created_at", "instance_updated_at",
+                           "role_tags", "audit_tags"]].rename(columns={"role_tags": "role", "audit_tags": "audit"})
 
-    instance_cache = {}
-    for resource in items:
-        crn = resource["crn"]
-        instance_cache[crn] = resource
-
-    return instance_cache
-def createSDK(IC_API_KEY):
+def tagSetId(tags):
     """
-    Create SDK clients
+    Content address of a set of tags, identical tag sets share one id (and one stored copy) across CRNs and snapshots
     """
-    global resource_controller_service, iam_identity_service, global_search_service, usage_reports_service, vpc_service_us_south, vpc_service_us_east, vpc_service_ca_tor
-
-    try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        iam_identity_service = IamIdentityV1(authenticator=authenticator)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        usage_reports_service = UsageReportsV4(authenticator=authenticator)
-        usage_reports_service.enable_retries(max_retries=5, retry_interval=1.0)
-        usage_reports_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        resource_controller_service = ResourceControllerV2(authenticator=authenticator)
-        resource_controller_service.enable_retries(max_retries=5, retry_interval=1.0)
-        resource_controller_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        global_search_service = GlobalSearchV2(authenticator=authenticator)
-        global_search_service.enable_retries(max_retries=5, retry_interval=1.0)
-        global_search_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        vpc_service_us_south = VpcV1(authenticator=authenticator)
-        vpc_service_us_south.set_service_url('https://us-south.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        vpc_service_us_east = VpcV1(authenticator=authenticator)
-        vpc_service_us_east.set_service_url('https://us-east.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-
-    try:
-        vpc_service_ca_tor = VpcV1(authenticator=authenticator)
-        vpc_service_ca_tor.set_service_url('https://ca-tor.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit(1)
-def getCurrentMonthAccountUsage():
+    return hashlib.sha1("\n".join(sorted(set(tags))).encode("utf-8")).hexdigest()[:16]
+def loadTagSnapshots(filename):
     """
-    Get IBM Cloud Service from account for current month
+    Load tag snapshot store
+    :param filename: pickle file of snapshot store
+    :return: dictionary of shared tagsets, current CRN to tagset mapping, and list of snapshots with their changes
     """
-
-    data = []
-    usageMonth = datetime.now().strftime("%Y-%m")
-
-    try:
-        usage = usage_reports_service.get_account_usage(
-            account_id=accountId,
-            billingmonth=usageMonth,
-            names=True
-        ).get_result()
-    except ApiException as e:
-        if e.code == 424:
-            logging.warning("API exception {}.".format(str(e)))
-            quit(1)
-        else:
-            logging.error("API exception {}.".format(str(e)))
-            quit(1)
-
-    logging.debug("usage {}={}".format(usageMonth, usage))
-    for resource in usage['resources']:
-        for plan in resource['plans']:
-            for metric in plan['usage']:
-                row = {
-                    'account_id': usage["account_id"],
-                    'account_name': accountName,
-                    'month': usageMonth,
-                    'currency_code': usage['currency_code'],
-                    'billing_country': usage['billing_country'],
-                    'resource_id': resource['resource_id'],
-                    'resource_name': resource['resource_name'],
-                    'billable_charges': resource["billable_cost"],
-                    'billable_rated_charges': resource["billable_rated_cost"],
-                    'plan_id': plan['plan_id'],
-                    'plan_name': plan['plan_name'],
-                    'metric': metric['metric'],
-                    'unit_name': metric['unit_name'],
-                    'quantity': float(metric['quantity']),
-                    'rateable_quantity': metric['rateable_quantity'],
-                    'cost': metric['cost'],
-                    'rated_cost': metric['rated_cost'],
-                    }
-                if metric['discounts'] != []:
-                    """
-                    Discount found in usage record
-                    """
-                    row['discount'] = metric['discounts'][0]['discount'] / 100
-                else:
-                    """
-                    No discount found in usage record
-                    """
-                    row['discount'] = 0
-
-
-                if len(metric['price']) > 0:
-                    row['price'] = metric['price']
-                else:
-                    row['price'] = "[]"
-                # add row to data
-                data.append(row.copy())
-
-
-    accountUsage = pd.DataFrame(data, columns=['account_id', "account_name", 'month', 'currency_code', 'billing_country', 'resource_id', 'resource_name',
-                    'billable_charges', 'billable_rated_charges', 'plan_id', 'plan_name', 'metric', 'unit_name', 'quantity',
-                    'rateable_quantity','cost', 'rated_cost', 'discount', 'price'])
-
-    return accountUsage
-def listAllResourceInstances():
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    return {"tagsets": {}, "current": {}, "snapshots": []}
+def saveTagSnapshots(filename, store):
     """
-    Retrieve all Resources for account from resource controller fore resource_type
+    Save tag snapshot store
     """
-    all_results = []
-    pager = ResourceInstancesPager(
-        client=resource_controller_service,
-        limit=20
-    )
-
-    try:
-        while pager.has_next():
-            next_page = pager.get_next()
-            assert next_page is not None
-            all_results.extend(next_page)
-        logging.debug("resource_instance={}".format(all_results))
-    except ApiException as e:
-            logging.error(
-                "API Error.  Can not retrieve instances of type {} {}: {}".format(resource_type, str(e.code),
-                                                                                         e.message))
-            quit(1)
-    return all_results
-def getTags(resourceId):
+    with open(filename, "wb") as f:
+        pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return
+def recordTagSnapshot(store, tag_cache, timestamp):
     """
-    Check Tag_Cache for Resource tags which may have been retrieved previously
+    Record tag cache as new snapshot.  Only CRNs whose tagset changed since the previous snapshot are stored.
+    :param store: tag snapshot store
+    :param tag_cache: dictionary of CRN to list of tags from populateTagCache
+    :param timestamp: timestamp of snapshot
+    :return: changes of snapshot as dictionary of CRN to (previous tagset id, new tagset id), None if not tagged
     """
-    global tag_cache
-    if resourceId not in tag_cache:
-        logging.debug("Cache miss for Tag {}".format(resourceId))
-        tag = []
-    else:
-        tag = tag_cache[resourceId]
-    return tag
-def getInstance(instance):
+    current = store["current"]
+    changes = {}
+    seen = set()
+    for crn, tags in tag_cache.items():
+        seen.add(crn)
+        newId = tagSetId(tags)
+        if newId not in store["tagsets"]:
+            store["tagsets"][newId] = tuple(sorted(set(tags)))
+        oldId = current.get(crn)
+        if oldId != newId:
+            changes[crn] = (oldId, newId)
+            current[crn] = newId
+
+    """ CRNs no longer returned by tag search have had all tags removed or were deleted """
+    for crn in [crn for crn in current if crn not in seen]:
+        changes[crn] = (current.pop(crn), None)
+
+    store["snapshots"].append({"timestamp": timestamp, "changes": changes})
+    logging.info("Tag snapshot {} recorded with {} changed CRNs.".format(timestamp, len(changes)))
+    return changes
+def getTagChanges(store, since=None):
     """
-    Check Tag_Cache for Resource tags which may have been retrieved previously
+    Combine snapshot change logs after since (all snapshots if None) into one set of changes per CRN
+    Only change logs are read so time is linear in the number of changes.
+    :return: dictionary of CRN to (tagset id at since, current tagset id)
     """
-    global instance_cache
-    if instance not in instance_cache:
-        logging.warning("Cache miss for VPC instance {}".format(instance))
-        instance_data = []
-    else:
-        instance_data = instance_cache[instance]
-    return instance_data
-def parseResources(accoutName, resources):
+    combined = {}
+    for snapshot in store["snapshots"]:
+        if since is not None and snapshot["timestamp"] <= since:
+            continue
+        for crn, (oldId, newId) in snapshot["changes"].items():
+            if crn in combined:
+                combined[crn] = (combined[crn][0], newId)
+            else:
+                combined[crn] = (oldId, newId)
+    return {crn: ids for crn, ids in combined.items() if ids[0] != ids[1]}
+def diffTagSets(oldTags, newTags):
     """
-    Parse Resource JSON
+    Compare two tag lists by tag key
+    :return: list of (tag_key, action, old_value, new_value) where action is added, removed or changed
     """
-
-    data = []
-    nytz = pytz.timezone('America/New_York')
-    for resource_instance in resources:
-        row = {
-            "account_id": resource_instance["account_id"],
-            "account_name": accountName,
-            "service_id": resource_instance["resource_id"],
-            "instance_id": resource_instance["id"],
-            "region_id": resource_instance["region_id"],
-            "name": resource_instance["name"]
-        }
-
-        if "created_at" in resource_instance:
-            created_at = resource_instance["created_at"]
+    def byKey(tags):
+        keys = {}
+        for tag in tags:
+            key, sep, value = tag.partition(":")
+            keys.setdefault(key, set()).add(value)
+        return keys
+
+    old = byKey(oldTags)
+    new = byKey(newTags)
+    diff = []
+    for key in sorted(old.keys() | new.keys()):
+        oldValues = old.get(key, set())
+        newValues = new.get(key, set())
+        if oldValues == newValues:
+            continue
+        if len(oldValues) == 0:
+            action = "added"
+        elif len(newValues) == 0:
+            action = "removed"
         else:
-            created_at = ""
-
-        if "updated_at" in resource_instance:
-            updated_at = resource_instance["updated_at"]
-        else:
-            updated_at = ""
-
-        """
-        get tags attached to instance from cache or resource controller
-        """
-
-        tags = getTags(resource_instance["id"])
-        # parse role tag into comma delimited list
-        if len(tags) > 0:
-            role = ",".join([str(item) for item in tags if "role:" in item])
-            audit = ",".join([str(item) for item in tags if "audit:" in item])
-        else:
-            role = ""
-            audit = ""
-
-
-        row_addition = {
-            "instance_created_at": created_at,
-            "instance_updated_at": updated_at,
-            "role": role,
-            "audit": audit,
-        }
-
-        # combine original row with additions
-
-        row = row | row_addition
-        data.append(row.copy())
-
-    resourceDetail = pd.DataFrame(data, columns=['account_id', "account_name", "service_id", "instance_id", "name", "region_id",
-                                                 "instance_created_at", "instance_updated_at",
-                                                 "role", "audit"])
-    return resourceDetail
+            action = "changed"
+        diff.append((key, action, ",".join(sorted(oldValues)), ",".join(sorted(newValues))))
+    return diff
+def parseTagChanges(store, changes, timestamp):
+    """
+    Expand CRN tagset changes into one row per changed tag key
+    """
+    data = []
+    for crn, (oldId, newId) in changes.items():
+        oldTags = store["tagsets"][oldId] if oldId is not None else ()
+        newTags = store["tagsets"][newId] if newId is not None else ()
+        for key, action, old_value, new_value in diffTagSets(oldTags, newTags):
+            data.append({
+                "snapshot": timestamp,
+                "instance_id": crn,
+                "action": action,
+                "tag_key": key,
+                "old_value": old_value,
+                "new_value": new_value
+            })
+
+    tagChanges = pd.DataFrame(data, columns=["snapshot", "instance_id", "action", "tag_key", "old_value", "new_value"])
+    return tagChanges
+def createTagChangesTab(tagChanges):
+    """
+    Write tag changes since previous snapshot tab to excel
+    """
+    logging.info("Creating tagChanges tab.")
+    tagChanges.to_excel(writer, "tagChanges")
+    worksheet = writer.sheets['tagChanges']
+    totalrows,totalcols=tagChanges.shape
+    worksheet.autofilter(0,0,totalrows,totalcols)
+    format2 = workbook.add_format({'align': 'left'})
+    worksheet.set_column("B:B", 18, format2)
+    worksheet.set_column("C:D", 32, format2)
+    worksheet.set_column("E:E", 120, format2)
+    worksheet.set_column("F:F", 10, format2)
+    worksheet.set_column("G:G", 24, format2)
+    worksheet.set_column("H:I", 40, format2)
+    return
 def createTagListTab(paasUsage):
     """
     Write Service Usage detail tab to excel
@@ -382,52 +184,6 @@ def createTagListTab(paasUsage):
     worksheet.set_column("H:I", 28, format2)
     worksheet.set_column("J:K", 30, format2)
     return
-def writeFiletoCos(localfile, upload):
-    """"
-    Write Files to COS
-    """
-
-    def multi_part_upload(bucket_name, item_name, file_path):
-        """"
-        Write Files to COS
-        """
-        try:
-            logging.info("Starting file transfer for {0} to bucket: {1}".format(item_name, bucket_name))
-            # set 5 MB chunks
-            part_size = 1024 * 1024 * 5
-
-            # set threadhold to 15 MB
-            file_threshold = 1024 * 1024 * 15
-
-            # set the transfer threshold and chunk size
-            transfer_config = ibm_boto3.s3.transfer.TransferConfig(
-                multipart_threshold=file_threshold,
-                multipart_chunksize=part_size
-            )
-
-            # the upload_fileobj method will automatically execute a multi-part upload
-            # in 5 MB chunks for all files over 15 MB
-            with open(file_path, "rb") as file_data:
-                cos.Object(bucket_name, item_name).upload_fileobj(
-                    Fileobj=file_data,
-                    Config=transfer_config
-                )
-            logging.info("Transfer for {0} complete".format(item_name))
-        except ClientError as be:
-            logging.error("CLIENT ERROR: {0}".format(be))
-        except Exception as e:
-            logging.error("Unable to complete multi-part upload: {0}".format(e))
-        return
-
-    cos = ibm_boto3.resource("s3",
-                             ibm_api_key_id=args.COS_APIKEY,
-                             ibm_service_instance_id=args.COS_INSTANCE_CRN,
-                             config=Config(signature_version="oauth"),
-                             endpoint_url=args.COS_ENDPOINT
-                             )
-    multi_part_upload(args.COS_BUCKET, upload, "./" + localfile)
-    return
-
 if __name__ == "__main__":
     setup_logging()
     load_dotenv()
@@ -437,6 +193,9 @@ if __name__ == "__main__":
     parser.add_argument("--load", action=argparse.BooleanOptionalAction, help="Load dataframes from pkl files.")
     parser.add_argument("--save", action=argparse.BooleanOptionalAction, help="Store dataframes to pkl files.")
     parser.add_argument("--cos", "--COS", action=argparse.BooleanOptionalAction, help="Upload files to COS bucket specified.")
+    parser.add_argument("--snapshot", action=argparse.BooleanOptionalAction, help="Record tag snapshot and report tag changes since previous snapshot.")
+    parser.add_argument("--since", default=None, help="Report tag changes of all snapshots after this time (YYYY-MM-DD HH:MM) instead of the new snapshot only.")
+    parser.add_argument("--snapshot_store", default=os.environ.get('snapshot_store', 'tagSnapshots.pkl'), help="Filename of tag snapshot store.")
     parser.add_argument("--COS_APIKEY", default=os.environ.get('COS_APIKEY', None),
                         help="COS apikey to use to write output to Object Storage.")
     parser.add_argument("--COS_ENDPOINT", default=os.environ.get('COS_ENDPOINT', None),
@@ -446,14 +205,23 @@ if __name__ == "__main__":
     parser.add_argument("--COS_BUCKET", default=os.environ.get('COS_BUCKET', None),
                         help="COS Bucket name to use to write output to Object Storage.")
 
+    parser.add_argument("--importtime", action=argparse.BooleanOptionalAction, help="Log time taken by imports at startup.")
     args = parser.parse_args()
 
+    with importTimer("pandas"):
+        import pandas as pd
+    with importTimer("accountusage.resources"):
+        from accountusage.resources import normalizeResources
+    if args.importtime:
+        logImportTimes()
+
     if args.debug:
         log = logging.getLogger()
         log.handlers[0].setLevel(logging.DEBUG)
         log.handlers[1].setLevel(logging.DEBUG)
 
     APIKEYS = os.environ.get('APIKEYS', None)
+    all_tags = {}
     if not args.load:
         if APIKEYS == None:
             logging.error("You must specify apikey and name for each account in .env file or APIKEYS environment variable.")
@@ -470,14 +238,15 @@ if __name__ == "__main__":
             for account in APIKEYS:
                 if "apikey" in account:
                     apikey = account["apikey"]
-                    createSDK(apikey)
-                    accountId = getAccountId(apikey)
+                    clients = ClientFactory(apikey)
+                    accountId = clients.getAccountId()
                     if "name" in account:
                         accountName = account["name"]
                         logging.info("Caching Tag Data for {} AccountId: {}.".format(accountName, accountId))
-                        tag_cache = populateTagCache()
+                        tag_cache = populateTagCache(clients)
+                        all_tags.update({crn: tag_cache["sets"][setId]["tags"] for crn, setId in tag_cache["crn"].items()})
                         logging.info("Retrieving current list of service instances for {} AccountId: {}.".format(accountName, accountId))
-                        resources = pd.concat([resources, parseResources(accountName, listAllResourceInstances())])
+                        resources = pd.concat([resources, parseResources(accountName, listAllResourceInstances(clients))])
                     else:
                         logging.error("No Name for Account found.")
                 else:
@@ -490,6 +259,34 @@ if __name__ == "__main__":
     if args.save:
         resources.to_pickle("resources.pkl")
 
+    if args.since is not None:
+        try:
+            since = datetime.strptime(args.since, "%Y-%m-%d %H:%M").strftime("%Y-%m-%d %H:%M")
+        except ValueError:
+            logging.error("Invalid --since {}, expected YYYY-MM-DD HH:MM.".format(args.since))
+            quit(1)
+
+    tagChanges = None
+    if args.snapshot or args.since is not None:
+        store = loadTagSnapshots(args.snapshot_store)
+        changes = None
+        if args.snapshot and args.load:
+            logging.warning("Tag snapshots require current tag data and are not recorded with --load.")
+        elif args.snapshot:
+            snapshotTime = datetime.now().strftime("%Y-%m-%d %H:%M")
+            changes = recordTagSnapshot(store, all_tags, snapshotTime)
+            saveTagSnapshots(args.snapshot_store, store)
+        """ Changes of all snapshots after --since are combined, reported as of the latest snapshot """
+        if args.since is not None and len(store["snapshots"]) > 0:
+            snapshotTime = store["snapshots"][-1]["timestamp"]
+            changes = getTagChanges(store, since)
+            logging.info("{} CRNs changed tags in snapshots after {}.".format(len(changes), since))
+        if changes is not None:
+            tagChanges = parseTagChanges(store, changes, snapshotTime)
+            """ Add account and instance name from current resources where available """
+            tagChanges = tagChanges.merge(resources[["instance_id", "account_name", "name"]].drop_duplicates("instance_id"), how="left", on="instance_id")
+            tagChanges = tagChanges[["snapshot", "account_name", "name", "instance_id", "action", "tag_key", "old_value", "new_value"]]
+
     # Write dataframe to excel
     output = args.output
     split_tup = os.path.splitext(args.output)
@@ -499,11 +296,13 @@ if __name__ == "__main__":
     writer = pd.ExcelWriter(file_name + ".xlsx", engine='xlsxwriter')
     workbook = writer.book
     createTagListTab(resources)
+    if tagChanges is not None:
+        createTagChangesTab(tagChanges)
     writer.close()
 
     """ If --COS then copy files with report end month + timestamp to COS """
     if args.cos:
         """ Write output to COS"""
         logging.info("Writing Pivot Tables to COS.")
-        writeFiletoCos(file_name + ".xlsx", file_name + timestamp + ".xlsx")
+        writeFiletoCos(file_name + ".xlsx", file_name + timestamp + ".xlsx", args.COS_APIKEY, args.COS_INSTANCE_CRN, args.COS_ENDPOINT, args.COS_BUCKET)
     logging.info("Generation of currentTags is complete.")
@@ -15,249 +15,38 @@
 
 
 __author__ = 'jonhall'
-import os, logging, logging.config, os.path, argparse, pytz
+import os, sys, json, logging, logging.config, os.path, argparse, pytz
 from datetime import datetime, tzinfo, timezone
 from dateutil.relativedelta import *
-import pandas as pd
-import numpy as np
-import ibm_boto3
-from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalTaggingV1, GlobalSearchV2
-from ibm_cloud_sdk_core import ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_platform_services.resource_controller_v2 import *
-from ibm_botocore.client import Config, ClientError
-from ibm_vpc import VpcV1
 from dotenv import load_dotenv
-from urllib import parse
-
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
-def createSDK(IC_API_KEY):
-    """
-    Create SDK clients
-    """
-    global resource_controller_service, global_tagging_service, iam_identity_service, global_search_service, usage_reports_service, vpc_service_us_south, vpc_service_us_east, vpc_service_ca_tor
-
-    try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    try:
-        iam_identity_service = IamIdentityV1(authenticator=authenticator)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    try:
-        usage_reports_service = UsageReportsV4(authenticator=authenticator)
-        usage_reports_service.enable_retries(max_retries=5, retry_interval=1.0)
-        usage_reports_service.set_http_config({'timeout': 120})
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    try:
-        resource_controller_service = ResourceControllerV2(authenticator=authenticator)
-        resource_controller_service.enable_retries(max_retries=5, retry_interval=1.0)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    try:
-      global_tagging_service = GlobalTaggingV1(authenticator=authenticator)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    try:
-        global_search_service = GlobalSearchV2(authenticator=authenticator)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    try:
-        vpc_service_us_south = VpcV1(authenticator=authenticator)
-        vpc_service_us_south.set_service_url('https://us-south.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    try:
-        vpc_service_us_east = VpcV1(authenticator=authenticator)
-        vpc_service_us_east.set_service_url('https://us-east.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    try:
-        vpc_service_ca_tor = VpcV1(authenticator=authenticator)
-        vpc_service_ca_tor.set_service_url('https://ca-tor.iaas.cloud.ibm.com/v1')
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-def getAccountId(IC_API_KEY):
-    ##########################################################
-    ## Get AccountId for this API Key
-    ##########################################################
-
-    try:
-        api_key = iam_identity_service.get_api_keys_details(
-          iam_api_key=IC_API_KEY
-        ).get_result()
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
-
-    return api_key["account_id"]
-def populateTagCache():
-    ##########################################################
-    ## Populate Tagging data into cache
-    ##########################################################
-
-    search_cursor = None
-    items = []
-    while True:
-        response = global_search_service.search(query='tags:*',
-                                                search_cursor=search_cursor,
-                                                fields=["tags"],
-                                                limit=1000)
-
-        scan_result = response.get_result()
-
-        items = items + scan_result["items"]
-        if "search_cursor" not in scan_result:
-            break
-        else:
-            search_cursor = scan_result["search_cursor"]
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.startup import importTimer, logImportTimes
+from accountusage.logs import setup_logging
+from accountusage.clients import ClientFactory
+from accountusage.cache import searchTags, listAllResourceInstances, populateResourceCache
+from accountusage.tags import buildTagIndex, getTagSet
+from accountusage.cos import writeFiletoCos
 
-    df = pd.DataFrame.from_dict(items)
-    tag_cache = {}
-    for resource in items:
-        resourceId = resource["crn"]
-        tag_cache[resourceId] = resource["tags"]
-
-    return tag_cache, df
 def prePopulateResourceCache(accountName, accountId):
     """
     Retrieve all Resources for account from resource controller and pre-populate cache
     """
     logging.info("Resource_cache being pre-populated with active resources in account.")
-    all_results = []
-    pager = ResourceInstancesPager(
-        client=resource_controller_service,
-        limit=50
-    )
-
-    try:
-        while pager.has_next():
-            next_page = pager.get_next()
-            assert next_page is not None
-            all_results.extend(next_page)
-        logging.debug("resource_instance={}".format(all_results))
-    except ApiException as e:
-        logging.error(
-            "API Error.  Can not retrieve instances of type {} {}: {}".format(resource_type, str(e.code),
-                                                                              e.message))
-        quit()
+    all_results = listAllResourceInstances(clients)
     # Convert to DF and populdate all ROWS with account info
     resources_df = pd.DataFrame.from_dict(all_results)
     resources_df["accountId"] = accountId
     resources_df["accountName"] = accountName
 
-    resource_cache = {}
-    for resource in all_results:
-        resourceId = resource["crn"]
-        resource_cache[resourceId] = resource
-
-    return resource_cache, resources_df
-def populateInstanceCache():
-    """
-    Get profile information and create cache from each VPC endpoint
-    """
-
-    items = []
-    instances = vpc_service_us_south.list_instances()
-    while True:
-        """
-        Loop through all items in us-south
-        """
-        try:
-            result = instances.get_result()
-        except ApiException as e:
-            logging.error("List VPC virtual server instances with status code{}:{}".format(str(e.code), e.message))
-            quit()
-
-        items = items + result["instances"]
-        if "next" not in result:
-            break
-        else:
-            next = dict(parse.parse_qsl(parse.urlsplit(result["next"]["href"]).query))
-            instances = vpc_service_us_south.list_instances(start=next["start"])
-
-    instances = vpc_service_us_east.list_instances()
-    while True:
-        """
-        Loop through all items in us-east
-        """
-        try:
-            result = instances.get_result()
-        except ApiException as e:
-            logging.error("List VPC virtual server instances with status code{}:{}".format(str(e.code), e.message))
-            quit()
-
-        items = items + result["instances"]
-        if "next" not in result:
-            break
-        else:
-            next = dict(parse.parse_qsl(parse.urlsplit(result["next"]["href"]).query))
-            instances = vpc_service_us_east.list_instances(start=next["start"])
-
-    instances = vpc_service_ca_tor.list_instances()
-    while True:
-        """
-        Loop through all items in us-east
-        """
-        try:
-            result = instances.get_result()
-        except ApiException as e:
-            logging.error("List VPC virtual server instances with status code{}:{}".format(str(e.code), e.message))
-            quit()
-
-        items = items + result["instances"]
-        if "next" not in result:
-            break
-        else:
-            next = dict(parse.parse_qsl(parse.urlsplit(result["next"]["href"]).query))
-            instances = vpc_service_ca_tor.list_instances(start=next["start"])
+    return populateResourceCache(all_results), resources_df
 
-    instance_cache = {}
-    for resource in items:
-        crn = resource["crn"]
-        instance_cache[crn] = resource
-
-    return instance_cache
 def getTags(resourceId):
     """
-    Check Tag Cache for Resource
+    Check Tag Index for Resource
     """
-    if resourceId not in tag_cache:
+    if resourceId not in tag_cache["crn"]:
         logging.debug("Cache miss for Tag {}".format(resourceId))
-        tags = []
-    else:
-        tags = tag_cache[resourceId]
-    return tags
+    return getTagSet(tag_cache, resourceId)
 def getInstancesUsage(start, end):
     """
     Get instances resource usage for month of specific resource_id
@@ -270,7 +59,7 @@ def getInstancesUsage(start, end):
         """
         logging.debug("Requesting resource data from resource controller for {}".format(resourceId))
         try:
-            resource_instance = resource_controller_service.get_resource_instance(
+            resource_instance = clients.resource_controller.get_resource_instance(
                 id=resourceId).get_result()
             logging.debug("resource_instance={}".format(resource_instance))
         except ApiException as e:
@@ -300,7 +89,7 @@ def getInstancesUsage(start, end):
         recordstart = 1
         """ Read first Group of records """
         try:
-            instances_usage = usage_reports_service.get_resource_usage_account(
+            instances_usage = clients.usage_reports.get_resource_usage_account(
                 account_id=accountId,
                 billingmonth=usageMonth, names=True, limit=limit).get_result()
         except ApiException as e:
@@ -433,15 +222,11 @@ def getInstancesUsage(start, end):
 
                 # get tags attached to instance from cache or resource controller
                 tags = getTags(instance["resource_instance_id"])
-                logging.debug("Instance {} tags: {}".format(instance["resource_instance_id"], tags))
+                logging.debug("Instance {} tags: {}".format(instance["resource_instance_id"], tags["tags"]))
 
-                # parse role tag into comma delimited list
-                if len(tags) > 0:
-                    role = ",".join([str(item.split(":")[1]) for item in tags if "role:" in item])
-                    audit = ",".join([str(item.split(":")[1]) for item in tags if "audit:" in item])
-                else:
-                    role = ""
-                    audit = ""
+                # role and audit are parsed once per distinct tag set
+                role = tags["role"]
+                audit = tags["audit"]
 
 
                 row_addition = {
@@ -523,7 +308,7 @@ def getInstancesUsage(start, end):
                                                                                               instances_usage["count"]))
 
                 try:
-                    instances_usage = usage_reports_service.get_resource_usage_account(
+                    instances_usage = clients.usage_reports.get_resource_usage_account(
                         account_id=accountId,
                         billingmonth=usageMonth, names=True,limit=limit, start=nextoffset).get_result()
                 except ApiException as e:
@@ -545,197 +330,6 @@ def getInstancesUsage(start, end):
                                                  "instance_role", "audit", "metric", "metric_name", "unit", "unit_name", "quantity", "cost", "rated_cost", "rateable_quantity", "estimated_days", "price", "discount"])
 
     return instancesUsage
-def getTags(resourceId):
-    """
-    Check Tag_Cache for Resource tags which may have been retrieved previously
-    """
-    global tag_cache
-    if resourceId not in tag_cache:
-        logging.debug("Cache miss for Tag {}".format(resourceId))
-        tag = []
-    else:
-        tag = tag_cache[resourceId]
-    return tag
-def getInstance(instance):
-    """
-    Check Tag_Cache for Resource tags which may have been retrieved previously
-    """
-    global instance_cache
-    if instance not in instance_cache:
-        logging.warning("Cache miss for VPC instance {}".format(instance))
-        instance_data = []
-    else:
-        instance_data = instance_cache[instance]
-    return instance_data
-def parseResources(accoutName, resources):
-    """
-    Parse Resource JSON
-    """
-
-    data = []
-    nytz = pytz.timezone('America/New_York')
-    for resource_instance in resources:
-        row = {
-            "account_id": resource_instance["account_id"],
-            "account_name": accountName,
-            "service_id": resource_instance["resource_id"],
-            "instance_id": resource_instance["id"],
-            "resource_group_id": resource_instance["resource_group_id"],
-            "region_id": resource_instance["region_id"],
-            "name": resource_instance["name"]
-        }
-
-        if "created_at" in resource_instance:
-            created_at = resource_instance["created_at"]
-            """Create Provision Date Field using US East Timezone for Zulu conversion"""
-            provisionDate = pd.to_datetime(created_at, format="%Y-%m-%dT%H:%M:%S.%f").astimezone(nytz)
-            provisionDate = provisionDate.strftime("%Y-%m-%d")
-        else:
-            created_at = ""
-            provisionDate = ""
-
-        if "updated_at" in resource_instance:
-            updated_at = resource_instance["updated_at"]
-        else:
-            updated_at = ""
-
-        if "deleted_at" in resource_instance:
-            deleted_at = resource_instance["deleted_at"]
-            """Create deProvision Date Field using US East Timezone for Zulu conversion"""
-            if deleted_at != None:
-                deprovisionDate = pd.to_datetime(deleted_at, format="%Y-%m-%dT%H:%M:%S.%f").astimezone(nytz)
-                deprovisionDate = deprovisionDate.strftime("%Y-%m-%d")
-            else:
-                deprovisionDate = ""
-        else:
-            deleted_at = ""
-            deprovisionDate = ""
-
-        if "state" in resource_instance:
-            state = resource_instance["state"]
-        else:
-            state = ""
-
-        az = ""
-        region = ""
-        profile = ""
-        cpuFamily = ""
-        numberOfVirtualCPUs = ""
-        MemorySizeMiB = ""
-        NodeName = ""
-        NumberOfGPUs = ""
-        NumberOfInstStorageDisks = ""
-        NumberofCores = ""
-        NumberofSockets = ""
-        Bandwidth = ""
-        LifecycleAction = ""
-        Capacity = ""
-        IOPS = ""
-
-        if "extensions" in resource_instance:
-            if "VirtualMachineProperties" in resource_instance["extensions"]:
-                profile = resource_instance["extensions"]["VirtualMachineProperties"]["Profile"]
-                cpuFamily = resource_instance["extensions"]["VirtualMachineProperties"]["CPUFamily"]
-                numberOfVirtualCPUs = resource_instance["extensions"]["VirtualMachineProperties"]["NumberOfVirtualCPUs"]
-                MemorySizeMiB = resource_instance["extensions"]["VirtualMachineProperties"]["MemorySizeMiB"]
-                NodeName = resource_instance["extensions"]["VirtualMachineProperties"]["NodeName"]
-                NumberOfGPUs = resource_instance["extensions"]["VirtualMachineProperties"]["NumberOfGPUs"]
-                NumberOfInstStorageDisks = resource_instance["extensions"]["VirtualMachineProperties"][
-                    "NumberOfInstStorageDisks"]
-
-            elif "BMServerProperties" in resource_instance["extensions"]:
-                profile = resource_instance["extensions"]["BMServerProperties"]["Profile"]
-                MemorySizeMiB = resource_instance["extensions"]["BMServerProperties"]["MemorySizeMiB"]
-                NodeName = resource_instance["extensions"]["BMServerProperties"]["NodeName"]
-                NumberofCores = resource_instance["extensions"]["BMServerProperties"]["NumberOfCores"]
-                NumberofSockets = resource_instance["extensions"]["BMServerProperties"]["NumberOfSockets"]
-                Bandwidth = resource_instance["extensions"]["BMServerProperties"]["Bandwidth"]
-
-            elif "VolumeInfo" in resource_instance["extensions"]:
-                Capacity = resource_instance["extensions"]["VolumeInfo"]["Capacity"]
-                IOPS = resource_instance["extensions"]["VolumeInfo"]["IOPS"]
-
-            if "Resource" in resource_instance["extensions"]:
-                if "AvailabilityZone" in resource_instance["extensions"]["Resource"]:
-                    az = resource_instance["extensions"]["Resource"]["AvailabilityZone"]
-                if "Location" in resource_instance["extensions"]["Resource"]:
-                    region = resource_instance["extensions"]["Resource"]["Location"]["Region"]
-                if "LifecycleAction" in resource_instance["extensions"]["Resource"]:
-                    LifecycleAction = resource_instance["extensions"]["Resource"]["LifecycleAction"]
-
-        # Lookup instance related detail
-        numa_count = ""
-        boot_volume_attachment = ""
-        primary_network_interface_primary_ip = ""
-        primary_network_interface_subnet = ""
-        vpc= ""
-        if resource_instance["resource_id"] == "is.instance":
-            """ Check Cache """
-            instance = getInstance(resource_instance["id"])
-            if "numa_count" in instance:
-                numa_count = instance["numa_count"]
-            if "boot_volume_attachment" in instance:
-                boot_volume_attachment = instance["boot_volume_attachment"]["name"]
-            if "primary_network_interface" in instance:
-                primary_network_interface_primary_ip = instance["primary_network_interface"]["primary_ip"]["address"]
-                primary_network_interface_subnet = instance["primary_network_interface"]["subnet"]["name"]
-            if "vpc" in instance:
-                vpc = instance["vpc"]["name"]
-
-        # get tags attached to instance from cache or resource controller
-        tags = getTags(resource_instance["id"])
-        # parse role tag into comma delimited list
-        if len(tags) > 0:
-            role = ",".join([str(item.split(":")[1]) for item in tags if "role:" in item])
-            audit = ",".join([str(item.split(":")[1]) for item in tags if "audit:" in item])
-        else:
-            role = ""
-            audit = ""
-
-        row_addition = {
-            "provision_date": provisionDate,
-            "deprovision_date": deprovisionDate,
-            "instance_created_at": created_at,
-            "instance_updated_at": updated_at,
-            "instance_deleted_at": deleted_at,
-            "instance_state": state,
-            "instance_profile": profile,
-            "cpu_family": cpuFamily,
-            "numa_count": numa_count,
-            "boot_volume_attachment": boot_volume_attachment,
-            "primary_network_interface_primary_ip": primary_network_interface_primary_ip,
-            "primary_network_interface_subnet": primary_network_interface_subnet,
-            "vpc": vpc,
-            "numberOfVirtualCPUs": numberOfVirtualCPUs,
-            "MemorySizeMiB": MemorySizeMiB,
-            "NodeName": NodeName,
-            "NumberOfGPUs": NumberOfGPUs,
-            "NumberOfInstStorageDisks": NumberOfInstStorageDisks,
-            "instance_role": role,
-            "audit": audit,
-            "availability_zone": az,
-            "region": region,
-            "lifecycleAction": LifecycleAction,
-            "BMnumberofCores": NumberofCores,
-            "BMnumberofSockets": NumberofSockets,
-            "BMbandwidth": Bandwidth,
-            "capacity": Capacity,
-            "iops": IOPS
-        }
-
-        # combine original row with additions
-
-        row = row | row_addition
-        data.append(row.copy())
-
-
-    resourceDetail = pd.DataFrame(data, columns=['account_id', "account_name", "service_id", "instance_id", "name", "resource_group_id", "region_id",
-                                                 "provision_date", "deprovision_date", "instance_created_at", "instance_updated_at", "instance_deleted_at",
-                                                 "instance_state", "lifecycleAction",  "instance_profile", "cpu_family", "numa_count", "boot_volume_attachment", "primary_network_interface_subnet",
-                                                 "primary_network_interface_primary_ip", "vpc", "numberOfVirtualCPUs", "MemorySizeMiB", "NodeName", "NumberOfGPUs",
-                                                 "NumberOfInstStorageDisks", "region", "availability_zone", "BMnumberofCores", "BMnumberofSockets", "BMbandwidth", "capacity", "iops",
-                                                 "instance_role", "audit"])
-    return resourceDetail
 def createMissingCRNTab(paasUsage):
     """
     Write Service Usage detail tab to excel
@@ -778,52 +372,6 @@ def createResourceControllerTab(resources):
     totalrows,totalcols=resources.shape
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
-def writeFiletoCos(localfile, upload):
-    """"
-    Write Files to COS
-    """
-
-    def multi_part_upload(bucket_name, item_name, file_path):
-        """"
-        Write Files to COS
-        """
-        try:
-            logging.info("Starting file transfer for {0} to bucket: {1}".format(item_name, bucket_name))
-            # set 5 MB chunks
-            part_size = 1024 * 1024 * 5
-
-            # set threadhold to 15 MB
-            file_threshold = 1024 * 1024 * 15
-
-            # set the transfer threshold and chunk size
-            transfer_config = ibm_boto3.s3.transfer.TransferConfig(
-                multipart_threshold=file_threshold,
-                multipart_chunksize=part_size
-            )
-
-            # the upload_fileobj method will automatically execute a multi-part upload
-            # in 5 MB chunks for all files over 15 MB
-            with open(file_path, "rb") as file_data:
-                cos.Object(bucket_name, item_name).upload_fileobj(
-                    Fileobj=file_data,
-                    Config=transfer_config
-                )
-            logging.info("Transfer for {0} complete".format(item_name))
-        except ClientError as be:
-            logging.error("CLIENT ERROR: {0}".format(be))
-        except Exception as e:
-            logging.error("Unable to complete multi-part upload: {0}".format(e))
-        return
-
-    cos = ibm_boto3.resource("s3",
-                             ibm_api_key_id=args.COS_APIKEY,
-                             ibm_service_instance_id=args.COS_INSTANCE_CRN,
-                             config=Config(signature_version="oauth"),
-                             endpoint_url=args.COS_ENDPOINT
-                             )
-    multi_part_upload(args.COS_BUCKET, upload, "./" + localfile)
-    return
-
 if __name__ == "__main__":
     setup_logging()
     load_dotenv()
@@ -844,8 +392,15 @@ if __name__ == "__main__":
                         help="COS Instance CRN to use to write output to Object Storage.")
     parser.add_argument("--COS_BUCKET", default=os.environ.get('COS_BUCKET', None),
                         help="COS Bucket name to use to write output to Object Storage.")
+    parser.add_argument("--importtime", action=argparse.BooleanOptionalAction, help="Log time taken by imports at startup.")
     args = parser.parse_args()
 
+    with importTimer("pandas"):
+        import pandas as pd
+        import numpy as np
+    if args.importtime:
+        logImportTimes()
+
     if args.debug:
         log = logging.getLogger()
         log.handlers[0].setLevel(logging.DEBUG)
@@ -883,18 +438,21 @@ if __name__ == "__main__":
             tags_df = pd.DataFrame()
 
         if not args.load:
+            with importTimer("ibm_cloud_sdk_core"):
+                from ibm_cloud_sdk_core import ApiException
             for account in APIKEYS:
                 if "apikey" in account:
                     apikey = account["apikey"]
-                    createSDK(apikey)
-                    accountId = getAccountId(apikey)
+                    clients = ClientFactory(apikey)
+                    accountId = clients.getAccountId()
                     if "name" in account:
                         accountName = account["name"]
 
                         """ Get all Tag Data to match to resources and usage data """
                         logging.info("Caching Tag Data for {} AccountId: {}.".format(accountName, accountId))
-                        tag_cache, df = populateTagCache()
-                        tags_df = pd.concat([tags_df, df])
+                        items = searchTags(clients)
+                        tag_cache = buildTagIndex(items)
+                        tags_df = pd.concat([tags_df, pd.DataFrame.from_dict(items)])
 
                         """ Get all resource controller instances for account """
                         logging.info("Caching Current Controller Data for {} AccountId: {}.".format(accountName, accountId))
@@ -913,6 +471,8 @@ if __name__ == "__main__":
 
         """ Check for missing billing records """
         logging.info("Searching for missing billing records for all accounts.")
+        """ Index tags for all accounts by CRN rather than searching tags_df for each missing record """
+        all_tags = buildTagIndex(tags_df.to_dict("records"))
         missing = pd.DataFrame()
         for index, record in resources_df.iterrows():
             if "resource_id" in record:
@@ -936,12 +496,7 @@ if __name__ == "__main__":
                         """ Check if server is missing in this months usage data """
                         servers = citiUsage.query('instance_id == @id and month == @usageMonth')
                         if servers["instance_id"].count() == 0:
-                            tags = tags_df.query('crn == @id')
-                            if tags["tags"].count() != 0:
-                                tag = tags.iloc[0]["tags"]
-                                role = ",".join([str(item.split(":")[1]) for item in tag if "role:" in item])
-                            else:
-                                role = ""
+                            role = getTagSet(all_tags, id)["role"]
                             newrow = record.to_dict()
                             newrow["role"] = role
                             newrow["month"] = usageMonth
@@ -976,6 +531,6 @@ if __name__ == "__main__":
     if args.cos:
         """ Write output to COS"""
         logging.info("Writing Pivot Tables to COS.")
-        writeFiletoCos(file_name + ".xlsx", file_name + timestamp + ".xlsx")
+        writeFiletoCos(file_name + ".xlsx", file_name + timestamp + ".xlsx", args.COS_APIKEY, args.COS_INSTANCE_CRN, args.COS_ENDPOINT, args.COS_BUCKET)
 
     logging.info("Current non billed server report is complete.")
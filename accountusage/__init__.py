@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Shared core of the account usage report scripts.
+
+    clients    Client factory creating IBM Cloud SDK clients for an API key on first use
+    tokens     IAM token manager sharing and caching tokens and account ids of API keys
+    cache      Tag, VPC instance and resource controller caches populated from those clients
+    tags       Compact tag index used as the tag cache
+    resources  Resource normalizer turning resource controller records into server detail
+    cos        Upload of report output to Cloud Object Storage
+    service    Long running service serving report views over local HTTP
+    shards     File based work queue and partitioned output of sharded runs
+    checkpoint Checkpoint of collection progress for resuming failed runs
+    appconf    Validation and hash keyed cache of the application configuration (apps.yaml)
+    schema     Typed columns of the account usage and instance usage tables
+    aggregates Account usage aggregated by account, month, resource, plan and metric
+    prices     Price tier table of the price lists of usage, referenced by price_id
+    anomalies  Month over month anomalies of account usage against rolling baselines
+    forecast   Month end and next quarter cost forecasts of each account and service
+    snapshots  Store of month to date usage snapshots and their burn rate projection
+    intervals  Interval arithmetic of instance lifetimes, billable days of servers in their usage month
+    predicates Filters compiled to cached boolean masks over indexed columns, replacing DataFrame.query strings
+    metrics    Wall time, CPU, memory and API call metrics of each stage of a run
+    profiling  Opt-in sampling, cProfile and tracemalloc profiling of selected stages
+    logs       Logging configuration
+    startup    Timing of deferred imports at startup
+
+Modules are imported by the scripts individually and import their SDKs lazily, so a script that
+never touches VPC or COS never imports ibm_vpc or ibm_boto3.
+"""
+
+__author__ = 'jonhall'
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Materialized aggregate of account usage.
+
+Account usage is summed by account, month, resource, plan and metric as each account's month is
+ingested, so the summary, true-up and reconciliation tabs read one row per service metric instead
+of rescanning the account usage rows.  The aggregate is kept per account and month; updating it with
+usage of an account and month already aggregated replaces that month's rows rather than adding to them.
+"""
+
+__author__ = 'jonhall'
+import pandas as pd
+from accountusage.schema import ACCOUNT_USAGE_SCHEMA, concatFrames
+
+""" Names are grouped with their ids so tabs can group by either """
+AGGREGATE_KEYS = ["account_id", "account_name", "month", "resource_id", "resource_name", "plan_id", "plan_name", "metric"]
+AGGREGATE_VALUES = ["quantity", "rateable_quantity", "cost", "rated_cost", "billable_charges", "billable_rated_charges"]
+AGGREGATE_SCHEMA = {column: ACCOUNT_USAGE_SCHEMA[column] for column in AGGREGATE_KEYS + AGGREGATE_VALUES}
+
+
+class UsageAggregate:
+    def __init__(self):
+        """
+        Constructor Method
+        """
+        self.units = {}
+        self.table = None
+
+    def update(self, accountUsage):
+        """
+        Aggregate account usage, replacing the aggregate of any account and month already aggregated
+        :param accountUsage: typed account usage dataframe of one or more accounts and months
+        """
+        """ Group on category codes, pandas drops rows with a missing category from groups even with dropna=False """
+        codes = [accountUsage[column].cat.codes.rename(column) for column in AGGREGATE_KEYS]
+        sums = accountUsage[AGGREGATE_VALUES].groupby(codes, sort=False).sum()
+        columns = {column: pd.Categorical.from_codes(sums.index.get_level_values(column), dtype=accountUsage[column].dtype) for column in AGGREGATE_KEYS}
+        columns.update({column: sums[column].to_numpy() for column in AGGREGATE_VALUES})
+        grouped = pd.DataFrame(columns)
+        for unit, rows in grouped.groupby(["account_id", "month"], sort=False, observed=True):
+            self.units[unit] = rows
+        self.table = None
+        return
+
+    def frame(self):
+        """
+        Aggregate of all accounts and months ingested
+        :return: typed dataframe with the columns of AGGREGATE_SCHEMA
+        """
+        if self.table is None:
+            self.table = concatFrames(self.units.values(), AGGREGATE_SCHEMA).reset_index(drop=True)
+        return self.table
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Month over month anomalies of account usage.
+
+Cost of each account, resource and metric is laid out as a matrix of a row per series and a column per month,
+months without usage being 0.  The baseline of each month is the mean and standard deviation of the months
+before it in a rolling window, calculated for every series at once over windows of the matrix, and months whose
+cost is more than a threshold of standard deviations from the baseline are anomalies.
+
+Baselines need the months before the months reported, so the usage aggregate of every run is kept in a
+usage history file and the months of earlier runs are used as history of later ones.
+"""
+
+__author__ = 'jonhall'
+import os, logging
+import numpy as np
+import pandas as pd
+
+""" Usage is summed over plans to a series per account, resource and metric """
+SERIES_KEYS = ["account_id", "account_name", "resource_id", "resource_name", "metric"]
+
+""" Default months of the rolling baseline, months of history required and standard deviations of an anomaly """
+WINDOW = 6
+MIN_PERIODS = 3
+THRESHOLD = 3.0
+""" Changes in cost smaller than this are not anomalies however far from the baseline """
+MINIMUM_CHANGE = 100.0
+
+
+def usageSeries(usageAggregate, columns):
+    """
+    Matrices of values of each account, resource and metric for every month from the first to the last month of usage
+    :param usageAggregate: typed dataframe of account usage aggregated by account, month, resource, plan and metric
+    :param columns: values to sum (ie cost)
+    :return: dataframe of SERIES_KEYS of each series, list of months (YYYY-MM), series x months array of each column
+    """
+    if len(usageAggregate) == 0:
+        return pd.DataFrame(columns=SERIES_KEYS), [], [np.zeros((0, 0)) for column in columns]
+    """ Group on category codes, missing names are kept as their own series """
+    codes = pd.DataFrame({key: usageAggregate[key].cat.codes.to_numpy() for key in SERIES_KEYS})
+    series = codes.groupby(SERIES_KEYS, sort=False).ngroup().to_numpy()
+    keys = usageAggregate[SERIES_KEYS].iloc[codes.drop_duplicates().index].reset_index(drop=True)
+
+    used = usageAggregate["month"].astype(str)
+    months = list(pd.period_range(used.min(), used.max(), freq="M").strftime("%Y-%m"))
+    month = pd.Index(months).get_indexer(used)
+    cells = series * len(months) + month
+    values = [np.bincount(cells, weights=usageAggregate[column].to_numpy(dtype=float), minlength=len(keys) * len(months)).reshape(len(keys), len(months))
+              for column in columns]
+    return keys, months, values
+
+
+def rollingBaseline(values, window=WINDOW, minPeriods=MIN_PERIODS):
+    """
+    Mean and standard deviation of the months before each month, over a rolling window
+    :param values: series x months array
+    :param window: months of the baseline
+    :param minPeriods: months before a month required for a baseline
+    :return: mean, standard deviation and months of the baseline of each series and month, nan without a baseline
+    """
+    series, months = values.shape
+    """ Windows of the months before each month, months before the first month are nan """
+    padded = np.concatenate([np.full((series, window), np.nan), values], axis=1)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=1)[:, :months]
+    count = np.count_nonzero(~np.isnan(windows), axis=2)
+    mean = np.divide(np.nansum(windows, axis=2), count, out=np.full(values.shape, np.nan), where=count > 0)
+    squares = np.nansum((windows - mean[:, :, None]) ** 2, axis=2)
+    std = np.sqrt(np.divide(squares, count - 1, out=np.full(values.shape, np.nan), where=count > 1))
+    unknown = count < minPeriods
+    mean[unknown] = np.nan
+    std[unknown] = np.nan
+    return mean, std, count
+
+
+def detectAnomalies(usageAggregate, months=None, window=WINDOW, minPeriods=MIN_PERIODS, threshold=THRESHOLD, minimumChange=MINIMUM_CHANGE):
+    """
+    Flag the cost of each account, resource and metric in months outside its rolling baseline
+    :param usageAggregate: typed dataframe of account usage aggregated by account, month, resource, plan and metric
+    :param months: months to flag (YYYY-MM), all months of usage if None; earlier months of usage are used as history
+    :param window: months of the baseline
+    :param minPeriods: months of history required before a month is flagged
+    :param threshold: standard deviations from the baseline mean of an anomaly
+    :param minimumChange: change in cost from the baseline mean required of an anomaly
+    :return: dataframe of each anomaly with the cost, quantity and baseline of the series and month, largest first
+    """
+    keys, history, (cost, quantity) = usageSeries(usageAggregate, ["cost", "rateable_quantity"])
+    mean, std, count = rollingBaseline(cost, window, minPeriods)
+    change = cost - mean
+    """ A baseline that never changed makes any change infinitely far from it """
+    score = np.divide(change, std, out=np.where(change == 0, 0.0, np.sign(change) * np.inf), where=std > 0)
+    flagged = ~np.isnan(mean) & (np.abs(score) >= threshold) & (np.abs(change) >= minimumChange)
+    if months is not None:
+        flagged &= np.isin(history, months)[None, :]
+
+    series, month = np.nonzero(flagged)
+    """ Latest month first, largest change first within a month """
+    order = np.lexsort((-np.abs(change[series, month]), -month))
+    series, month = series[order], month[order]
+    anomalies = keys.iloc[series].reset_index(drop=True)
+    anomalies.insert(0, "month", np.array(history, dtype=object)[month])
+    anomalies = anomalies.assign(rateable_quantity=quantity[series, month], cost=cost[series, month], baseline_cost=mean[series, month],
+                                 baseline_std=std[series, month], baseline_months=count[series, month], change=change[series, month],
+                                 score=score[series, month], anomaly=np.where(change[series, month] > 0, "spike", "drop"))
+    return anomalies
+
+
+def loadUsageHistory(filename):
+    """
+    Load usage history of earlier runs
+    :param filename: pkl file of usage history
+    :return: typed dataframe of account usage aggregated by account, month, resource, plan and metric, None if there is no history
+    """
+    if not os.path.exists(filename):
+        logging.info("No usage history {} found, anomalies are flagged from the months collected only.".format(filename))
+        return None
+    try:
+        return pd.read_pickle(filename)
+    except Exception as e:
+        logging.warning("Ignoring unreadable usage history {}: {}.".format(filename, str(e)))
+        return None
+
+
+def saveUsageHistory(filename, usageHistory):
+    """
+    Atomically replace usage history with the aggregate of earlier runs and this run
+    """
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    usageHistory.to_pickle(tmp)
+    os.replace(tmp, filename)
+    return
+
+
+def historyMonths(usageAggregate, month):
+    """
+    Number of months of usage before month
+    """
+    used = usageAggregate["month"].astype(str).unique()
+    return int(np.count_nonzero(used < month))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Validated application configuration (apps.yaml) of the contract charges.
+
+The configuration is parsed with the LibYAML loader when PyYAML was built with it, and validated against the
+structure the contract charge tabs expect: every application, component, charge and region rate is checked and every
+problem is reported at once with its location, so a typo in a charge type fails at startup before any usage is
+collected.  Optional charge fields are filled with their defaults.
+
+The validated configuration is cached compiled (pickled) under the SHA-256 hash of the file, so an unchanged file is
+loaded without parsing or validating it again.  The cache directory defaults to ~/.accountusage/conf and is set with
+the CONF_CACHE environment variable (an empty value disables the cache).
+"""
+
+__author__ = 'jonhall'
+import os, hashlib, logging, numbers, pickle, yaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+CONF_CACHE = os.environ.get("CONF_CACHE", os.path.join(os.path.expanduser("~"), ".accountusage", "conf"))
+
+""" Changing the validation or the compiled form changes the version, so configurations cached before are validated again """
+CONF_VERSION = 1
+
+COMPONENT_TYPES = ["per_account", "per_region", "per_az", "per_az_per_app", "per_node", "per_service_instance"]
+CHARGE_TYPES = ["monthly", "daily"]
+""" Daily charges are priced on the billable days of each node """
+DAILY_COMPONENT_TYPES = ["per_node"]
+
+""" Required and optional keys of each level, optional charge keys with their default """
+APPLICATION_KEYS = {"name", "tab", "account", "components"}
+APPLICATION_OPTIONAL = {"allocation"}
+COMPONENT_KEYS = {"name", "type", "charge"}
+CHARGE_KEYS = {"name", "role", "type", "region"}
+CHARGE_DEFAULTS = {"profile": "", "service": "", "metric": ""}
+REGION_KEYS = {"name", "contract_rate"}
+
+""" Excel sheet names are limited to 31 characters without any of these """
+TAB_LENGTH = 31
+TAB_CHARACTERS = set("[]:*?/\\")
+
+
+def checkKeys(entry, required, optional, location, errors):
+    """
+    Check a mapping has the required keys and no others
+    :param entry: mapping to check
+    :param required: set of required keys
+    :param optional: set of optional keys
+    :param location: description of the entry in error messages
+    :param errors: list errors are appended to
+    :return: True if entry is a mapping
+    """
+    if not isinstance(entry, dict):
+        errors.append("{}: expected a mapping of {}, found {!r}.".format(location, ", ".join(sorted(required)), entry))
+        return False
+    for key in sorted(required - set(entry)):
+        errors.append("{}: {} is required.".format(location, key))
+    for key in sorted(set(entry) - required - optional):
+        errors.append("{}: unknown key {}.".format(location, key))
+    return True
+
+
+def checkList(entry, key, location, errors):
+    """
+    Entries of a required non empty list
+    :return: list of entries, empty if missing or not a list
+    """
+    values = entry.get(key)
+    if key in entry and (not isinstance(values, list) or len(values) == 0):
+        errors.append("{}: {} must be a non empty list.".format(location, key))
+    return values if isinstance(values, list) else []
+
+
+def checkString(entry, key, location, errors):
+    if key in entry and (not isinstance(entry[key], str) or entry[key] == ""):
+        errors.append("{}: {} must be a non empty string, found {!r}.".format(location, key, entry[key]))
+    return
+
+
+def checkChoice(entry, key, choices, location, errors):
+    if key in entry and entry[key] not in choices:
+        errors.append("{}: {} {!r} must be one of {}.".format(location, key, entry[key], ", ".join(choices)))
+    return
+
+
+def checkNumber(entry, key, location, errors):
+    value = entry.get(key)
+    if key in entry and (isinstance(value, bool) or not isinstance(value, numbers.Real) or value < 0):
+        errors.append("{}: {} must be a number of 0 or more, found {!r}.".format(location, key, value))
+    return
+
+
+def validateAppConf(applications):
+    """
+    Validate an application configuration
+    :param applications: application configuration as parsed from apps.yaml
+    :return: list of errors, each with the location of the problem, empty if the configuration is valid
+    """
+    errors = []
+    if not isinstance(applications, list) or len(applications) == 0:
+        return ["expected a non empty list of applications."]
+    names = set()
+    tabs = set()
+    for appIndex, application in enumerate(applications):
+        location = "application {}".format(application.get("name", appIndex + 1) if isinstance(application, dict) else appIndex + 1)
+        if not checkKeys(application, APPLICATION_KEYS, APPLICATION_OPTIONAL, location, errors):
+            continue
+        for key in ["name", "tab", "account"]:
+            checkString(application, key, location, errors)
+        checkNumber(application, "allocation", location, errors)
+        if isinstance(application.get("name"), str):
+            if application["name"] in names:
+                errors.append("{}: name is not unique.".format(location))
+            names.add(application["name"])
+        tab = application.get("tab")
+        if isinstance(tab, str):
+            if len(tab) > TAB_LENGTH or TAB_CHARACTERS & set(tab):
+                errors.append("{}: tab {!r} must be at most {} characters without any of {}.".format(location, tab, TAB_LENGTH, "".join(sorted(TAB_CHARACTERS))))
+            if tab.lower() in tabs:
+                errors.append("{}: tab {!r} is not unique.".format(location, tab))
+            tabs.add(tab.lower())
+
+        for componentIndex, component in enumerate(checkList(application, "components", location, errors)):
+            componentLocation = "{} component {}".format(location, component.get("name", componentIndex + 1) if isinstance(component, dict) else componentIndex + 1)
+            if not checkKeys(component, COMPONENT_KEYS, set(), componentLocation, errors):
+                continue
+            checkString(component, "name", componentLocation, errors)
+            checkChoice(component, "type", COMPONENT_TYPES, componentLocation, errors)
+
+            for chargeIndex, charge in enumerate(checkList(component, "charge", componentLocation, errors)):
+                chargeLocation = "{} charge {}".format(componentLocation, charge.get("name", chargeIndex + 1) if isinstance(charge, dict) else chargeIndex + 1)
+                if not checkKeys(charge, CHARGE_KEYS, set(CHARGE_DEFAULTS), chargeLocation, errors):
+                    continue
+                for key in ["name", "role"] + list(CHARGE_DEFAULTS):
+                    checkString(charge, key, chargeLocation, errors)
+                checkChoice(charge, "type", CHARGE_TYPES, chargeLocation, errors)
+                if charge.get("type") == "daily" and component.get("type") in COMPONENT_TYPES and component["type"] not in DAILY_COMPONENT_TYPES:
+                    errors.append("{}: daily charges are only priced for {} components.".format(chargeLocation, ", ".join(DAILY_COMPONENT_TYPES)))
+                if component.get("type") == "per_service_instance":
+                    for key in ["service", "metric"]:
+                        if key not in charge:
+                            errors.append("{}: {} is required of per_service_instance charges.".format(chargeLocation, key))
+
+                regions = checkList(charge, "region", chargeLocation, errors)
+                for regionIndex, region in enumerate(regions):
+                    regionLocation = "{} region {}".format(chargeLocation, region.get("name", regionIndex + 1) if isinstance(region, dict) else regionIndex + 1)
+                    if checkKeys(region, REGION_KEYS, set(), regionLocation, errors):
+                        checkString(region, "name", regionLocation, errors)
+                        checkNumber(region, "contract_rate", regionLocation, errors)
+                """ Per account charges are priced at the rate of region any """
+                if component.get("type") == "per_account" and regions and "any" not in [region.get("name") for region in regions if isinstance(region, dict)]:
+                    errors.append("{}: per_account charges require a contract_rate for region any.".format(chargeLocation))
+    return errors
+
+
+def compileAppConf(applications):
+    """
+    Fill the defaults of optional charge fields of a validated application configuration
+    :param applications: validated application configuration
+    :return: application configuration
+    """
+    for application in applications:
+        for component in application["components"]:
+            for charge in component["charge"]:
+                for key, default in CHARGE_DEFAULTS.items():
+                    charge.setdefault(key, default)
+    return applications
+
+
+def cacheFilename(directory, text):
+    """
+    Filename of the compiled configuration of the text of a configuration file
+    """
+    digest = hashlib.sha256("{}:".format(CONF_VERSION).encode() + text).hexdigest()
+    return os.path.join(directory, digest + ".pkl")
+
+
+def readCachedConf(filename):
+    """
+    Read a compiled configuration from the cache
+    :return: application configuration, None if not cached or unreadable
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logging.warning("Ignoring unreadable configuration cache {}: {}.".format(filename, str(e)))
+        return None
+
+
+def writeCachedConf(filename, applications):
+    """
+    Atomically write a compiled configuration to the cache, readable only by the current user
+    """
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), mode=0o700, exist_ok=True)
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            pickle.dump(applications, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    except OSError as e:
+        logging.warning("Unable to write configuration cache {}: {}.".format(filename, str(e)))
+    return
+
+
+def loadAppConf(filename, cache=CONF_CACHE):
+    """
+    Load, validate and compile an application configuration, from the cache if the file is unchanged
+    :param filename: filename of application configuration in YAML format (apps.yaml)
+    :param cache: directory of compiled configurations, None or empty to always parse and validate the file
+    :return: application configuration, a list of applications
+    """
+    try:
+        with open(filename, "rb") as f:
+            text = f.read()
+    except OSError as e:
+        logging.error("Unable to read application configuration {}: {}.".format(filename, str(e)))
+        quit(1)
+
+    cached = cacheFilename(cache, text) if cache else None
+    if cached is not None:
+        applications = readCachedConf(cached)
+        if applications is not None:
+            logging.debug("Application configuration {} loaded from {}.".format(filename, cached))
+            return applications
+
+    try:
+        applications = yaml.load(text, Loader=YamlLoader)
+    except yaml.YAMLError as e:
+        logging.error("Unable to parse application configuration {}: {}.".format(filename, str(e)))
+        quit(1)
+    errors = validateAppConf(applications)
+    if errors:
+        for error in errors:
+            logging.error("{}: {}".format(filename, error))
+        logging.error("Application configuration {} has {} errors.  Unable to generate billing data.".format(filename, len(errors)))
+        quit(1)
+    applications = compileAppConf(applications)
+    if cached is not None:
+        writeCachedConf(cached, applications)
+    return applications
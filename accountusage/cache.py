@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Caches of account data populated once per account and shared by the report parsers.
+SDK modules are imported by the functions calling them.
+
+    tag cache       tag index of CRN to tag set from global search, updatable for a list of CRNs
+    instance cache  dictionary of CRN to VPC virtual or bare metal server from each VPC region
+    resource cache  dictionary of CRN to resource controller instance
+"""
+
+__author__ = 'jonhall'
+import logging
+from urllib import parse
+from accountusage.clients import VPC_REGIONS
+from accountusage.tags import buildTagIndex, addTags, removeTags
+
+""" Largest page size accepted by global search """
+SEARCH_PAGE_LIMIT = 1000
+
+""" Largest page size accepted by resource controller """
+RESOURCE_PAGE_LIMIT = 100
+
+""" CRNs per global search query when updating tags of changed resources """
+SEARCH_CRN_BATCH = 50
+
+
+def searchTags(clients, query='tags:*'):
+    """
+    Get tags of all tagged resources in account from global search
+    :param clients: ClientFactory for account
+    :param query: global search query of resources, default all tagged resources
+    :return: list of search items with crn and tags
+    """
+    from ibm_cloud_sdk_core import ApiException
+    search_cursor = None
+    items = []
+    while True:
+        try:
+            response = clients.global_search.search(query=query,
+                                                    search_cursor=search_cursor,
+                                                    fields=["tags"],
+                                                    limit=SEARCH_PAGE_LIMIT)
+        except ApiException as e:
+            logging.error("API exception {}.".format(str(e)))
+            quit(1)
+
+        scan_result = response.get_result()
+
+        items.extend(scan_result["items"])
+        if "search_cursor" not in scan_result:
+            break
+        else:
+            search_cursor = scan_result["search_cursor"]
+    return items
+
+
+def populateTagCache(clients):
+    """
+    Populate Tagging data into cache
+    :param clients: ClientFactory for account
+    :return: tag index
+    """
+    return buildTagIndex(searchTags(clients))
+
+
+def updateTagCache(clients, tag_index, crns):
+    """
+    Update tags of changed resources in tag cache, searching only their CRNs
+    Tags attached or detached without any other change to a resource do not change its updated_at,
+    so they are only picked up by the next populateTagCache.
+    :param clients: ClientFactory for account
+    :param tag_index: tag index to update
+    :param crns: list of CRNs of changed resources
+    :return: number of resources with tags
+    """
+    tagged = 0
+    for start in range(0, len(crns), SEARCH_CRN_BATCH):
+        batch = crns[start:start + SEARCH_CRN_BATCH]
+        query = " OR ".join('crn:"{}"'.format(crn) for crn in batch)
+        found = {item["crn"]: item.get("tags", []) for item in searchTags(clients, query)}
+        for crn in batch:
+            """ A changed resource missing from the results has no tags left """
+            if found.get(crn):
+                addTags(tag_index, crn, found[crn])
+                tagged = tagged + 1
+            else:
+                removeTags(tag_index, crn)
+    return tagged
+
+
+def listVPCResources(list_method, key):
+    """
+    Page through a VPC list method
+    :param list_method: VPC client method (ie list_instances)
+    :param key: key of items in result
+    :return: list of items
+    """
+    from ibm_cloud_sdk_core import ApiException
+    items = []
+    start = None
+    while True:
+        try:
+            if start is None:
+                result = list_method().get_result()
+            else:
+                result = list_method(start=start).get_result()
+        except ApiException as e:
+            logging.error("List VPC {} with status code{}:{}".format(key, str(e.code), e.message))
+            quit(1)
+
+        items.extend(result[key])
+        if "next" not in result:
+            break
+        else:
+            next = dict(parse.parse_qsl(parse.urlsplit(result["next"]["href"]).query))
+            start = next["start"]
+    return items
+
+
+def populateVPCInstanceCache(clients, regions=VPC_REGIONS, bare_metal=True):
+    """
+    Get VPC instance information and create cache from each VPC regional endpoint
+    :param clients: ClientFactory for account
+    :param regions: VPC regions to search
+    :param bare_metal: include bare metal servers
+    :return: dictionary of CRN to VPC instance
+    """
+    instance_cache = {}
+    for region in regions:
+        endpoint = clients.vpc(region)
+        """ Get virtual servers """
+        for resource in listVPCResources(endpoint.list_instances, "instances"):
+            instance_cache[resource["crn"]] = resource
+        """ Get Bare Metal"""
+        if bare_metal:
+            for resource in listVPCResources(endpoint.list_bare_metal_servers, "bare_metal_servers"):
+                instance_cache[resource["crn"]] = resource
+    return instance_cache
+
+
+def updateVPCInstanceCache(clients, instance_cache, resources):
+    """
+    Add VPC servers missing from instance cache, retrieving each from its regional endpoint
+    :param clients: ClientFactory for account
+    :param instance_cache: VPC instance cache to update
+    :param resources: resource controller instances of VPC virtual or bare metal servers
+    :return: number of servers added
+    """
+    from ibm_cloud_sdk_core import ApiException
+    added = 0
+    for resource in resources:
+        crn = resource["crn"]
+        if crn in instance_cache:
+            continue
+        """ CRN location is the zone of the server (ie us-south-1), and the last segment its VPC id """
+        region = crn.split(":")[5].rsplit("-", 1)[0]
+        endpoint = clients.vpc(region)
+        if resource["resource_id"] == "is.bare-metal-server":
+            get_method = endpoint.get_bare_metal_server
+        else:
+            get_method = endpoint.get_instance
+        try:
+            instance_cache[crn] = get_method(id=crn.split(":")[-1]).get_result()
+            added = added + 1
+        except ApiException as e:
+            logging.warning("Get VPC server {} with status code {}:{}".format(crn, str(e.code), e.message))
+    return added
+
+
+def listAllResourceInstances(clients, resource_id=None, updated_from=None, state=None):
+    """
+    Retrieve all Resources for account from resource controller
+    :param clients: ClientFactory for account
+    :param resource_id: only retrieve resources of resource_id (ie is.instance), None for all resources
+    :param updated_from: only retrieve resources updated since this UTC timestamp (ie 2023-06-01T00:00:00Z)
+    :param state: only retrieve resources in state (ie removed), None for the default of active resources
+    :return: list of resource instances
+    """
+    from ibm_cloud_sdk_core import ApiException
+    from ibm_platform_services.resource_controller_v2 import ResourceInstancesPager
+    all_results = []
+    filters = {"resource_id": resource_id, "updated_from": updated_from, "state": state}
+    pager = ResourceInstancesPager(client=clients.resource_controller, limit=RESOURCE_PAGE_LIMIT,
+                                   **{key: value for key, value in filters.items() if value is not None})
+
+    try:
+        while pager.has_next():
+            next_page = pager.get_next()
+            assert next_page is not None
+            all_results.extend(next_page)
+    except ApiException as e:
+        logging.error(
+            "API Error.  Can not retrieve instances of type {} {}: {}".format(resource_id, str(e.code), e.message))
+        quit(1)
+    return all_results
+
+
+def populateResourceCache(resources):
+    """
+    Create resource cache from resource controller instances
+    :param resources: list of resource instances
+    :return: dictionary of CRN to resource instance
+    """
+    return {resource["crn"]: resource for resource in resources}
+
+
+def getResourceInstanceCache(resource_cache, resourceId):
+    """
+    Check Cache for Resource Details which may have been retrieved previously
+    """
+    if resourceId not in resource_cache:
+        logging.error("Cache miss for Resource {}".format(resourceId))
+        quit(1)
+
+    return resource_cache[resourceId]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Checkpoint of collection progress so a failed run can be resumed.
+
+Progress is kept per account and month.  The typed dataframe of each page of a month is committed as
+it is parsed together with the offset of the next page, and when the month is complete its output is
+written as partitions and its pages are dropped.  state.json records the run the checkpoint belongs
+to, the completed units and the committed pages; it is replaced atomically after each commit so a
+run stopped at any point resumes from the last committed page.
+
+Only a directory holding the state.json of a checkpoint, or an empty one, is ever discarded.
+"""
+
+__author__ = 'jonhall'
+import os, json, shutil, logging
+import pandas as pd
+
+
+class Checkpoint:
+    def __init__(self, directory, run, resume=False):
+        """
+        Constructor Method
+        :param directory: checkpoint directory
+        :param run: dictionary identifying the run (ie months and accounts), a checkpoint of another run is not resumed
+        :param resume: resume from existing checkpoint, otherwise any existing checkpoint is discarded
+        """
+        self.directory = directory
+        state = self.readState()
+        if resume and state is not None and state["run"] == run:
+            self.state = state
+            logging.info("Resuming from checkpoint with {} units complete and {} units in progress.".format(len(state["complete"]), len(state["pages"])))
+            return
+        if resume:
+            logging.warning("No checkpoint of this run found in {}, starting from the beginning.".format(directory))
+        if os.path.exists(directory) and len(os.listdir(directory)) > 0:
+            if state is None:
+                logging.error("{} is not a checkpoint and is not empty.  Specify a new or existing --checkpoint directory.".format(directory))
+                quit(1)
+            shutil.rmtree(directory)
+        os.makedirs(self.path("partitions"))
+        os.makedirs(self.path("pages"))
+        self.state = {"run": run, "complete": [], "pages": {}}
+        self.writeState()
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    @staticmethod
+    def unitKey(account, month):
+        """
+        Key of unit of account index and month
+        """
+        return "{:03d}-{}".format(account, month)
+
+    def readState(self):
+        """
+        State of checkpoint in directory
+        :return: state dictionary, None if directory does not hold a checkpoint
+        """
+        if not os.path.isfile(self.path("state.json")):
+            return None
+        try:
+            with open(self.path("state.json"), "rt") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(state, dict) or not {"run", "complete", "pages"} <= set(state):
+            return None
+        return state
+
+    def writeState(self):
+        with open(self.path("state.json.tmp"), "wt") as f:
+            json.dump(self.state, f)
+        os.replace(self.path("state.json.tmp"), self.path("state.json"))
+        return
+
+    def isComplete(self, key):
+        return key in self.state["complete"]
+
+    def completeUnit(self, key, frames):
+        """
+        Write output of completed unit and drop its pages
+        :param frames: dictionary of output name to dataframe
+        """
+        for name, frame in frames.items():
+            frame.to_pickle(self.path("partitions", "{}.{}.pkl".format(key, name)))
+        self.state["complete"].append(key)
+        pages = self.state["pages"].pop(key, None)
+        self.writeState()
+        if pages is not None:
+            for page in range(pages["pages"]):
+                os.remove(self.path("pages", "{}.{:05d}.pkl".format(key, page)))
+        return
+
+    def readPartition(self, key, name):
+        return pd.read_pickle(self.path("partitions", "{}.{}.pkl".format(key, name)))
+
+    def commitPage(self, key, frame, offset, recordstart):
+        """
+        Commit parsed page
+        :param frame: typed dataframe of rows parsed from page
+        :param offset: offset of next page, "" if page was the last
+        :param recordstart: record number of next page
+        """
+        pages = self.state["pages"].get(key, {"pages": 0})
+        frame.to_pickle(self.path("pages", "{}.{:05d}.pkl".format(key, pages["pages"])))
+        self.state["pages"][key] = {"pages": pages["pages"] + 1, "offset": offset, "recordstart": recordstart}
+        self.writeState()
+        return
+
+    def readPages(self, key):
+        """
+        Read committed pages of unit
+        :return: list of dataframes of committed pages, offset of next page (None if no pages committed), record number of next page
+        """
+        pages = self.state["pages"].get(key)
+        if pages is None:
+            return [], None, 1
+        frames = [pd.read_pickle(self.path("pages", "{}.{:05d}.pkl".format(key, page))) for page in range(pages["pages"])]
+        return frames, pages["offset"], pages["recordstart"]
+
+    def remove(self):
+        """
+        Remove checkpoint after run completes
+        """
+        shutil.rmtree(self.directory)
+        return
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Client factory for the IBM Cloud SDK services used by the account usage scripts.
+
+One factory is created per API key.  Clients are created on first use and share the API key's
+authenticator from the token manager, so every factory and client of an API key reuses one IAM token,
+and each SDK (including ibm_cloud_sdk_core) is imported only when first needed.
+"""
+
+__author__ = 'jonhall'
+import logging
+from accountusage.tokens import getTokenManager
+from accountusage.metrics import getRunMetrics
+
+""" VPC regions searched for virtual and bare metal servers """
+VPC_REGIONS = ["us-south", "us-east", "ca-tor"]
+
+
+class ClientFactory:
+    def __init__(self, apikey, tokens=None):
+        """
+        Constructor Method
+        :param apikey: IBM Cloud API key
+        :param tokens: token manager, defaults to the token manager shared by the process
+        """
+        from ibm_cloud_sdk_core import ApiException
+        self.apikey = apikey
+        self.accountId = None
+        self.clients = {}
+        self.tokens = tokens if tokens is not None else getTokenManager()
+        try:
+            self.authenticator = self.tokens.getAuthenticator(apikey)
+        except ApiException as e:
+            logging.error("API exception {}.".format(str(e)))
+            quit(1)
+
+    def getClient(self, name, create, retries=True):
+        """
+        Return cached client, creating it on first use
+        :param name: name of client in cache
+        :param create: function creating client from authenticator
+        :param retries: enable retries and timeout used for platform services
+        API calls of clients are counted in the run metrics of the process
+        """
+        if name not in self.clients:
+            from ibm_cloud_sdk_core import ApiException
+            try:
+                client = create(self.authenticator)
+                if retries:
+                    client.enable_retries(max_retries=5, retry_interval=1.0)
+                    client.set_http_config({'timeout': 120})
+                getRunMetrics().instrument(client)
+            except ApiException as e:
+                logging.error("API exception {}.".format(str(e)))
+                quit(1)
+            self.clients[name] = client
+        return self.clients[name]
+
+    @property
+    def iam_identity(self):
+        from ibm_platform_services import IamIdentityV1
+        return self.getClient("iam_identity", lambda authenticator: IamIdentityV1(authenticator=authenticator), retries=False)
+
+    @property
+    def usage_reports(self):
+        from ibm_platform_services import UsageReportsV4
+        return self.getClient("usage_reports", lambda authenticator: UsageReportsV4(authenticator=authenticator))
+
+    @property
+    def resource_controller(self):
+        from ibm_platform_services import ResourceControllerV2
+        return self.getClient("resource_controller", lambda authenticator: ResourceControllerV2(authenticator=authenticator))
+
+    @property
+    def global_search(self):
+        from ibm_platform_services import GlobalSearchV2
+        return self.getClient("global_search", lambda authenticator: GlobalSearchV2(authenticator=authenticator))
+
+    @property
+    def global_tagging(self):
+        from ibm_platform_services import GlobalTaggingV1
+        return self.getClient("global_tagging", lambda authenticator: GlobalTaggingV1(authenticator=authenticator))
+
+    def vpc(self, region):
+        """
+        Return VPC client for regional endpoint
+        :param region: VPC region (ie us-south)
+        """
+        def create(authenticator):
+            from ibm_vpc import VpcV1
+            vpc_service = VpcV1(authenticator=authenticator)
+            vpc_service.set_service_url('https://{}.iaas.cloud.ibm.com/v1'.format(region))
+            return vpc_service
+        return self.getClient("vpc_" + region, create, retries=False)
+
+    def getAccountId(self):
+        """
+        Get AccountId for this API Key, cached by the token manager
+        """
+        if self.accountId is None:
+            from ibm_cloud_sdk_core import ApiException
+            try:
+                self.accountId = self.tokens.getAccountId(self.apikey, self.lookupAccountId)
+            except ApiException as e:
+                logging.error("API exception {}.".format(str(e)))
+                quit(1)
+        return self.accountId
+
+    def lookupAccountId(self):
+        """
+        Get AccountId for this API Key from IAM Identity service
+        """
+        api_key = self.iam_identity.get_api_keys_details(
+            iam_api_key=self.apikey
+        ).get_result()
+        return api_key["account_id"]
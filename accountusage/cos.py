@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Upload of report output to IBM Cloud Object Storage.
+
+ibm_boto3 is imported on first upload so scripts run without --cos never import it.
+"""
+
+__author__ = 'jonhall'
+import logging
+
+
+def writeFiletoCos(localfile, upload, apikey, instance_crn, endpoint, bucket):
+    """"
+    Write Files to COS
+    :param localfile: local file to upload
+    :param upload: object name in bucket
+    :param apikey: COS apikey with write access to bucket
+    :param instance_crn: COS service instance CRN
+    :param endpoint: COS endpoint (with https://)
+    :param bucket: COS bucket name
+    """
+    import ibm_boto3
+    from ibm_botocore.client import Config, ClientError
+
+    def multi_part_upload(bucket_name, item_name, file_path):
+        """"
+        Write Files to COS
+        """
+        try:
+            logging.info("Starting file transfer for {0} to bucket: {1}".format(item_name, bucket_name))
+            # set 5 MB chunks
+            part_size = 1024 * 1024 * 5
+
+            # set threadhold to 15 MB
+            file_threshold = 1024 * 1024 * 15
+
+            # set the transfer threshold and chunk size
+            transfer_config = ibm_boto3.s3.transfer.TransferConfig(
+                multipart_threshold=file_threshold,
+                multipart_chunksize=part_size
+            )
+
+            # the upload_fileobj method will automatically execute a multi-part upload
+            # in 5 MB chunks for all files over 15 MB
+            with open(file_path, "rb") as file_data:
+                cos.Object(bucket_name, item_name).upload_fileobj(
+                    Fileobj=file_data,
+                    Config=transfer_config
+                )
+            logging.info("Transfer for {0} complete".format(item_name))
+        except ClientError as be:
+            logging.error("CLIENT ERROR: {0}".format(be))
+        except Exception as e:
+            logging.error("Unable to complete multi-part upload: {0}".format(e))
+            quit(1)
+        return
+
+    cos = ibm_boto3.resource("s3",
+                             ibm_api_key_id=apikey,
+                             ibm_service_instance_id=instance_crn,
+                             config=Config(signature_version="oauth"),
+                             endpoint_url=endpoint
+                             )
+    multi_part_upload(bucket, upload, "./" + localfile)
+    return
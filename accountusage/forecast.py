@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Cost forecasts of account usage.
+
+Monthly cost of each account and service is laid out as a matrix of a row per series and a column per month, and
+three simple models are fitted to every series at once over the matrix, from the first month the series was used:
+
+    linear_trend            least squares line through the last months of a rolling window
+    seasonal_naive          cost of the same month a year earlier, the last month until there is a year of history
+    exponential_smoothing   exponentially weighted level of all months
+
+Each model also predicts every month from the months before it, and the model of each series is the one with the
+smallest mean absolute error over the last months of the window.  The month end forecast of the current month blends
+its month to date run rate with the model forecast by the fraction of the month elapsed.
+"""
+
+__author__ = 'jonhall'
+import numpy as np
+import pandas as pd
+
+""" Usage is summed over resources, plans and metrics to a series per account and service """
+FORECAST_KEYS = ["account_name", "resource_name"]
+MODELS = ["linear_trend", "seasonal_naive", "exponential_smoothing"]
+
+""" Default months of the linear trend and of the model errors, months of a season and smoothing factor """
+WINDOW = 6
+SEASON = 12
+ALPHA = 0.5
+""" Months forecast after the current month """
+QUARTER = 3
+
+
+def monthElapsed(timestamp):
+    """
+    Month of a time and the fraction of it elapsed
+    :param timestamp: datetime
+    :return: month (YYYY-MM), fraction of the month elapsed
+    """
+    start = pd.Timestamp(timestamp).to_period("M").start_time
+    end = (pd.Timestamp(timestamp).to_period("M") + 1).start_time
+    return start.strftime("%Y-%m"), (pd.Timestamp(timestamp) - start) / (end - start)
+
+
+def monthlySeries(usage, keys, months):
+    """
+    Matrix of the cost of each series for every month
+    :param usage: dataframe of keys, month (YYYY-MM) and cost
+    :param keys: columns identifying a series (ie FORECAST_KEYS)
+    :param months: list of months (YYYY-MM) of the matrix, usage of other months is ignored
+    :return: dataframe of keys of each series, series x months array of cost
+    """
+    usage = usage[usage["month"].astype(str).isin(months)]
+    if len(usage) == 0:
+        return pd.DataFrame(columns=keys), np.zeros((0, len(months)))
+    series = usage.groupby(keys, sort=False, dropna=False).ngroup().to_numpy()
+    seriesKeys = usage[keys].drop_duplicates().reset_index(drop=True)
+    month = pd.Index(months).get_indexer(usage["month"].astype(str))
+    cells = series * len(months) + month
+    cost = np.bincount(cells, weights=usage["cost"].to_numpy(dtype=float), minlength=len(seriesKeys) * len(months))
+    return seriesKeys, cost.reshape(len(seriesKeys), len(months))
+
+
+def linearTrend(values, window=WINDOW, horizon=1):
+    """
+    Least squares line through the months of a rolling window
+    :param values: series x months array, nan before the series started
+    :param window: months of each fit
+    :param horizon: months forecast after the last month
+    :return: series x months array predicting each month from the window before it (nan for the first month),
+    series x horizon array of forecasts
+    """
+    series, months = values.shape
+    padded = np.concatenate([np.full((series, window), np.nan), values], axis=1)
+    """ Window t holds the months before month t, the last window the months before the first forecast """
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=1)[:, -(months + 1):]
+    x = np.arange(window, dtype=float)
+    valid = ~np.isnan(windows)
+    n = valid.sum(axis=2)
+    sx = np.where(valid, x, 0).sum(axis=2)
+    sxx = np.where(valid, x * x, 0).sum(axis=2)
+    sy = np.nansum(windows, axis=2)
+    sxy = np.nansum(windows * x, axis=2)
+    """ A single month is a flat line """
+    denominator = n * sxx - sx * sx
+    slope = np.divide(n * sxy - sx * sy, denominator, out=np.zeros(n.shape), where=denominator > 0)
+    intercept = np.divide(sy - slope * sx, n, out=np.full(n.shape, np.nan), where=n > 0)
+    fitted = intercept[:, :months] + slope[:, :months] * window
+    steps = window - 1 + np.arange(1, horizon + 1)
+    forecast = intercept[:, -1:] + slope[:, -1:] * steps[None, :]
+    return fitted, forecast
+
+
+def seasonalNaive(values, season=SEASON, horizon=1):
+    """
+    Cost of the same month a season earlier, the last month where there is no month a season earlier
+    :param values: series x months array, nan before the series started
+    :param season: months of a season
+    :param horizon: months forecast after the last month
+    :return: series x months array predicting each month from the months before it (nan for the first month),
+    series x horizon array of forecasts
+    """
+    series, months = values.shape
+    extended = np.concatenate([values, np.full((series, horizon), np.nan)], axis=1)
+    fitted = np.full((series, months), np.nan)
+    for month in range(1, months + horizon):
+        last = min(month, months) - 1
+        prediction = extended[:, last]
+        if month >= season:
+            prediction = np.where(np.isnan(extended[:, month - season]), prediction, extended[:, month - season])
+        if month < months:
+            fitted[:, month] = prediction
+        else:
+            extended[:, month] = prediction
+    return fitted, extended[:, months:]
+
+
+def exponentialSmoothing(values, alpha=ALPHA, horizon=1):
+    """
+    Simple exponential smoothing, the forecast is the smoothed level of the months before
+    :param values: series x months array, nan before the series started
+    :param alpha: smoothing factor, weight of the latest month
+    :param horizon: months forecast after the last month
+    :return: series x months array predicting each month from the months before it (nan for the first month),
+    series x horizon array of forecasts
+    """
+    series, months = values.shape
+    fitted = np.full((series, months), np.nan)
+    if months == 0:
+        return fitted, np.full((series, horizon), np.nan)
+    """ The level starts at the first month of each series """
+    level = values[:, 0].astype(float)
+    for month in range(1, months):
+        fitted[:, month] = level
+        level = np.where(np.isnan(level), values[:, month], alpha * values[:, month] + (1 - alpha) * level)
+    return fitted, np.repeat(level[:, None], horizon, axis=1)
+
+
+def forecastUsage(usage, month, elapsed, projected=None, keys=FORECAST_KEYS, window=WINDOW, season=SEASON, alpha=ALPHA, quarter=QUARTER):
+    """
+    Forecast the month end cost of the current month and the cost of the months after it of each series
+    :param usage: dataframe of keys, month (YYYY-MM) and cost of the months before month and month to date cost of month
+    :param month: current month (YYYY-MM)
+    :param elapsed: fraction of month elapsed at the time of the month to date cost
+    :param projected: dataframe of keys and projected_cost of month from usage snapshots, None to project the month to
+    date cost over the month
+    :param keys: columns identifying a series
+    :param window: months of the linear trend and of the model errors
+    :param season: months of a season of seasonal_naive
+    :param alpha: smoothing factor of exponential_smoothing
+    :param quarter: months forecast after month
+    :return: dataframe of keys, history_months, mtd_cost, the month forecast of each model, model, run_rate_cost,
+    month_end_forecast, forecast of each month after month and next_quarter_forecast, largest month end forecast first
+    """
+    first = min(usage["month"].astype(str).min(), month) if len(usage) > 0 else month
+    months = list(pd.period_range(first, month, freq="M").strftime("%Y-%m"))
+    after = list(pd.period_range(pd.Period(month, freq="M") + 1, periods=quarter, freq="M").strftime("%Y-%m"))
+    seriesKeys, cost = monthlySeries(usage, keys, months)
+    history, mtdCost = cost[:, :-1], cost[:, -1]
+    """ Months before the first month of usage of a series are not history of it """
+    started = np.cumsum(history != 0, axis=1) > 0
+    history = np.where(started, history, np.nan)
+    horizon = quarter + 1
+
+    fits = [linearTrend(history, window, horizon), seasonalNaive(history, season, horizon), exponentialSmoothing(history, alpha, horizon)]
+    fitted = np.stack([fit for fit, forecast in fits])
+    forecasts = np.clip(np.stack([forecast for fit, forecast in fits]), 0, None)
+
+    """ Each series takes the model with the smallest mean absolute error of the last months it predicted """
+    errors = np.abs(fitted - history[None, :, :])[:, :, -window:]
+    predicted = ~np.isnan(errors).any(axis=0)
+    counts = predicted.sum(axis=1)
+    mae = np.divide(np.where(predicted[None], errors, 0).sum(axis=2), counts, out=np.full(forecasts.shape[:2], np.inf), where=counts > 0)
+    best = np.argmin(mae, axis=0)
+    forecast = forecasts[best, np.arange(len(best))]
+
+    """ Month to date cost run over the whole month, or projected from the burn rate of usage snapshots """
+    runRate = mtdCost / elapsed if elapsed > 0 else mtdCost
+    if projected is not None:
+        projectedCost = seriesKeys.merge(projected[keys + ["projected_cost"]], how="left", on=keys)["projected_cost"].to_numpy(dtype=float)
+        runRate = np.where(np.isnan(projectedCost), runRate, projectedCost)
+    """ The run rate is weighted by the fraction of the month elapsed, without history the run rate is the forecast """
+    monthForecast = np.where(np.isnan(forecast[:, 0]), runRate, elapsed * runRate + (1 - elapsed) * forecast[:, 0])
+    monthEnd = np.maximum(monthForecast, mtdCost)
+    """ Without history the months after are forecast at the month end forecast """
+    quarterForecast = np.where(np.isnan(forecast[:, 1:]), monthEnd[:, None], forecast[:, 1:])
+
+    forecastTable = seriesKeys.assign(history_months=started.sum(axis=1), mtd_cost=mtdCost)
+    for model, modelForecast in zip(MODELS, forecasts):
+        forecastTable[model] = modelForecast[:, 0]
+    forecastTable["model"] = np.where(np.isinf(mae[best, np.arange(len(best))]), "", np.array(MODELS, dtype=object)[best])
+    forecastTable["run_rate_cost"] = runRate
+    forecastTable["month_end_forecast"] = monthEnd
+    for position, nextMonth in enumerate(after):
+        forecastTable[nextMonth] = quarterForecast[:, position]
+    forecastTable["next_quarter_forecast"] = quarterForecast.sum(axis=1)
+    return forecastTable.sort_values("month_end_forecast", ascending=False, kind="stable").reset_index(drop=True)
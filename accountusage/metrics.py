@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Run metrics of the report scripts.
+
+Each stage of a run (tag cache, resource cache, account usage, instance usage, each create*Tab and
+the upload) is recorded with its wall time, CPU time, peak RSS and the API calls, bytes received and
+retries of SDK clients during the stage.  API calls are counted by a response hook added to each
+client's http session by the client factory.  Stages run for an account are also totalled per
+account.  Metrics are written as JSON and optionally in Prometheus text format, so runs can be
+compared month to month.  A StageProfiler (see profiling) attached as profiler profiles selected stages.
+"""
+
+__author__ = 'jonhall'
+import os, sys, json, time, logging, platform, threading
+from datetime import datetime
+from contextlib import contextmanager
+from functools import wraps
+
+COUNTERS = ["api_calls", "bytes_received", "retries"]
+
+
+def peakRss():
+    """
+    Peak resident set size of the process in MiB, None where not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    """ ru_maxrss is in bytes on macOS and kilobytes elsewhere """
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class RunMetrics:
+    def __init__(self, script=None):
+        """
+        Constructor Method
+        :param script: name of script reported with metrics
+        """
+        self.script = script
+        self.started = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.stages = []
+        self.profiler = None
+
+    def recordResponse(self, response, *args, **kwargs):
+        """
+        requests response hook counting API calls, bytes received and retries made by urllib3
+        """
+        retries = getattr(response.raw, "retries", None)
+        with self.lock:
+            self.counters["api_calls"] += 1
+            self.counters["bytes_received"] += len(response.content or b"")
+            if retries is not None:
+                self.counters["retries"] += len(retries.history)
+        return response
+
+    def instrument(self, client):
+        """
+        Count API calls of SDK client
+        :param client: IBM Cloud SDK service
+        """
+        client.get_http_client().hooks["response"].append(self.recordResponse)
+        return client
+
+    @contextmanager
+    def stage(self, name, account=None):
+        """
+        Record metrics of the code run inside a with block, profiling it if selected by the stage profiler
+        :param name: name of stage (ie tag cache)
+        :param account: name of account the stage is run for, None for stages of the whole run
+        """
+        profile = self.profiler.start(name, account) if self.profiler is not None else None
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        with self.lock:
+            counters = dict(self.counters)
+        try:
+            yield
+        finally:
+            with self.lock:
+                record = {"stage": name, "account": account,
+                          "wall_seconds": round(time.perf_counter() - wall, 3),
+                          "cpu_seconds": round(time.process_time() - cpu, 3),
+                          "peak_rss_mb": peakRss()}
+                record.update({counter: self.counters[counter] - counters[counter] for counter in COUNTERS})
+                self.stages.append(record)
+            if profile is not None:
+                self.profiler.stop(profile)
+
+    @staticmethod
+    def total(records, **keys):
+        """
+        Total metrics of stage records
+        """
+        total = dict(keys, calls=len(records))
+        for metric in ["wall_seconds", "cpu_seconds"] + COUNTERS:
+            total[metric] = round(sum(record[metric] for record in records), 3)
+        rss = [record["peak_rss_mb"] for record in records if record["peak_rss_mb"] is not None]
+        total["peak_rss_mb"] = max(rss) if rss else None
+        return total
+
+    def summary(self):
+        """
+        Metrics of run with totals per stage and per account
+        """
+        with self.lock:
+            stages = list(self.stages)
+            counters = dict(self.counters)
+        byStage = {}
+        byAccount = {}
+        for record in stages:
+            byStage.setdefault((record["stage"], record["account"]), []).append(record)
+            if record["account"] is not None:
+                byAccount.setdefault(record["account"], []).append(record)
+        run = {"script": self.script, "started": self.started, "python": platform.python_version(),
+               "wall_seconds": round(time.perf_counter() - self.wall, 3),
+               "cpu_seconds": round(time.process_time() - self.cpu, 3),
+               "peak_rss_mb": peakRss()}
+        run.update(counters)
+        return {"run": run,
+                "stages": [self.total(records, stage=stage, account=account) for (stage, account), records in byStage.items()],
+                "accounts": [self.total(records, account=account) for account, records in byAccount.items()],
+                "records": stages}
+
+    def writeJson(self, filename):
+        """
+        Write run metrics as JSON
+        """
+        with open(filename, "wt") as f:
+            json.dump(self.summary(), f, indent=2)
+        logging.info("Run metrics written to {}.".format(filename))
+        return
+
+    def writePrometheus(self, filename):
+        """
+        Write run metrics in Prometheus text exposition format (ie for the node exporter textfile collector)
+        """
+        summary = self.summary()
+        metrics = {"wall_seconds": "Wall time in seconds", "cpu_seconds": "CPU time in seconds", "peak_rss_mb": "Peak resident set size in MiB",
+                   "api_calls": "Number of API calls", "bytes_received": "Bytes received from APIs", "retries": "Number of API retries"}
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        def sample(name, labels, value):
+            return "{}{{{}}} {}".format(name, ",".join("{}=\"{}\"".format(key, escape(value)) for key, value in labels.items()), value)
+
+        lines = []
+        for metric, description in metrics.items():
+            for scope, records in [("run", [summary["run"]]), ("stage", summary["stages"]), ("account", summary["accounts"])]:
+                name = "accountusage_{}_{}".format(scope, metric)
+                lines.append("# HELP {} {} of {}.".format(name, description, scope))
+                lines.append("# TYPE {} gauge".format(name))
+                for record in records:
+                    if record[metric] is None:
+                        continue
+                    labels = {"script": self.script}
+                    labels.update({key: record[key] or "" for key in ["stage", "account"] if key in record})
+                    lines.append(sample(name, labels, record[metric]))
+        with open(filename, "wt") as f:
+            f.write("\n".join(lines) + "\n")
+        logging.info("Prometheus metrics written to {}.".format(filename))
+        return
+
+
+metrics = None
+
+
+def getRunMetrics():
+    """
+    Return run metrics shared by the process
+    """
+    global metrics
+    if metrics is None:
+        metrics = RunMetrics(os.path.splitext(os.path.basename(sys.argv[0]))[0] or None)
+    return metrics
+
+
+def stage(name, account=None):
+    """
+    Record stage in run metrics of the process
+    """
+    return getRunMetrics().stage(name, account)
+
+
+def timedStage(function):
+    """
+    Decorator recording each call of function as a stage in run metrics of the process
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
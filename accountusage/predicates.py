@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compiled row filters of report dataframes.
+
+A filter is built once from column predicates combined with &, | and ~, instead of a DataFrame.query string that is
+parsed and evaluated on every call:
+
+    workers = (column("service_id") == "is.instance") & column("instance_role").contains("symphony-worker")
+    servers = select(instancesUsage, workers & (column("month") == usageMonth))
+
+Each column is indexed once per dataframe as integer codes of its distinct values, so == and isin compare codes and
+contains matches each distinct value once.  The boolean mask of every predicate and combination is cached by the
+dataframe's selector, so filters repeated across tabs and charges (ie per application in a loop) reuse the masks of
+their parts.  Indexes and masks are dropped when a column they were built from is no longer the column of the
+dataframe (pandas returns a new column after any assignment to it) or the number of rows changed.
+
+Run as a module to time DataFrame.query against compiled filters on a pkl file of instance usage:
+
+    python -m accountusage.predicates Billing/instanceUsage.pkl
+"""
+
+__author__ = 'jonhall'
+import sys, time, weakref
+
+
+class Predicate:
+    def __init__(self, key, evaluate):
+        """
+        Constructor Method
+        :param key: hashable description of the predicate, the key of its cached mask
+        :param evaluate: function of a Selector returning the boolean mask of the predicate
+        """
+        self.key = key
+        self.evaluate = evaluate
+
+    def __and__(self, other):
+        return Predicate(("and", self.key, other.key), lambda selector: selector.mask(self) & selector.mask(other))
+
+    def __or__(self, other):
+        return Predicate(("or", self.key, other.key), lambda selector: selector.mask(self) | selector.mask(other))
+
+    def __invert__(self):
+        return Predicate(("not", self.key), lambda selector: ~selector.mask(self))
+
+    def __repr__(self):
+        return "Predicate{}".format(self.key)
+
+
+class Column:
+    def __init__(self, name):
+        """
+        Constructor Method
+        :param name: column name
+        """
+        self.name = name
+
+    def __eq__(self, value):
+        return Predicate(("==", self.name, value), lambda selector: selector.equal(self.name, value))
+
+    def __ne__(self, value):
+        """ Like query, != is true where the column is missing """
+        return ~(self == value)
+
+    def isin(self, values):
+        values = tuple(values)
+        return Predicate(("in", self.name, values), lambda selector: selector.isin(self.name, values))
+
+    def contains(self, pattern):
+        """ Regular expression search like str.contains, false where the column is missing """
+        return Predicate(("contains", self.name, pattern), lambda selector: selector.contains(self.name, pattern))
+
+    def notna(self):
+        return Predicate(("notna", self.name), lambda selector: selector.notna(self.name))
+
+
+def column(name):
+    """
+    Column of a filter
+    :param name: column name
+    :return: Column to build predicates with ==, !=, isin, contains and notna
+    """
+    return Column(name)
+
+
+class Selector:
+    def __init__(self, frame):
+        """
+        Constructor Method
+        :param frame: dataframe to filter
+        """
+        """ Referenced weakly so shared selectors do not keep dataframes alive """
+        self.reference = weakref.ref(frame)
+        self.indexes = {}
+        self.masks = {}
+        self.columns = {}
+        self.rows = len(frame)
+
+    @property
+    def frame(self):
+        return self.reference()
+
+    def values(self, name):
+        """
+        Column of the dataframe, recorded so indexes and masks built from it are dropped if it changes
+        """
+        values = self.frame[name]
+        self.columns[name] = values
+        return values
+
+    def validate(self):
+        """
+        Drop indexes and masks if a column they were built from or the number of rows changed
+        """
+        frame = self.frame
+        if len(frame) != self.rows or any(name not in frame.columns or frame[name] is not values for name, values in self.columns.items()):
+            self.indexes = {}
+            self.masks = {}
+            self.columns = {}
+            self.rows = len(frame)
+        return
+
+    def index(self, name):
+        """
+        Integer codes of the values of a column and its distinct values, code -1 where missing
+        Numeric columns are not indexed, None is returned and they are compared directly.
+        """
+        import pandas as pd
+        if name not in self.indexes:
+            values = self.values(name)
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                self.indexes[name] = (values.cat.codes.to_numpy(), values.cat.categories)
+            elif values.dtype == object:
+                codes, uniques = pd.factorize(values.to_numpy(dtype=object))
+                self.indexes[name] = (codes, pd.Index(uniques, dtype=object))
+            else:
+                self.indexes[name] = None
+        return self.indexes[name]
+
+    def equal(self, name, value):
+        import numpy as np
+        index = self.index(name)
+        if index is None:
+            return (self.values(name) == value).to_numpy()
+        codes, uniques = index
+        code = uniques.get_indexer([value])[0]
+        return codes == code if code >= 0 else np.zeros(len(codes), dtype=bool)
+
+    def isin(self, name, values):
+        import numpy as np
+        index = self.index(name)
+        if index is None:
+            return self.values(name).isin(values).to_numpy()
+        codes, uniques = index
+        found = uniques.get_indexer(list(values))
+        return np.isin(codes, found[found >= 0])
+
+    def contains(self, name, pattern):
+        import numpy as np
+        import pandas as pd
+        index = self.index(name)
+        if index is None:
+            return self.values(name).astype(str).str.contains(pattern).to_numpy()
+        codes, uniques = index
+        matches = pd.Series(uniques, dtype=object).str.contains(pattern, na=False).to_numpy(dtype=bool)
+        """ Missing values have code -1, which takes the False appended to the matches """
+        return np.append(matches, False)[codes]
+
+    def notna(self, name):
+        index = self.index(name)
+        if index is None:
+            return self.values(name).notna().to_numpy()
+        return index[0] >= 0
+
+    def mask(self, predicate):
+        """
+        Boolean mask of the rows matching predicate, calculated once for each predicate
+        """
+        if predicate.key not in self.masks:
+            self.masks[predicate.key] = predicate.evaluate(self)
+        return self.masks[predicate.key]
+
+    def select(self, predicate):
+        """
+        Rows of the dataframe matching predicate
+        """
+        self.validate()
+        return self.frame[self.mask(predicate)]
+
+
+""" Selectors of dataframes filtered, by id of the dataframe until it is garbage collected """
+selectors = {}
+
+
+def getSelector(frame):
+    """
+    Selector of a dataframe, shared by every filter of that dataframe so masks are reused
+    """
+    key = id(frame)
+    if key not in selectors:
+        selectors[key] = Selector(frame)
+        weakref.finalize(frame, selectors.pop, key, None)
+    return selectors[key]
+
+
+def select(frame, predicate):
+    """
+    Rows of a dataframe matching a compiled filter, as DataFrame.query would return them
+    :param frame: dataframe to filter
+    :param predicate: Predicate built from column()
+    :return: dataframe of the matching rows
+    """
+    return getSelector(frame).select(predicate)
+
+
+def benchmark(frame, filters, repeat=20):
+    """
+    Time each filter with DataFrame.query and compiled, on a new selector, a selector with the columns indexed and a
+    selector with the masks cached
+    :param frame: dataframe to filter
+    :param filters: list of name, query string, local variables of the query and the equivalent Predicate
+    :param repeat: calls timed of each filter
+    :return: list of name, rows selected, and milliseconds per call of query, compiled, indexed and cached
+    """
+    results = []
+    for name, query, variables, predicate in filters:
+        expected = frame.query(query, local_dict=variables)
+        if not expected.index.equals(Selector(frame).select(predicate).index):
+            raise ValueError("Compiled filter {} selects different rows than its query.".format(name))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            frame.query(query, local_dict=variables)
+        queried = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            Selector(frame).select(predicate)
+        compiled = time.perf_counter() - start
+        """ Columns indexed by an earlier filter, as filters with other values in a loop """
+        selector = Selector(frame)
+        selector.select(predicate)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            selector.masks = {}
+            selector.select(predicate)
+        indexed = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            selector.select(predicate)
+        cached = time.perf_counter() - start
+        results.append((name, len(expected), queried * 1000 / repeat, compiled * 1000 / repeat, indexed * 1000 / repeat, cached * 1000 / repeat))
+    return results
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    if len(sys.argv) != 2:
+        print("usage: python -m accountusage.predicates instanceUsage.pkl")
+        quit(1)
+    instancesUsage = pd.read_pickle(sys.argv[1])
+    usageMonth = str(instancesUsage["month"].iloc[-1])
+    role = "symphony-worker"
+    """ An account with servers of the role, so the role filter selects rows """
+    workers = select(instancesUsage, column("instance_role").contains(role))
+    account = str(workers["account_id"].iloc[0]) if len(workers) > 0 else ""
+    virtualServerHours = (column("service_id") == "is.instance") & column("metric").isin(["VCPU_HOURS", "INSTANCE_HOURS_MULTI_TENANT"])
+    bareMetalHours = (column("service_id") == "is.bare-metal-server") & (column("metric") == "BARE_METAL_SERVER_HOURS")
+    filters = [
+        ("month", 'month == @usageMonth', {"usageMonth": usageMonth}, column("month") == usageMonth),
+        ("server hours of month", 'month == @usageMonth and ((service_id == "is.instance" and (metric == "VCPU_HOURS" or metric =="INSTANCE_HOURS_MULTI_TENANT")) or (service_id == "is.bare-metal-server" and metric == "BARE_METAL_SERVER_HOURS"))',
+         {"usageMonth": usageMonth}, (column("month") == usageMonth) & (virtualServerHours | bareMetalHours)),
+        ("role of account", '(instance_role.str.contains(@role) and account_id == @account)', {"role": role, "account": account},
+         column("instance_role").contains(role) & (column("account_id") == account)),
+    ]
+    print("{:25s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}".format("filter", "rows", "query ms", "compiled", "indexed", "cached"))
+    for name, rows, queried, compiled, indexed, cached in benchmark(instancesUsage, filters):
+        print("{:25s} {:8d} {:10.3f} {:10.3f} {:10.3f} {:10.3f}".format(name, rows, queried, compiled, indexed, cached))
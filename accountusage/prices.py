@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Price tier table of usage.
+
+Usage records carry the price list of their plan and metric as a list of tiers, which collection stores as
+text.  The price lists are normalized into one deduplicated table of a row per tier keyed by plan, metric,
+pricing region and tier, and each usage row keeps a price_id referencing its price list.  The text of each
+distinct price list is parsed once.  A plan metric with more than one price list (ie priced in another
+currency) has a price_id for each.
+"""
+
+__author__ = 'jonhall'
+import ast, logging
+import numpy as np
+import pandas as pd
+from accountusage.schema import typedFrame
+
+""" Usage columns identifying a price list """
+PRICE_LIST_KEYS = ["plan_id", "metric", "pricing_region", "price"]
+
+PRICE_TIER_SCHEMA = {
+    "price_id": "Int32",
+    "plan_id": "category",
+    "metric": "category",
+    "pricing_region": "category",
+    "tier": "Int16",
+    "quantity_tier": "Float64",
+    "price": "Float64"
+}
+
+
+def priceSchema(schema):
+    """
+    Schema of usage normalized by normalizePrices
+    :param schema: ACCOUNT_USAGE_SCHEMA or INSTANCE_USAGE_SCHEMA
+    :return: schema with a price_id column in place of the price column
+    """
+    return {("price_id" if column == "price" else column): ("Int32" if column == "price" else dtype) for column, dtype in schema.items()}
+
+
+def parsePriceList(text):
+    """
+    Parse the text of a price list
+    :param text: text of a list of tiers (ie [{'price': 0.1, 'quantity_tier': 1}]), "[]" or missing
+    :return: list of tier dictionaries, empty if there are no tiers
+    """
+    if not isinstance(text, str) or text.strip() == "":
+        return []
+    try:
+        tiers = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        logging.warning("Unable to parse price list {}.".format(text))
+        return []
+    return [tier for tier in tiers if isinstance(tier, dict)] if isinstance(tiers, list) else []
+
+
+def normalizePrices(frames):
+    """
+    Split the price lists of typed usage dataframes into one deduplicated price tier table
+    :param frames: list of typed usage dataframes (ie account usage and instance usage)
+    :return: list of the dataframes with price_id in place of price (missing where there are no tiers), price tier
+    dataframe of PRICE_TIER_SCHEMA
+    """
+    priceIds = {}
+    parsed = {}
+    tiers = []
+    normalized = []
+    for frame in frames:
+        """ Each distinct plan, metric, pricing region and price list is looked up once, rows take the id of their group """
+        codes = pd.DataFrame({key: frame[key].cat.codes.to_numpy() for key in PRICE_LIST_KEYS})
+        groups = codes.groupby(PRICE_LIST_KEYS, sort=False).ngroup().to_numpy()
+        groupIds = np.full(groups.max() + 1 if len(groups) > 0 else 0, -1)
+        for group, position in enumerate(codes.drop_duplicates().index):
+            planId, metric, region, text = (frame[key].iat[position] for key in PRICE_LIST_KEYS)
+            planId, metric, region = ("" if pd.isna(value) else value for value in (planId, metric, region))
+            if text not in parsed:
+                parsed[text] = parsePriceList(text)
+            if len(parsed[text]) == 0:
+                continue
+            if (planId, metric, region, text) not in priceIds:
+                priceId = len(priceIds)
+                priceIds[(planId, metric, region, text)] = priceId
+                for tier, entry in enumerate(parsed[text], 1):
+                    tiers.append({"price_id": priceId, "plan_id": planId, "metric": metric, "pricing_region": region, "tier": tier,
+                                  "quantity_tier": entry.get("quantity_tier"), "price": entry.get("price")})
+            groupIds[group] = priceIds[(planId, metric, region, text)]
+        priceId = pd.Series(groupIds[groups], index=frame.index)
+        frame = frame.assign(price=priceId.where(priceId >= 0).astype("Int32")).rename(columns={"price": "price_id"})
+        normalized.append(frame)
+    return normalized, typedFrame(tiers, PRICE_TIER_SCHEMA)
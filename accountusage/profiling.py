@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Opt-in profiling of the stages recorded in run metrics.
+
+A StageProfiler attached to the run metrics profiles the stages selected by name while they run.
+The default sampling profiler reads the stack of the stage's thread from a background thread at a
+fixed interval and writes the samples as folded stacks (one "frame;frame;frame count" line per
+stack), the input format of flamegraph.pl, speedscope and inferno.  The cprofile profiler writes
+pstats files instead (snakeviz, flameprof).  With memory tracking, tracemalloc snapshots taken at
+the start and end of the stage are compared and the top allocations are written by line.
+
+Each selected stage is profiled on its first call and then every Nth call, so stages run once per
+account and month can be sampled rather than profiled on every call.
+"""
+
+__author__ = 'jonhall'
+import os, re, sys, time, logging, threading
+
+""" Number of allocation sites written per stage by memory tracking """
+MEMORY_TOP = 25
+
+
+def stageKey(name):
+    """
+    Name of stage as selected on the command line and used in filenames (ie instance usage -> instance_usage)
+    """
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name.strip())
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, threadId, interval):
+        """
+        Constructor Method
+        :param threadId: ident of thread to sample
+        :param interval: seconds between samples
+        """
+        super().__init__(daemon=True)
+        self.threadId = threadId
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples = self.samples + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return
+
+
+class StageProfiler:
+    def __init__(self, stages, directory="profile", profiler="sample", interval=0.01, every=1, memory=False):
+        """
+        Constructor Method
+        :param stages: list of stage names to profile, ["all"] for every stage
+        :param directory: directory profiles are written to
+        :param profiler: sample for folded stacks from a sampling profiler, cprofile for pstats files
+        :param interval: seconds between samples of the sampling profiler
+        :param every: profile the first and then every Nth call of each stage
+        :param memory: track allocations of each profiled call with tracemalloc
+        """
+        self.stages = set(stageKey(name) for name in stages)
+        self.directory = directory
+        self.profiler = profiler
+        self.interval = interval
+        self.every = max(every, 1)
+        self.memory = memory
+        self.calls = {}
+        self.active = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if memory:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+
+    def start(self, name, account=None):
+        """
+        Start profiling call of stage if selected
+        :return: profile of call passed to stop, None if call is not profiled
+        """
+        key = stageKey(name)
+        if "all" not in self.stages and key not in self.stages:
+            return None
+        with self.lock:
+            call = self.calls.get(key, 0)
+            self.calls[key] = call + 1
+            """ Profilers do not nest, a stage run inside a profiled stage is included in its profile """
+            if call % self.every != 0 or self.active is not None:
+                return None
+            self.active = threading.get_ident()
+        profile = {"name": ".".join([key] + ([stageKey(account)] if account else []) + ["{:03d}".format(call)]),
+                   "started": time.perf_counter()}
+        if self.memory:
+            """ Tracing is started for the call only, so stages not profiled run without its overhead """
+            profile["tracing"] = not self.tracemalloc.is_tracing()
+            if profile["tracing"]:
+                self.tracemalloc.start()
+            self.tracemalloc.reset_peak()
+            profile["snapshot"] = self.tracemalloc.take_snapshot()
+        if self.profiler == "cprofile":
+            import cProfile
+            profile["profiler"] = cProfile.Profile()
+            profile["profiler"].enable()
+        else:
+            profile["profiler"] = StackSampler(threading.get_ident(), self.interval)
+            profile["profiler"].start()
+        return profile
+
+    def stop(self, profile):
+        """
+        Stop profiling call of stage and write its profile
+        """
+        if profile is None:
+            return
+        profiler = profile["profiler"]
+        if self.profiler == "cprofile":
+            profiler.disable()
+            filename = self.path(profile, "prof")
+            profiler.dump_stats(filename)
+        else:
+            profiler.stop()
+            filename = self.path(profile, "folded")
+            with open(filename, "wt") as f:
+                for stack, count in sorted(profiler.stacks.items()):
+                    f.write("{} {}\n".format(stack, count))
+        elapsed = time.perf_counter() - profile["started"]
+        logging.info("Profiled {} in {:.1f} seconds to {}.".format(profile["name"], elapsed, filename))
+        if self.memory:
+            self.writeMemory(profile)
+            if profile["tracing"]:
+                self.tracemalloc.stop()
+        with self.lock:
+            self.active = None
+        return
+
+    def writeMemory(self, profile):
+        """
+        Write top allocations of profiled call by line, compared to the start of the call
+        """
+        snapshot = self.tracemalloc.take_snapshot()
+        current, peak = self.tracemalloc.get_traced_memory()
+        statistics = snapshot.compare_to(profile["snapshot"], "lineno")
+        with open(self.path(profile, "memory.txt"), "wt") as f:
+            f.write("Traced memory at end {:.1f} MiB, peak during stage {:.1f} MiB\n\n".format(current / 1048576, peak / 1048576))
+            for statistic in statistics[:MEMORY_TOP]:
+                f.write("{}\n".format(statistic))
+        return
+
+    def path(self, profile, extension):
+        return os.path.join(self.directory, "{}.{}".format(profile["name"], extension))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Resource normalizer shared by the account usage scripts.
+
+Resource controller instances are normalized column-wise: extensions are flattened once per struct,
+and VPC instance details and tags are joined by CRN.  normalizeResources returns every column any
+script reports, each script selects and formats the columns it needs.
+"""
+
+__author__ = 'jonhall'
+import logging, pytz
+import pandas as pd
+from accountusage.cache import getResourceInstanceCache
+
+nytz = pytz.timezone('America/New_York')
+
+""" Location detail of VPC regions """
+REGION_LOCATIONS = {
+    "us-south": ("Dallas", "Texas", "United States"),
+    "us-east": ("Ashburn", "Virginia", "United States"),
+    "ca-tor": ("Toronto", "Ontario", "Canada")
+}
+
+""" Columns joined from VPC instance cache """
+VPC_COLUMNS = ["vpc", "primary_network_interface_subnet", "primary_network_interface_primary_ip", "numa_count",
+               "total_network_bandwidth", "total_volume_bandwidth", "boot_volume_attachment", "BMThreadsPerCore", "BMDisks",
+               "BMRawStorage"]
+
+""" Columns joined from VPC instance cache with volume detail from resource cache """
+VOLUME_COLUMNS = ["bootVolumeCapacity", "bootVolumeAttachment", "numAttachedDataVolumes", "totalDataVolumeCapacity",
+                  "attachedDataVolumes"]
+
+""" Columns of normalized resources """
+RESOURCE_COLUMNS = ['account_id', "account_name", "service_id", "instance_id", "name", "resource_group_id", "region_id",
+                    "provision_date", "deprovision_date", "instance_created_at", "instance_updated_at", "instance_deleted_at",
+                    "instance_state", "lifecycleAction", "instance_profile", "cpu_family", "region", "city", "stateprov",
+                    "country", "availability_zone", "numberOfVirtualCPUs", "MemorySizeMiB", "NodeName", "NumberOfGPUs",
+                    "NumberOfInstStorageDisks", "BMnumberofCores", "BMnumberofSockets", "BMbandwidth", "capacity", "iops",
+                    "OSName", "OSVendor", "OSVersion"] + VPC_COLUMNS + VOLUME_COLUMNS + \
+                   ["instance_role", "audit", "role_tags", "audit_tags"]
+
+VM_FIELDS = ["Profile", "CPUFamily", "NumberOfVirtualCPUs", "MemorySizeMiB", "NodeName", "NumberOfGPUs",
+             "NumberOfInstStorageDisks", "OSName", "OSVendor", "OSVersion"]
+BM_FIELDS = ["Profile", "MemorySizeMiB", "NodeName", "NumberOfCores", "NumberOfSockets", "Bandwidth", "OSName",
+             "OSVendor", "OSVersion"]
+
+
+def flattenExtension(extensions, name, fields):
+    """
+    Flatten one struct of the resource controller extensions column into columns
+    :param extensions: series of extensions dictionaries (NaN where resource has no extensions)
+    :param name: name of struct in extensions (ie VirtualMachineProperties)
+    :param fields: fields of struct to return as columns
+    :return: dataframe of fields ("" where not present) and boolean series of rows where struct exists
+    """
+    structs = [extension.get(name) if isinstance(extension, dict) else None for extension in extensions]
+    present = pd.Series([isinstance(struct, dict) for struct in structs], index=extensions.index, dtype=bool)
+    flat = pd.DataFrame([struct if isinstance(struct, dict) else {} for struct in structs],
+                        index=extensions.index, columns=fields, dtype=object).fillna("")
+    return flat, present
+
+
+def localDates(timestamps):
+    """
+    Convert Zulu timestamps to dates in US East Timezone, each distinct timestamp is converted once
+    :param timestamps: series of timestamps
+    :return: series of dates (YYYY-MM-DD), "" where there is no timestamp
+    """
+    dates = {}
+    for timestamp in timestamps.dropna().unique():
+        date = pd.to_datetime(timestamp, utc=True, errors="coerce")
+        if not pd.isnull(date):
+            dates[timestamp] = date.tz_convert(nytz).strftime("%Y-%m-%d")
+    return timestamps.map(dates).fillna("")
+
+
+def parseVolumes(vpcinstance, resource_cache):
+    """
+    Get boot and data volume detail of VPC instance from resource cache
+    :return: dictionary of VOLUME_COLUMNS
+    """
+    volumes = {column: "" for column in VOLUME_COLUMNS}
+    bootVolumeCRN = ""
+    if "boot_volume_attachment" in vpcinstance:
+        bootVolumeCRN = vpcinstance["boot_volume_attachment"]["volume"]["crn"]
+        """ Get cached resource controller data for volume """
+        resourceDetail = getResourceInstanceCache(resource_cache, bootVolumeCRN)
+        if "extensions" in resourceDetail:
+            bootCapacity = resourceDetail["extensions"]["VolumeInfo"]["Capacity"]
+            bootIops = resourceDetail["extensions"]["VolumeInfo"]["IOPS"]
+            volumes["bootVolumeCapacity"] = float(resourceDetail["extensions"]["VolumeInfo"]["Capacity"])
+        else:
+            bootCapacity = "100"
+            bootIops = "3000"
+            volumes["bootVolumeCapacity"] = 100
+
+        volumes["bootVolumeAttachment"] = {
+            "id": vpcinstance["boot_volume_attachment"]["id"],
+            "name": vpcinstance["boot_volume_attachment"]["name"],
+            "capacity": bootCapacity,
+            "iops": bootIops
+        }
+
+    if "volume_attachments" in vpcinstance:
+        volumes["numAttachedDataVolumes"] = len(vpcinstance["volume_attachments"]) - 1
+        totalDataVolumeCapacity = 0
+        attachedDataVolumeDetail = []
+        for volume in vpcinstance["volume_attachments"]:
+            volumerow = {}
+            volumeCRN = volume["volume"]["crn"]
+            volumerow["name"] = volume["volume"]["name"]
+            volumerow["id"] = volume["volume"]["id"]
+            """ Ignore if Boot Volume """
+            if bootVolumeCRN != volumeCRN:
+                """ Lookup Volume by CRN from Cache """
+                resourceDetail = getResourceInstanceCache(resource_cache, volumeCRN)
+                if "extensions" in resourceDetail:
+                    if "VolumeInfo" in resourceDetail["extensions"]:
+                        if "Capacity" in resourceDetail["extensions"]["VolumeInfo"]:
+                            volumerow["capacity"] = resourceDetail["extensions"]["VolumeInfo"]["Capacity"]
+                            totalDataVolumeCapacity = totalDataVolumeCapacity + float(volumerow["capacity"])
+                        if "IOPS" in resourceDetail["extensions"]["VolumeInfo"]:
+                            volumerow["iops"] = resourceDetail["extensions"]["VolumeInfo"]["IOPS"]
+                attachedDataVolumeDetail.append(volumerow)
+        volumes["totalDataVolumeCapacity"] = totalDataVolumeCapacity
+        volumes["attachedDataVolumes"] = attachedDataVolumeDetail
+    return volumes
+
+
+def parseVPCInstances(instances, resource_cache=None):
+    """
+    Parse VPC instances into a dataframe indexed by CRN for joining with resource controller data
+    :param instances: list of VPC instance and bare metal server records
+    :param resource_cache: resource cache used for volume detail, None to skip volume detail
+    :return: dataframe of VPC_COLUMNS and VOLUME_COLUMNS by CRN
+    """
+    data = []
+    for vpcinstance in instances:
+        ThreadsPerCore = ""
+        if "cpu" in vpcinstance:
+            ThreadsPerCore = float(vpcinstance["cpu"]["threads_per_core"])
+        bm_disks = ""
+        BMRawStorage = ""
+        if "disks" in vpcinstance:
+            bm_disks = len(vpcinstance["disks"])
+            BMRawStorage = 0
+            for storage in vpcinstance["disks"]:
+                if storage["interface_type"] == "nvme":
+                    BMRawStorage = BMRawStorage + float(storage["size"])
+
+        row = {
+            "crn": vpcinstance["crn"],
+            "vpc": vpcinstance["vpc"]["name"] if "vpc" in vpcinstance else "",
+            "primary_network_interface_subnet": vpcinstance["primary_network_interface"]["subnet"]["name"] if "primary_network_interface" in vpcinstance else "",
+            "primary_network_interface_primary_ip": vpcinstance["primary_network_interface"]["primary_ip"]["address"] if "primary_network_interface" in vpcinstance else "",
+            "numa_count": vpcinstance["numa_count"] if "numa_count" in vpcinstance else "",
+            "total_network_bandwidth": vpcinstance["total_network_bandwidth"] if "total_network_bandwidth" in vpcinstance else "",
+            "total_volume_bandwidth": vpcinstance["total_volume_bandwidth"] if "total_volume_bandwidth" in vpcinstance else "",
+            "boot_volume_attachment": vpcinstance["boot_volume_attachment"]["name"] if "boot_volume_attachment" in vpcinstance else "",
+            "BMThreadsPerCore": ThreadsPerCore,
+            "BMDisks": bm_disks,
+            "BMRawStorage": BMRawStorage
+        }
+        if resource_cache is not None:
+            row = row | parseVolumes(vpcinstance, resource_cache)
+        data.append(row)
+
+    vpcDetail = pd.DataFrame(data, columns=["crn"] + VPC_COLUMNS + VOLUME_COLUMNS).set_index("crn")
+    return vpcDetail[~vpcDetail.index.duplicated()]
+
+
+def normalizeResources(accountName, resources, tag_cache, instance_cache=None, resource_cache=None,
+                       vpc_services=("is.instance", "is.bare-metal-server")):
+    """
+    Normalize resource controller instances
+    :param accountName: account name
+    :param resources: dataframe (or list) of resource controller instances
+    :param tag_cache: tag index of account
+    :param instance_cache: VPC instance cache of account, None to skip VPC detail
+    :param resource_cache: resource cache of account used for volume detail, None to skip volume detail
+    :param vpc_services: resource_ids looked up in VPC instance cache
+    :return: dataframe of RESOURCE_COLUMNS ("" where not applicable to resource)
+    """
+    resources = pd.DataFrame(resources)
+    if len(resources) == 0:
+        return pd.DataFrame(columns=RESOURCE_COLUMNS)
+    resources = resources.reset_index(drop=True)
+
+    def column(name):
+        """ resource controller column, or "" if no resource returned it """
+        if name in resources.columns:
+            return resources[name]
+        return pd.Series("", index=resources.index, dtype=object)
+
+    resourceDetail = pd.DataFrame({
+        "account_id": column("account_id"),
+        "account_name": accountName,
+        "service_id": column("resource_id"),
+        "instance_id": column("id"),
+        "name": column("name"),
+        "resource_group_id": column("resource_group_id"),
+        "region_id": column("region_id"),
+        "instance_created_at": column("created_at").fillna(""),
+        "instance_updated_at": column("updated_at").fillna(""),
+        "instance_deleted_at": column("deleted_at"),
+        "instance_state": column("state").fillna("")
+    }, index=resources.index)
+
+    """ Create Provision & deProvision Date Fields using US East Timezone for Zulu conversion """
+    resourceDetail["provision_date"] = localDates(resourceDetail["instance_created_at"])
+    resourceDetail["deprovision_date"] = localDates(resourceDetail["instance_deleted_at"])
+
+    """ Flatten extension data from resource controller """
+    extensions = column("extensions")
+    vm, isVM = flattenExtension(extensions, "VirtualMachineProperties", VM_FIELDS)
+    bm, isBM = flattenExtension(extensions, "BMServerProperties", BM_FIELDS)
+    isBM = isBM & ~isVM
+    volume, isVolume = flattenExtension(extensions, "VolumeInfo", ["Capacity", "IOPS"])
+    isVolume = isVolume & ~isVM & ~isBM
+    resource, isResource = flattenExtension(extensions, "Resource", ["AvailabilityZone", "Location", "LifecycleAction"])
+
+    def choose(vmField, bmField):
+        """ value from VirtualMachineProperties, else BMServerProperties, else "" """
+        value = pd.Series("", index=resources.index, dtype=object)
+        if bmField is not None:
+            value = value.mask(isBM, bm[bmField])
+        if vmField is not None:
+            value = value.mask(isVM, vm[vmField])
+        return value
+
+    resourceDetail["instance_profile"] = choose("Profile", "Profile")
+    resourceDetail["cpu_family"] = choose("CPUFamily", None)
+    resourceDetail["numberOfVirtualCPUs"] = choose("NumberOfVirtualCPUs", None)
+    resourceDetail["MemorySizeMiB"] = choose("MemorySizeMiB", "MemorySizeMiB")
+    resourceDetail["NodeName"] = choose("NodeName", "NodeName")
+    resourceDetail["NumberOfGPUs"] = choose("NumberOfGPUs", None)
+    resourceDetail["NumberOfInstStorageDisks"] = choose("NumberOfInstStorageDisks", None)
+    resourceDetail["BMnumberofCores"] = choose(None, "NumberOfCores")
+    resourceDetail["BMnumberofSockets"] = choose(None, "NumberOfSockets")
+    resourceDetail["BMbandwidth"] = choose(None, "Bandwidth")
+    resourceDetail["OSName"] = choose("OSName", "OSName")
+    resourceDetail["OSVendor"] = choose("OSVendor", "OSVendor")
+    resourceDetail["OSVersion"] = choose("OSVersion", "OSVersion")
+    resourceDetail["capacity"] = volume["Capacity"].where(isVolume, "")
+    resourceDetail["iops"] = volume["IOPS"].where(isVolume, "")
+    resourceDetail["availability_zone"] = resource["AvailabilityZone"]
+    resourceDetail["lifecycleAction"] = resource["LifecycleAction"]
+    resourceDetail["region"] = [location.get("Region", "") if isinstance(location, dict) else "" for location in resource["Location"]]
+    locations = resourceDetail["region"].map(REGION_LOCATIONS)
+    resourceDetail["city"] = [location[0] if isinstance(location, tuple) else "" for location in locations]
+    resourceDetail["stateprov"] = [location[1] if isinstance(location, tuple) else "" for location in locations]
+    resourceDetail["country"] = [location[2] if isinstance(location, tuple) else "" for location in locations]
+
+    """ Join VPC details not stored in resource controller by CRN """
+    if instance_cache is not None:
+        servers = resourceDetail["service_id"].isin(vpc_services)
+        missing = servers & ~resourceDetail["instance_id"].isin(instance_cache.keys())
+        for crn in resourceDetail.loc[missing, "instance_id"]:
+            logging.warning("Cache miss for VPC instance {}".format(crn))
+        vpcDetail = parseVPCInstances([instance_cache[crn] for crn in resourceDetail.loc[servers & ~missing, "instance_id"]], resource_cache)
+        resourceDetail = resourceDetail.join(vpcDetail, on="instance_id")
+        """ Threads per core, disks and raw storage are only reported for bare metal servers """
+        resourceDetail.loc[resourceDetail["service_id"] != "is.bare-metal-server", ["BMThreadsPerCore", "BMDisks", "BMRawStorage"]] = ""
+    resourceDetail = resourceDetail.reindex(columns=resourceDetail.columns.union(VPC_COLUMNS + VOLUME_COLUMNS, sort=False))
+    resourceDetail[VPC_COLUMNS + VOLUME_COLUMNS] = resourceDetail[VPC_COLUMNS + VOLUME_COLUMNS].astype(object).fillna("")
+
+    """ Join tags by CRN, tags are parsed once per distinct tag set """
+    setIds = resourceDetail["instance_id"].map(tag_cache["crn"])
+    for column_name, field in [("instance_role", "role"), ("audit", "audit"), ("role_tags", "role_tags"), ("audit_tags", "audit_tags")]:
+        resourceDetail[column_name] = setIds.map(pd.Series([tags[field] for tags in tag_cache["sets"]], dtype=object)).fillna("")
+
+    return resourceDetail[RESOURCE_COLUMNS]
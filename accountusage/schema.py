@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Typed schema of the account usage and instance usage tables.
+
+Usage is collected into typed dataframes: strings are categories, so each distinct value is stored
+once and rows hold small integer codes; counts are downcast nullable integers and estimated days a
+nullable float, missing instead of "" placeholders; price tiers are stored once per distinct price
+as their text.  Rows are typed in batches of pages as they are parsed, so only one batch of parsed
+rows is held as python objects at a time.  Typed dataframes are what is checkpointed, partitioned and saved.
+
+The report tabs group and pivot on the categorical columns with observed=True, so only combinations
+present in the data are grouped; reportFrame only sorts the categories and converts nullable numbers, and
+pivotTable sorts the rows, which pandas 1.5 leaves in order of appearance for observed categories.
+"""
+
+__author__ = 'jonhall'
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+""" Number of parsed rows typed at a time, typing is mostly a fixed cost per column so pages are typed in batches """
+BATCH_ROWS = 5000
+
+""" Column types: category for strings, text for values stored as the category of their text (ie price tiers) """
+ACCOUNT_USAGE_SCHEMA = {
+    "account_id": "category",
+    "account_name": "category",
+    "month": "category",
+    "currency_code": "category",
+    "billing_country": "category",
+    "resource_id": "category",
+    "resource_name": "category",
+    "billable_charges": "float64",
+    "billable_rated_charges": "float64",
+    "plan_id": "category",
+    "plan_name": "category",
+    "pricing_region": "category",
+    "metric": "category",
+    "unit_name": "category",
+    "quantity": "float64",
+    "rateable_quantity": "float64",
+    "cost": "float64",
+    "rated_cost": "float64",
+    "discount": "float64",
+    "price": "text"
+}
+
+INSTANCE_USAGE_SCHEMA = {
+    "account_id": "category",
+    "account_name": "category",
+    "month": "category",
+    "service_name": "category",
+    "service_id": "category",
+    "instance_name": "category",
+    "instance_id": "category",
+    "plan_name": "category",
+    "plan_id": "category",
+    "region": "category",
+    "pricing_region": "category",
+    "resource_group_name": "category",
+    "resource_group_id": "category",
+    "billable": "bool",
+    "pricing_country": "category",
+    "billing_country": "category",
+    "currency_code": "category",
+    "pricing_plan_id": "category",
+    "provision_date": "category",
+    "instance_created_at": "category",
+    "instance_updated_at": "category",
+    "instance_deleted_at": "category",
+    "instance_state": "category",
+    "instance_profile": "category",
+    "cpu_family": "category",
+    "numberOfVirtualCPUs": "Int16",
+    "MemorySizeMiB": "Int32",
+    "NodeName": "category",
+    "NumberOfGPUs": "Int8",
+    "NumberOfInstStorageDisks": "Int8",
+    "availability_zone": "category",
+    "BMnumberofCores": "Int16",
+    "BMnumberofSockets": "Int8",
+    "BMbandwidth": "Int32",
+    "instance_role": "category",
+    "audit": "category",
+    "metric": "category",
+    "metric_name": "category",
+    "unit": "category",
+    "unit_name": "category",
+    "quantity": "float64",
+    "cost": "float64",
+    "rated_cost": "float64",
+    "rateable_quantity": "float64",
+    "estimated_days": "Float32",
+    "price": "text",
+    "discount": "float64"
+}
+
+
+def applySchema(frame, schema):
+    """
+    Convert columns of dataframe to the types of schema, "" placeholders of numbers become missing
+    :param frame: dataframe of parsed rows, or a typed dataframe (ie loaded from a pkl file of an earlier run)
+    :param schema: ACCOUNT_USAGE_SCHEMA or INSTANCE_USAGE_SCHEMA
+    :return: typed dataframe with the columns of schema
+    """
+    typed = {}
+    for column, dtype in schema.items():
+        values = frame[column]
+        if str(values.dtype) == dtype:
+            typed[column] = values
+        elif dtype == "text":
+            typed[column] = values.map(str).astype("category")
+        elif dtype in ("category", "bool"):
+            typed[column] = values.astype(dtype)
+        else:
+            if values.dtype == object:
+                values = pd.to_numeric(values.mask(values == ""))
+            typed[column] = values.astype(dtype)
+    return pd.DataFrame(typed, index=frame.index)
+
+
+def typedFrame(rows, schema):
+    """
+    Create typed dataframe from parsed rows
+    :param rows: list of row dictionaries
+    :param schema: ACCOUNT_USAGE_SCHEMA or INSTANCE_USAGE_SCHEMA
+    """
+    return applySchema(pd.DataFrame(rows, columns=list(schema)), schema)
+
+
+def concatFrames(frames, schema=None):
+    """
+    Concatenate typed dataframes, unioning the categories of each categorical column so it stays categorical
+    :param frames: list of typed dataframes with the same columns
+    :param schema: schema of an empty result when frames is empty
+    """
+    frames = list(frames)
+    if len(frames) == 0:
+        return typedFrame([], schema) if schema is not None else pd.DataFrame()
+    columns = {}
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            columns[column] = union_categoricals([frame[column] for frame in frames])
+        else:
+            columns[column] = pd.concat([frame[column] for frame in frames], ignore_index=True).array
+    return pd.DataFrame(columns, index=frames[0].index.append([frame.index for frame in frames[1:]]))
+
+
+def pivotTable(frame, **kwargs):
+    """
+    pd.pivot_table of the observed combinations of categorical columns, with rows sorted by category value and the margins row kept last
+    pandas 1.5 leaves the groups of observed categories in order of appearance rather than sorting them.
+    :param frame: dataframe from reportFrame
+    :param kwargs: arguments of pd.pivot_table
+    :return: pivot table
+    """
+    table = pd.pivot_table(frame, observed=True, **kwargs)
+    body, margins = (table.iloc[:-1], table.iloc[-1:]) if kwargs.get("margins") else (table, table.iloc[:0])
+    return pd.concat([body.sort_index(key=categoryValues), margins])
+
+
+def categoryValues(level):
+    """
+    Sort key of an index level, the values of a categorical level as the categories of concatenated frames are not sorted
+    """
+    if isinstance(level.dtype, pd.CategoricalDtype):
+        return level.astype(level.dtype.categories.dtype)
+    return level
+
+
+def reportFrame(frame, schema):
+    """
+    Prepare typed dataframe for the report tabs, which group and pivot on it with observed=True
+    Categories stay categorical with their categories sorted, and text columns become categories.  Nullable numbers
+    become numpy numbers, float64 with nan where missing, which are written to Excel as empty cells.
+    :param frame: typed dataframe
+    :param schema: schema of frame
+    :return: dataframe of the report tabs
+    """
+    report = {}
+    for column, dtype in schema.items():
+        values = frame[column]
+        if dtype in ("category", "text"):
+            values = values.astype("category")
+            report[column] = values.cat.reorder_categories(sorted(values.cat.categories, key=str))
+        elif dtype.startswith("Float"):
+            report[column] = values.astype("float64")
+        elif dtype.startswith("Int"):
+            """ pivot_table margins do not support nullable integers """
+            report[column] = values.astype("float64") if values.isna().any() else values.astype(dtype.lower())
+        else:
+            report[column] = values
+    return pd.DataFrame(report, index=frame.index)
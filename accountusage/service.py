@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Long running service serving report views from memory over local HTTP.
+
+The service calls a refresh function on a schedule, encodes each dataframe view it returns as JSON
+and CSV once, and swaps the encoded views in for requests, so a request is answered from memory
+without touching the APIs or pandas.
+
+    GET /                 status of the service and list of views
+    GET /<view>           view as JSON records
+    GET /<view>?format=csv  view as CSV
+"""
+
+__author__ = 'jonhall'
+import json, time, logging, threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+
+def encodeView(view):
+    """
+    Encode dataframe view as JSON records and CSV
+    :param view: dataframe, pivot table index levels become columns
+    :return: dict of format to (content type, body)
+    """
+    view = view.reset_index()
+    if view.columns.nlevels > 1:
+        view.columns = [" ".join(str(level) for level in column if level != "").strip() for column in view.columns]
+    return {
+        "json": ("application/json", view.to_json(orient="records").encode()),
+        "csv": ("text/csv", view.to_csv(index=False).encode())
+    }
+
+
+class ViewRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = parse.urlsplit(self.path)
+        name = url.path.strip("/")
+        service = self.server.service
+        if name == "":
+            self.send(200, "application/json", json.dumps(service.status()).encode())
+            return
+        views = service.views
+        if name not in views:
+            self.send(404, "application/json", json.dumps({"error": "Unknown view {}.".format(name)}).encode())
+            return
+        format = parse.parse_qs(url.query).get("format", ["json"])[0]
+        if format not in views[name]:
+            self.send(400, "application/json", json.dumps({"error": "Unknown format {}.".format(format)}).encode())
+            return
+        self.send(200, *views[name][format])
+
+    def send(self, code, contentType, body):
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("{} {}".format(self.address_string(), format % args))
+
+
+class ViewService:
+    def __init__(self, refresh, interval, host="127.0.0.1", port=8080):
+        """
+        Constructor Method
+        :param refresh: function returning dict of view name to dataframe, called with the refresh count
+        :param interval: seconds between the start of each refresh
+        :param host: address to listen on, local only by default
+        :param port: port to listen on
+        """
+        self.refresh = refresh
+        self.interval = interval
+        self.views = {}
+        self.refreshed = None
+        self.refreshSeconds = None
+        self.refreshes = 0
+        self.server = ThreadingHTTPServer((host, port), ViewRequestHandler)
+        self.server.service = self
+
+    def status(self):
+        """
+        Status of service returned for /
+        """
+        return {
+            "refreshed": self.refreshed,
+            "refresh_seconds": self.refreshSeconds,
+            "refreshes": self.refreshes,
+            "views": sorted(self.views.keys())
+        }
+
+    def publish(self, views):
+        """
+        Encode views and replace the views served
+        """
+        self.views = {name: encodeView(view) for name, view in views.items()}
+        self.refreshed = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return
+
+    def run(self):
+        """
+        Serve views in a background thread and refresh them until interrupted
+        """
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address[:2]
+        logging.info("Serving views on http://{}:{}/ refreshing every {:.0f} seconds.".format(host, port, self.interval))
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    views = self.refresh(self.refreshes)
+                except SystemExit:
+                    """ API helpers quit on errors, keep serving the previous views and retry at next refresh """
+                    logging.error("Refresh failed, serving views from {}.".format(self.refreshed))
+                except Exception:
+                    """ API, payload and pandas errors of one refresh do not stop the service """
+                    logging.exception("Refresh failed, serving views from {}.".format(self.refreshed))
+                else:
+                    self.publish(views)
+                    self.refreshes = self.refreshes + 1
+                    self.refreshSeconds = round(time.monotonic() - started, 3)
+                    logging.info("Refreshed {} views in {:.1f} seconds.".format(len(views), self.refreshSeconds))
+                time.sleep(max(self.interval - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            logging.info("Stopping service.")
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+        return
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+File based work queue for sharded report runs.
+
+A coordinator writes one JSON file per work unit to <directory>/queue.  Workers on this host or on
+other hosts sharing the directory claim a unit by renaming it into <directory>/claimed, which is
+atomic so each unit is claimed once, write their output partitions and rename the unit into
+<directory>/done.  Output is partitioned by the unit's keys as <name>/<key>=<value>/.../<unit>.pkl
+and read back by the coordinator in unit order.  Units never contain API keys, workers look up the
+account of a unit by its index in their own APIKEYS.
+
+Workers touch the file of the unit they are collecting every HEARTBEAT seconds.  A claim not touched
+for STALE_CLAIM seconds belongs to a worker that died and is requeued by the coordinator, which gives
+up when no unit is done for --queue_timeout seconds (ie no worker is running).  Only a directory
+holding the queue marker file is ever replaced by a new queue.
+"""
+
+__author__ = 'jonhall'
+import os, json, time, shutil, socket, logging, threading
+from contextlib import contextmanager
+import pandas as pd
+from accountusage.schema import concatFrames
+
+""" Seconds between touches of a claimed unit, and age of a claim not touched after which it is requeued """
+HEARTBEAT = 60
+STALE_CLAIM = 5 * HEARTBEAT
+""" Marker file of a queue directory """
+QUEUE_MARKER = ".workqueue"
+
+
+class WorkQueue:
+    def __init__(self, directory):
+        """
+        Constructor Method
+        :param directory: queue directory, shared by all hosts running workers
+        """
+        self.directory = directory
+        self.worker = "{}.{}".format(socket.gethostname(), os.getpid())
+        self.files = {}
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def create(self, units):
+        """
+        Replace queue with new work units
+        :param units: list of dictionaries of unit keys (ie account and month)
+        :return: list of unit names
+        """
+        if os.path.exists(self.directory) and len(os.listdir(self.directory)) > 0:
+            if not os.path.exists(self.path(QUEUE_MARKER)):
+                logging.error("{} is not a work queue and is not empty.  Specify a new or existing --queue directory.".format(self.directory))
+                quit(1)
+            shutil.rmtree(self.directory)
+        for state in ["queue", "claimed", "done", "output"]:
+            os.makedirs(self.path(state))
+        with open(self.path(QUEUE_MARKER), "wt") as f:
+            f.write("work queue\n")
+        self.files = {}
+        names = []
+        for number, unit in enumerate(units):
+            name = "unit-{:05d}".format(number)
+            with open(self.path("queue", name + ".tmp"), "wt") as f:
+                json.dump(dict(unit, name=name), f)
+            os.replace(self.path("queue", name + ".tmp"), self.path("queue", name + ".json"))
+            names.append(name)
+        return names
+
+    def claim(self):
+        """
+        Claim next queued unit
+        :return: unit dictionary, or None when queue is empty
+        """
+        for filename in sorted(os.listdir(self.path("queue"))):
+            if not filename.endswith(".json"):
+                continue
+            claimed = self.path("claimed", "{}.{}".format(filename, self.worker))
+            try:
+                os.rename(self.path("queue", filename), claimed)
+            except FileNotFoundError:
+                """ Claimed by another worker first """
+                continue
+            """ Renaming keeps the time the unit was queued, the claim is as old as its last touch """
+            os.utime(claimed)
+            with open(claimed, "rt") as f:
+                unit = json.load(f)
+            unit["claimed"] = claimed
+            return unit
+        return None
+
+    @contextmanager
+    def heartbeat(self, unit, interval=HEARTBEAT):
+        """
+        Touch the claim of unit every interval seconds while it is collected, so it is not requeued as stale
+        """
+        stopped = threading.Event()
+
+        def touch():
+            while not stopped.wait(interval):
+                try:
+                    os.utime(unit["claimed"])
+                except FileNotFoundError:
+                    return
+
+        thread = threading.Thread(target=touch, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete(self, unit):
+        """
+        Mark claimed unit as done
+        """
+        try:
+            os.replace(unit["claimed"], self.path("done", unit["name"] + ".json"))
+        except FileNotFoundError:
+            """ Requeued as stale while collected, its output is complete so the unit is done all the same """
+            logging.warning("Claim of {} by {} was requeued, marking it done.".format(unit["name"], self.worker))
+            with open(self.path("done", unit["name"] + ".json"), "wt") as f:
+                json.dump({key: value for key, value in unit.items() if key != "claimed"}, f)
+        return
+
+    def requeueStale(self, age=STALE_CLAIM):
+        """
+        Requeue claimed units not touched for age seconds, their workers have died
+        :return: number of units requeued
+        """
+        requeued = 0
+        now = time.time()
+        for filename in os.listdir(self.path("claimed")):
+            claimed = self.path("claimed", filename)
+            name = filename.split(".json.", 1)[0]
+            try:
+                if now - os.path.getmtime(claimed) < age:
+                    continue
+                if os.path.exists(self.path("done", name + ".json")):
+                    os.remove(claimed)
+                    continue
+                os.rename(claimed, self.path("queue", name + ".json"))
+            except FileNotFoundError:
+                """ Completed or requeued meanwhile """
+                continue
+            logging.warning("Requeued {} claimed by {}, not touched for {} seconds.".format(name, filename.split(".json.", 1)[-1], age))
+            requeued = requeued + 1
+        return requeued
+
+    def partitionPath(self, name, unit, partition):
+        """
+        Path of output partition of unit
+        :param partition: list of (key, value) the output is partitioned by
+        """
+        return self.path("output", name, *["{}={}".format(key, value) for key, value in partition], unit["name"] + ".pkl")
+
+    def writePartition(self, name, unit, partition, frame):
+        """
+        Write output dataframe of unit
+        :param name: name of output (ie accountUsage)
+        :param partition: list of (key, value) the output is partitioned by
+        :param frame: dataframe to write
+        """
+        filename = self.partitionPath(name, unit, partition)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        frame.to_pickle(filename + ".tmp")
+        os.replace(filename + ".tmp", filename)
+        self.files.pop(name, None)
+        return
+
+    def outputFiles(self, name):
+        """
+        Files of the output partitions of every unit, the output tree is walked once and kept until output is written
+        :param name: name of output
+        :return: dictionary of unit name to filename
+        """
+        if name not in self.files:
+            files = {}
+            for directory, subdirectories, filenames in os.walk(self.path("output", name)):
+                for filename in filenames:
+                    if filename.endswith(".pkl"):
+                        files[filename[:-4]] = os.path.join(directory, filename)
+            self.files[name] = files
+        return self.files[name]
+
+    def readPartitions(self, name, unitNames):
+        """
+        Read output partitions of units
+        :param name: name of output
+        :param unitNames: names of units in the order their output is concatenated
+        :return: dataframe
+        """
+        files = self.outputFiles(name)
+        return concatFrames([pd.read_pickle(files[unitName]) for unitName in unitNames if unitName in files])
+
+    def counts(self):
+        """
+        Number of queued, claimed and done units
+        """
+        return {state: len(os.listdir(self.path(state))) for state in ["queue", "claimed", "done"]}
+
+    def wait(self, total, processes=(), interval=5, timeout=None, stale=STALE_CLAIM):
+        """
+        Wait until all units are done, requeueing stale claims
+        :param total: number of units
+        :param processes: local worker processes, an error is logged if they all exit before units are done
+        :param interval: seconds between checks of queue
+        :param timeout: seconds without a unit done after which an error is logged, None to wait indefinitely
+        :param stale: age in seconds of claims requeued
+        :return: True if all units are done
+        """
+        reported = None
+        progress = time.monotonic()
+        done = 0
+        while True:
+            self.requeueStale(stale)
+            counts = self.counts()
+            if counts["done"] >= total:
+                return True
+            if counts != reported:
+                logging.info("Work units queued: {queue}, in progress: {claimed}, done: {done}.".format(**counts))
+                reported = counts
+            if counts["done"] > done:
+                done = counts["done"]
+                progress = time.monotonic()
+            elif timeout is not None and time.monotonic() - progress > timeout:
+                logging.error("No work unit done for {} seconds with {} of {} done.  Are workers running against {}?".format(timeout, done, total, self.directory))
+                return False
+            if len(processes) > 0 and all(process.poll() is not None for process in processes):
+                if self.counts()["done"] >= total:
+                    return True
+                logging.error("All local workers exited with {} of {} work units done.".format(self.counts()["done"], total))
+                return False
+            time.sleep(interval)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compact store of month to date usage snapshots collected by currentMonthUsage.py.
+
+Each distinct (account, month, resource, plan, metric) key is stored once and referenced by id.  The
+store keeps the latest cumulative quantity and cost of each key, so a new snapshot is diffed against
+the latest values only, and the non-zero differences are appended as deltas (start, end, key id,
+quantity, cost) in numpy arrays.  Burn rate is calculated from the deltas of a trailing window.
+"""
+
+__author__ = 'jonhall'
+import os, pickle, calendar
+from datetime import datetime, timedelta
+import pandas as pd
+import numpy as np
+
+SNAPSHOT_KEY = ["account_id", "account_name", "month", "resource_id", "resource_name", "plan_id", "plan_name", "metric", "unit_name"]
+
+
+def newUsageSnapshots():
+    """
+    Create empty usage snapshot store
+    """
+    return {
+        "keys": [],
+        "ids": {},
+        "snapshots": [],
+        "latest": {
+            "time": np.array([], dtype="datetime64[s]"),
+            "quantity": np.array([], dtype=np.float64),
+            "cost": np.array([], dtype=np.float64)
+        },
+        "deltas": {
+            "start": np.array([], dtype="datetime64[s]"),
+            "end": np.array([], dtype="datetime64[s]"),
+            "key": np.array([], dtype=np.int32),
+            "quantity": np.array([], dtype=np.float64),
+            "cost": np.array([], dtype=np.float64)
+        }
+    }
+
+
+def loadUsageSnapshots(filename):
+    """
+    Load usage snapshot store
+    :param filename: pickle file of usage snapshots
+    :return: usage snapshot store, or empty store if file does not exist
+    """
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    return newUsageSnapshots()
+
+
+def saveUsageSnapshots(filename, store):
+    """
+    Save usage snapshot store
+    """
+    with open(filename, "wb") as f:
+        pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return
+
+
+def getKeyId(store, key):
+    """
+    Lookup id of key, adding it to the store if new
+    :param key: tuple of SNAPSHOT_KEY values
+    :return: key id
+    """
+    keyId = store["ids"].get(key)
+    if keyId is None:
+        keyId = len(store["keys"])
+        store["ids"][key] = keyId
+        store["keys"].append(key)
+    return keyId
+
+
+def appendUsageSnapshot(store, accountUsage, timestamp):
+    """
+    Append month to date usage snapshot as deltas from the latest snapshot
+    :param store: usage snapshot store to append to
+    :param accountUsage: dataframe of month to date usage from getCurrentMonthAccountUsage
+    :param timestamp: datetime of snapshot
+    :return: number of deltas appended
+    """
+    usage = accountUsage.groupby(SNAPSHOT_KEY, sort=False)[["quantity", "cost"]].sum().reset_index()
+    keyIds = np.array([getKeyId(store, key) for key in usage[SNAPSHOT_KEY].itertuples(index=False, name=None)], dtype=np.int32)
+
+    """ Keys seen for the first time start from zero at the start of their month """
+    latest = store["latest"]
+    grow = len(store["keys"]) - len(latest["cost"])
+    if grow > 0:
+        monthStarts = pd.to_datetime([store["keys"][keyId][2] for keyId in range(len(latest["cost"]), len(store["keys"]))], format="%Y-%m")
+        latest["time"] = np.concatenate([latest["time"], monthStarts.values.astype("datetime64[s]")])
+        latest["quantity"] = np.concatenate([latest["quantity"], np.zeros(grow)])
+        latest["cost"] = np.concatenate([latest["cost"], np.zeros(grow)])
+
+    end = np.datetime64(timestamp, "s")
+    quantity = usage["quantity"].to_numpy(dtype=np.float64)
+    cost = usage["cost"].to_numpy(dtype=np.float64)
+    deltaQuantity = quantity - latest["quantity"][keyIds]
+    deltaCost = cost - latest["cost"][keyIds]
+    changed = (deltaQuantity != 0) | (deltaCost != 0)
+
+    deltas = store["deltas"]
+    deltas["start"] = np.concatenate([deltas["start"], latest["time"][keyIds][changed]])
+    deltas["end"] = np.concatenate([deltas["end"], np.full(changed.sum(), end)])
+    deltas["key"] = np.concatenate([deltas["key"], keyIds[changed]])
+    deltas["quantity"] = np.concatenate([deltas["quantity"], deltaQuantity[changed]])
+    deltas["cost"] = np.concatenate([deltas["cost"], deltaCost[changed]])
+
+    latest["time"][keyIds] = end
+    latest["quantity"][keyIds] = quantity
+    latest["cost"][keyIds] = cost
+    store["snapshots"].append(timestamp)
+    return int(changed.sum())
+
+
+def getUsageDeltas(store, since=None):
+    """
+    Usage and cost deltas between snapshots
+    :param since: only deltas of snapshots after this datetime, None for all deltas
+    :return: dataframe of start, end, SNAPSHOT_KEY, quantity and cost
+    """
+    deltas = store["deltas"]
+    selected = np.ones(len(deltas["key"]), dtype=bool)
+    if since is not None:
+        selected = deltas["end"] > np.datetime64(since, "s")
+    keys = pd.DataFrame(store["keys"], columns=SNAPSHOT_KEY)
+    result = keys.iloc[deltas["key"][selected]].reset_index(drop=True)
+    result.insert(0, "start", deltas["start"][selected])
+    result.insert(1, "end", deltas["end"][selected])
+    result["quantity"] = deltas["quantity"][selected]
+    result["cost"] = deltas["cost"][selected]
+    return result
+
+
+def getBurnRate(store, month, days):
+    """
+    Month to date cost, daily burn rate over a trailing window and projected month end cost of each service
+    :param month: month of projection (YYYY-MM)
+    :param days: number of days in trailing window of burn rate
+    :return: dataframe indexed by account_name and resource_name
+    """
+    columns = ["mtd_cost", "daily_burn_rate", "projected_cost"]
+    keys = pd.DataFrame(store["keys"], columns=SNAPSHOT_KEY)
+    inMonth = (keys["month"] == month).to_numpy()
+    if not inMonth.any():
+        return pd.DataFrame(columns=columns, index=pd.MultiIndex.from_tuples([], names=["account_name", "resource_name"]))
+
+    """ Month to date cost is the latest cumulative cost of each key in month """
+    latest = store["latest"]
+    monthKeys = keys[inMonth].assign(mtd_cost=latest["cost"][inMonth])
+    lastSnapshot = latest["time"][inMonth].max()
+
+    """ Deltas ending in the window, measured from the earliest start among them """
+    deltas = getUsageDeltas(store, lastSnapshot.astype(datetime) - timedelta(days=days))
+    deltas = deltas[deltas["month"] == month]
+    burn = deltas.groupby(["account_name", "resource_name"])["cost"].sum()
+    elapsedDays = 0
+    if len(deltas) > 0:
+        elapsedDays = (lastSnapshot - deltas["start"].min().to_datetime64()) / np.timedelta64(1, "D")
+
+    monthStart = datetime.strptime(month, "%Y-%m")
+    monthEnd = monthStart + timedelta(days=calendar.monthrange(monthStart.year, monthStart.month)[1])
+    remainingDays = max((np.datetime64(monthEnd, "s") - lastSnapshot) / np.timedelta64(1, "D"), 0)
+
+    burnRate = monthKeys.groupby(["account_name", "resource_name"])[["mtd_cost"]].sum()
+    burnRate["daily_burn_rate"] = burn.reindex(burnRate.index, fill_value=0) / elapsedDays if elapsedDays > 0 else 0.0
+    burnRate["projected_cost"] = burnRate["mtd_cost"] + burnRate["daily_burn_rate"] * remainingDays
+    return burnRate[columns]
+
+
+def getMonthlyCost(store, before):
+    """
+    Cost of each service of the months of the snapshots, the latest cumulative cost of each month
+    :param before: only months before this month (YYYY-MM), ie the months completed
+    :return: dataframe of account_name, resource_name, month and cost
+    """
+    keys = pd.DataFrame(store["keys"], columns=SNAPSHOT_KEY).assign(cost=store["latest"]["cost"])
+    keys = keys[keys["month"] < before]
+    return keys.groupby(["account_name", "resource_name", "month"], sort=False, as_index=False)["cost"].sum()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Startup timing of the report scripts.
+
+Scripts import only the standard library before parsing arguments, so --help returns without
+loading pandas or any SDK.  Heavy modules are imported afterwards inside importTimer blocks, and
+SDKs only on the code paths that call them; with --importtime the time taken by each block and
+the total startup time are logged.
+"""
+
+__author__ = 'jonhall'
+import time, logging
+from contextlib import contextmanager
+
+STARTED = time.perf_counter()
+importTimes = {}
+
+
+@contextmanager
+def importTimer(name):
+    """
+    Time the imports made inside a with block
+    :param name: name reported for the imports
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        importTimes[name] = importTimes.get(name, 0) + time.perf_counter() - start
+
+
+def logImportTimes():
+    """
+    Log time taken by each timed import and time since startup
+    """
+    for name, elapsed in sorted(importTimes.items(), key=lambda item: item[1], reverse=True):
+        logging.info("Imported {} in {:.0f} ms.".format(name, elapsed * 1000))
+    logging.info("Startup completed in {:.0f} ms.".format((time.perf_counter() - STARTED) * 1000))
+    return
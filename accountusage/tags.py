@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compact tag index used as the tag_cache of the account usage scripts.
+
+Most resources share a handful of tag combinations, so tag strings are interned, each distinct
+tag set is stored once with its role, audit and key:value map already parsed, and each CRN maps
+to the id of its tag set.
+"""
+
+__author__ = 'jonhall'
+import sys
+
+
+def parseTagSet(tags):
+    """
+    Parse a tag set once for all resources sharing it
+    :param tags: tuple of tags
+    :return: dictionary of tags, role and audit values, role and audit tags, and key:value map
+    """
+    return {
+        "tags": tags,
+        "role": ",".join([str(item.split(":")[1]) for item in tags if "role:" in item]),
+        "audit": ",".join([str(item.split(":")[1]) for item in tags if "audit:" in item]),
+        "role_tags": ",".join([str(item) for item in tags if "role:" in item]),
+        "audit_tags": ",".join([str(item) for item in tags if "audit:" in item]),
+        "keys": {key: value for key, sep, value in (tag.partition(":") for tag in tags)}
+    }
+
+
+EMPTY_TAGSET = parseTagSet(())
+
+
+def newTagIndex():
+    """
+    Create empty tag index
+    """
+    return {"crn": {}, "sets": [], "ids": {}}
+
+
+def addTags(tag_index, crn, tags):
+    """
+    Add tags of a resource to tag index, reusing an existing tag set if identical and in the same order
+    :param tag_index: tag index to add to
+    :param crn: CRN of resource
+    :param tags: list of tags attached to resource
+    :return: tag set id
+    """
+    """ Duplicates are dropped keeping the order of the tags, which is the order role and audit values are joined in """
+    key = tuple(dict.fromkeys(sys.intern(tag) for tag in tags))
+    setId = tag_index["ids"].get(key)
+    if setId is None:
+        setId = len(tag_index["sets"])
+        tag_index["ids"][key] = setId
+        tag_index["sets"].append(parseTagSet(key))
+    tag_index["crn"][crn] = setId
+    return setId
+
+
+def removeTags(tag_index, crn):
+    """
+    Remove a resource from tag index, its tag set is kept for other resources sharing it
+    :param tag_index: tag index to remove from
+    :param crn: CRN of resource
+    """
+    tag_index["crn"].pop(crn, None)
+
+
+def buildTagIndex(items):
+    """
+    Build tag index from global search results
+    :param items: list of search items with crn and tags
+    :return: tag index
+    """
+    tag_index = newTagIndex()
+    for resource in items:
+        addTags(tag_index, resource["crn"], resource["tags"])
+    return tag_index
+
+
+def getTagSet(tag_index, crn):
+    """
+    Lookup parsed tag set for CRN
+    :return: parsed tag set, or the empty tag set if CRN has no tags
+    """
+    setId = tag_index["crn"].get(crn)
+    if setId is None:
+        return EMPTY_TAGSET
+    return tag_index["sets"][setId]
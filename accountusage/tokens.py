@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+IAM token manager shared by every client created for an API key.
+
+One IAMAuthenticator is kept per API key for the life of the process, and its access token and the
+account id of the API key are cached on disk between runs until shortly before the token expires.
+Each entry on disk is encrypted with a key derived from its API key and stored under a separate hash
+of the API key, so the cache file holds neither API keys nor tokens readable without them.  Tokens
+are refreshed by a background timer before the SDK would refresh them inline on a request.  Updates of the
+cache file are serialized across processes (ie sharded workers) with a lock file next to it.
+
+The cache file defaults to ~/.accountusage/tokens.json and is set with the TOKEN_CACHE environment
+variable (an empty value keeps tokens in memory only).  Disk caching requires the cryptography package.
+"""
+
+__author__ = 'jonhall'
+import os, json, time, base64, hashlib, logging, threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TOKEN_CACHE = os.path.join(os.path.expanduser("~"), ".accountusage", "tokens.json")
+
+""" Cached tokens expiring within this many seconds are not reused """
+EXPIRY_MARGIN = 300
+
+
+class TokenManager:
+    def __init__(self, filename=TOKEN_CACHE, background=True):
+        """
+        Constructor Method
+        :param filename: encrypted token cache file, None to cache in memory only
+        :param background: refresh tokens with a background timer before they are due
+        """
+        self.filename = filename
+        self.background = background
+        self.lock = threading.RLock()
+        self.authenticators = {}
+        self.entries = {}
+        self.timers = {}
+        self.fernet = None
+        if filename:
+            try:
+                from cryptography import fernet
+                self.fernet = fernet
+            except ImportError:
+                logging.warning("cryptography package not installed, IAM tokens will not be cached on disk.")
+
+    @staticmethod
+    def entryKeys(apikey):
+        """
+        Derive cache entry id and encryption key from API key
+        :return: entry id, Fernet key
+        """
+        entryId = hashlib.sha256(("accountusage-entry:" + apikey).encode()).hexdigest()
+        key = base64.urlsafe_b64encode(hashlib.sha256(("accountusage-key:" + apikey).encode()).digest())
+        return entryId, key
+
+    def readStore(self):
+        """
+        Read encrypted entries from token cache file
+        :return: dict of entry id to encrypted entry
+        """
+        if self.fernet is None or not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, "rt") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("Unable to read token cache {}: {}.".format(self.filename, str(e)))
+            return {}
+
+    def writeStore(self, store):
+        """
+        Atomically replace token cache file, readable only by the current user
+        """
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        tmp = "{}.{}.tmp".format(self.filename, os.getpid())
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wt") as f:
+                json.dump(store, f)
+            os.replace(tmp, self.filename)
+        except OSError as e:
+            logging.warning("Unable to write token cache {}: {}.".format(self.filename, str(e)))
+        return
+
+    @contextmanager
+    def fileLock(self):
+        """
+        Exclusive lock of the token cache file held across processes while it is read and replaced
+        """
+        if fcntl is None:
+            yield
+            return
+        lock = None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), mode=0o700, exist_ok=True)
+            lock = os.open(self.filename + ".lock", os.O_WRONLY | os.O_CREAT, 0o600)
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except OSError as e:
+            logging.warning("Unable to lock token cache {}: {}.".format(self.filename, str(e)))
+        try:
+            yield
+        finally:
+            if lock is not None:
+                os.close(lock)
+
+    def getEntry(self, apikey):
+        """
+        Get cached entry of API key, decrypting it from the token cache file on first use
+        :return: dict with any of account_id, access_token, expire_time and refresh_time
+        """
+        with self.lock:
+            if apikey not in self.entries:
+                entry = {}
+                entryId, key = self.entryKeys(apikey)
+                encrypted = self.readStore().get(entryId)
+                if encrypted is not None:
+                    try:
+                        entry = json.loads(self.fernet.Fernet(key).decrypt(encrypted.encode()))
+                    except (self.fernet.InvalidToken, ValueError):
+                        logging.warning("Ignoring unreadable token cache entry.")
+                self.entries[apikey] = entry
+            return self.entries[apikey]
+
+    def storeEntry(self, apikey, **values):
+        """
+        Update cached entry of API key and write it to the token cache file
+        """
+        with self.lock:
+            entry = self.getEntry(apikey)
+            entry.update(values)
+            if self.fernet is not None:
+                entryId, key = self.entryKeys(apikey)
+                """ Entries written by other processes since the store was read are kept """
+                with self.fileLock():
+                    store = self.readStore()
+                    store[entryId] = self.fernet.Fernet(key).encrypt(json.dumps(entry).encode()).decode()
+                    self.writeStore(store)
+        return
+
+    def getAuthenticator(self, apikey):
+        """
+        Return the shared IAMAuthenticator of API key, seeded with its cached token if still valid
+        """
+        with self.lock:
+            if apikey not in self.authenticators:
+                from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+                authenticator = IAMAuthenticator(apikey)
+                """ Persist every token the SDK obtains, whether requested inline or by the refresh timer """
+                authenticator.token_manager = persistingTokenManager(self, apikey)
+                tokenManager = authenticator.token_manager
+                entry = self.getEntry(apikey)
+                if entry.get("access_token") and entry.get("expire_time", 0) - EXPIRY_MARGIN > time.time():
+                    logging.debug("Using cached IAM token expiring at {}.".format(time.ctime(entry["expire_time"])))
+                    tokenManager.access_token = entry["access_token"]
+                    tokenManager.expire_time = entry["expire_time"]
+                    tokenManager.refresh_time = entry["refresh_time"]
+                    self.scheduleRefresh(apikey, tokenManager, entry["refresh_time"])
+                self.authenticators[apikey] = authenticator
+            return self.authenticators[apikey]
+
+    def saveToken(self, apikey, tokenManager, tokenResponse):
+        """
+        Store a token obtained by the SDK and schedule its background refresh
+        Expiry and refresh times are read from the token as the SDK does, refreshing after 80% of its lifetime.
+        :param tokenResponse: response of the IAM token request
+        """
+        import jwt
+        accessToken = tokenResponse.get("access_token")
+        claims = jwt.decode(accessToken, algorithms=["RS256"], options={"verify_signature": False, "verify_aud": False})
+        expireTime = claims["exp"]
+        refreshTime = expireTime - (expireTime - claims["iat"]) * 0.2
+        self.storeEntry(apikey, access_token=accessToken, expire_time=expireTime, refresh_time=refreshTime)
+        self.scheduleRefresh(apikey, tokenManager, refreshTime)
+        return
+
+    def scheduleRefresh(self, apikey, tokenManager, refreshTime):
+        """
+        Start background timer refreshing token at its refresh time
+        """
+        if not self.background:
+            return
+        with self.lock:
+            if apikey in self.timers:
+                self.timers[apikey].cancel()
+            timer = threading.Timer(max(refreshTime - time.time(), 0), self.refresh, (tokenManager,))
+            timer.daemon = True
+            self.timers[apikey] = timer
+            timer.start()
+        return
+
+    @staticmethod
+    def refresh(tokenManager):
+        """
+        Request new token in the background
+        """
+        try:
+            tokenManager.paced_request_token()
+        except Exception as e:
+            """ The SDK requests the token inline when it is next used, so a failed refresh is not fatal """
+            logging.warning("Background refresh of IAM token failed: {}.".format(str(e)))
+        return
+
+    def getAccountId(self, apikey, lookup):
+        """
+        Get account id of API key from the cache, the account claim of its access token, or lookup
+        :param lookup: function returning account id from the IAM Identity service
+        """
+        entry = self.getEntry(apikey)
+        if not entry.get("account_id"):
+            accountId = self.tokenAccountId(apikey)
+            if accountId is None:
+                accountId = lookup()
+            self.storeEntry(apikey, account_id=accountId)
+        return entry["account_id"]
+
+    def tokenAccountId(self, apikey):
+        """
+        Read account id from the account claim of the access token of API key
+        :return: account id, or None if token has no account claim
+        """
+        import jwt
+        token = self.getAuthenticator(apikey).token_manager.get_token()
+        claims = jwt.decode(token, algorithms=["RS256"], options={"verify_signature": False, "verify_aud": False})
+        return claims.get("account", {}).get("bss")
+
+
+def persistingTokenManager(manager, apikey):
+    """
+    IAM token manager of API key storing each token it requests in a TokenManager
+    Tokens are captured from the public request_token method the SDK calls for every token, inline or in the background.
+    :param manager: TokenManager to store tokens in
+    :return: IAMTokenManager
+    """
+    from ibm_cloud_sdk_core.token_managers.iam_token_manager import IAMTokenManager
+
+    class PersistingIAMTokenManager(IAMTokenManager):
+        def request_token(self):
+            tokenResponse = super().request_token()
+            manager.saveToken(apikey, self, tokenResponse)
+            return tokenResponse
+
+    return PersistingIAMTokenManager(apikey)
+
+
+manager = None
+
+
+def getTokenManager():
+    """
+    Return token manager shared by all clients of the process, using the TOKEN_CACHE file
+    """
+    global manager
+    if manager is None:
+        manager = TokenManager(os.environ.get("TOKEN_CACHE", TOKEN_CACHE) or None)
+    return manager
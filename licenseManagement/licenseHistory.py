@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compact time series store of license counts collected by licenseReport.py.
+
+Each distinct (license, account_name, key, metric) series is stored once and referenced by id.  Every
+collection run appends one sample per series as numpy arrays of timestamp, series id and value, and
+the daily high-water mark of each series is maintained as samples are appended, so daily, monthly and
+rolling high-water marks are answered from the daily table without reading the raw samples.
+"""
+
+__author__ = 'jonhall'
+import os, pickle
+import pandas as pd
+import numpy as np
+
+SERIES_COLUMNS = ["license", "account_name", "key", "metric"]
+
+
+def newLicenseHistory():
+    """
+    Create empty license history
+    """
+    return {
+        "series": [],
+        "ids": {},
+        "samples": {
+            "timestamp": np.array([], dtype="datetime64[s]"),
+            "series": np.array([], dtype=np.int32),
+            "value": np.array([], dtype=np.float64)
+        },
+        "daily": {}
+    }
+
+
+def loadLicenseHistory(filename):
+    """
+    Load license history store
+    :param filename: pickle file of license history
+    :return: license history, or empty license history if file does not exist
+    """
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    return newLicenseHistory()
+
+
+def saveLicenseHistory(filename, history):
+    """
+    Save license history store
+    """
+    with open(filename, "wb") as f:
+        pickle.dump(history, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return
+
+
+def getSeriesId(history, series):
+    """
+    Lookup id of series, adding it to the history if new
+    :param series: tuple of license, account_name, key, metric
+    :return: series id
+    """
+    seriesId = history["ids"].get(series)
+    if seriesId is None:
+        seriesId = len(history["series"])
+        history["ids"][series] = seriesId
+        history["series"].append(series)
+    return seriesId
+
+
+def appendLicenseCounts(history, counts, timestamp):
+    """
+    Append license counts of a collection run and update daily high-water marks
+    :param history: license history to append to
+    :param counts: dataframe of license, account_name, key, metric and value
+    :param timestamp: datetime of collection run
+    :return: number of samples appended
+    """
+    seriesIds = np.array([getSeriesId(history, series) for series in
+                          counts[SERIES_COLUMNS].itertuples(index=False, name=None)], dtype=np.int32)
+    values = counts["value"].to_numpy(dtype=np.float64)
+    samples = history["samples"]
+    samples["timestamp"] = np.concatenate([samples["timestamp"], np.full(len(values), np.datetime64(timestamp, "s"))])
+    samples["series"] = np.concatenate([samples["series"], seriesIds])
+    samples["value"] = np.concatenate([samples["value"], values])
+
+    day = timestamp.strftime("%Y-%m-%d")
+    for seriesId, value in zip(seriesIds.tolist(), values.tolist()):
+        if value > history["daily"].get((day, seriesId), -np.inf):
+            history["daily"][(day, seriesId)] = value
+    return len(values)
+
+
+def getDailyHighWater(history):
+    """
+    Daily high-water mark of each series
+    :return: dataframe with a date index and one column per series
+    """
+    if len(history["daily"]) == 0:
+        return pd.DataFrame(columns=pd.MultiIndex.from_tuples([], names=SERIES_COLUMNS), index=pd.DatetimeIndex([], name="date"))
+    days, seriesIds = zip(*history["daily"].keys())
+    daily = pd.DataFrame({"date": pd.to_datetime(days), "series": seriesIds, "value": list(history["daily"].values())})
+    daily = daily.pivot(index="date", columns="series", values="value").sort_index()
+    daily.columns = pd.MultiIndex.from_tuples([history["series"][seriesId] for seriesId in daily.columns], names=SERIES_COLUMNS)
+    return daily
+
+
+def getMonthlyHighWater(history):
+    """
+    Monthly high-water mark of each series
+    :return: dataframe with a month index and one column per series
+    """
+    daily = getDailyHighWater(history)
+    monthly = daily.groupby(daily.index.to_period("M")).max()
+    monthly.index.name = "month"
+    return monthly
+
+
+def getRollingHighWater(history, days):
+    """
+    Rolling high-water mark of each series over trailing window of days
+    :param days: number of days in window (including the day itself)
+    :return: dataframe with a date index and one column per series
+    """
+    daily = getDailyHighWater(history)
+    return daily.rolling("{}D".format(days)).max()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.schema import ACCOUNT_USAGE_SCHEMA, typedFrame
+from accountusage.aggregates import UsageAggregate
+from accountusage.anomalies import detectAnomalies, loadUsageHistory, saveUsageHistory, historyMonths
+
+
+def monthUsage(month, cost):
+    return typedFrame([{"account_id": "a", "account_name": "account", "month": month, "resource_id": "is.instance", "resource_name": "VPC",
+                        "plan_id": "plan", "plan_name": "plan", "metric": "VCPU_HOURS", "cost": cost, "rated_cost": cost,
+                        "quantity": 1.0, "rateable_quantity": 1.0}], ACCOUNT_USAGE_SCHEMA)
+
+
+def testSingleMonthRunUsesHistoryOfEarlierRuns(tmp_path):
+    filename = str(tmp_path / "usageHistory.pkl")
+    assert loadUsageHistory(filename) is None
+    for month, cost in [("2022-05", 1000.0), ("2022-06", 1010.0), ("2022-07", 990.0)]:
+        usageHistory = UsageAggregate()
+        history = loadUsageHistory(filename)
+        if history is not None:
+            usageHistory.update(history)
+        usageHistory.update(monthUsage(month, cost))
+        saveUsageHistory(filename, usageHistory.frame())
+
+    run = UsageAggregate()
+    run.update(monthUsage("2022-08", 5000.0))
+    assert len(detectAnomalies(run.frame(), ["2022-08"])) == 0
+
+    usageHistory = UsageAggregate()
+    usageHistory.update(loadUsageHistory(filename))
+    usageHistory.update(run.frame())
+    assert historyMonths(usageHistory.frame(), "2022-08") == 3
+    anomalies = detectAnomalies(usageHistory.frame(), ["2022-08"])
+    assert list(anomalies["anomaly"]) == ["spike"]
+    assert anomalies["baseline_cost"][0] == 1000.0
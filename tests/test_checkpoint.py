@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.checkpoint import Checkpoint
+
+RUN = {"start": "2022-06", "end": "2022-08", "accounts": ["account-a"]}
+
+
+def testCheckpointRefusesDirectoryThatIsNotACheckpoint(tmp_path):
+    (tmp_path / "data.txt").write_text("keep")
+    with pytest.raises(SystemExit):
+        Checkpoint(str(tmp_path), RUN)
+    assert (tmp_path / "data.txt").read_text() == "keep"
+
+
+def testCheckpointDiscardsPreviousCheckpoint(tmp_path):
+    directory = str(tmp_path / "checkpoint")
+    checkpoint = Checkpoint(directory, RUN)
+    checkpoint.state["complete"].append(Checkpoint.unitKey(0, "2022-06"))
+    checkpoint.writeState()
+    assert Checkpoint(directory, RUN, resume=True).isComplete(Checkpoint.unitKey(0, "2022-06"))
+    assert not Checkpoint(directory, RUN).isComplete(Checkpoint.unitKey(0, "2022-06"))
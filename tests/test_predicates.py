@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os, sys
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.predicates import column, select
+
+
+def testFiltersMatchQuery():
+    frame = pd.DataFrame({"role": ["symphony-worker", "scale-storage", None, "symphony-worker"], "month": ["2022-06", "2022-06", "2022-07", "2022-07"],
+                          "vcpu": [4, 8, 2, 4]})
+    frame["role"] = frame["role"].astype("category")
+    for predicate, query in [(column("role").contains("symphony") & (column("month") == "2022-07"), "role.str.contains('symphony', na=False) and month == '2022-07'"),
+                             (column("month").isin(["2022-06"]) | (column("vcpu") == 2), "month in ['2022-06'] or vcpu == 2"),
+                             (column("role") != "scale-storage", "role != 'scale-storage'")]:
+        assert list(select(frame, predicate).index) == list(frame.query(query).index)
+
+
+def testChangedColumnIsIndexedAgain():
+    frame = pd.DataFrame({"a": ["y", "z", "y", "z", "x"], "b": [1, 2, 3, 4, 5]})
+    assert list(select(frame, column("a") == "x").index) == [4]
+    frame.loc[1, "a"] = "x"
+    assert list(select(frame, column("a") == "x").index) == [1, 4]
+    assert list(select(frame, (column("a") == "x") & (column("b") == 2)).index) == [1]
+    frame.loc[0, "b"] = 2
+    assert list(select(frame, (column("a") == "x") | (column("b") == 2)).index) == [0, 1, 4]
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Sharded runs: local worker processes stand in for workers on other hosts sharing the queue directory.
+"""
+
+import os, sys, time, importlib.util, multiprocessing
+from datetime import datetime
+import pandas as pd
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from accountusage.schema import ACCOUNT_USAGE_SCHEMA, INSTANCE_USAGE_SCHEMA, typedFrame, concatFrames
+from accountusage.aggregates import UsageAggregate
+from accountusage.shards import WorkQueue, QUEUE_MARKER
+
+APIKEYS = [{"apikey": "key-a", "name": "account-a"}, {"apikey": "key-b", "name": "account-b"}, {"apikey": "key-c", "name": "account-c"}]
+
+
+def loadCitiUsage():
+    """
+    Load the billing script as a module with the names its main block defines
+    """
+    spec = importlib.util.spec_from_file_location("citiUsage", os.path.join(ROOT, "Billing", "citiUsage.py"))
+    citiUsage = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(citiUsage)
+    citiUsage.pd = pd
+    citiUsage.concatFrames = concatFrames
+    citiUsage.ACCOUNT_USAGE_SCHEMA = ACCOUNT_USAGE_SCHEMA
+    citiUsage.INSTANCE_USAGE_SCHEMA = INSTANCE_USAGE_SCHEMA
+    citiUsage.usageAggregate = UsageAggregate()
+    citiUsage.unitAccount = None
+    citiUsage.collectUnit = lambda apikeys, unit: collectUnit(citiUsage, apikeys, unit)
+    return citiUsage
+
+
+def collectUnit(citiUsage, apikeys, unit):
+    """
+    Usage of a unit without the API, distinct for every account and month
+    """
+    account = apikeys[unit["account"]]
+    citiUsage.accountId = "id-" + account["name"]
+    services = ["is.instance", "cloud-object-storage", "containers-kubernetes"][:unit["account"] + 1]
+    accountUsage = typedFrame([{"account_id": citiUsage.accountId, "account_name": account["name"], "month": unit["month"],
+                                "resource_id": service, "resource_name": service, "plan_id": "plan", "plan_name": "plan",
+                                "metric": "HOURS", "quantity": 10.0 * number, "rateable_quantity": 10.0 * number,
+                                "cost": number + int(unit["month"][-2:]), "rated_cost": float(number), "price": "[]"}
+                               for number, service in enumerate(services, 1)], ACCOUNT_USAGE_SCHEMA)
+    instancesUsage = typedFrame([{"account_id": citiUsage.accountId, "account_name": account["name"], "month": unit["month"],
+                                  "service_id": "is.instance", "instance_id": "crn-{}-{}-{}".format(unit["account"], unit["month"], number),
+                                  "metric": "VCPU_HOURS", "quantity": float(number), "cost": float(number), "numberOfVirtualCPUs": number}
+                                 for number in range(unit["account"] + 2)], INSTANCE_USAGE_SCHEMA)
+    """ Give the other worker time to claim units, so units are split between them """
+    time.sleep(0.05)
+    return accountUsage, instancesUsage
+
+
+def runWorker(directory):
+    citiUsage = loadCitiUsage()
+    citiUsage.runWorker(WorkQueue(directory), APIKEYS)
+
+
+def sequentialUsage(units):
+    citiUsage = loadCitiUsage()
+    usage = citiUsage.mergeUnits(units, lambda unit: citiUsage.collectUnit(APIKEYS, unit))
+    return usage, citiUsage.usageAggregate.frame()
+
+
+def testWorkerProcessesMatchSequentialRun(tmp_path):
+    citiUsage = loadCitiUsage()
+    units = citiUsage.workUnits(APIKEYS, datetime(2022, 6, 1), datetime(2022, 8, 1))
+    queue = WorkQueue(str(tmp_path / "shards"))
+    names = queue.create(units)
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=runWorker, args=(queue.directory,)) for worker in range(2)]
+    for process in processes:
+        process.start()
+    assert queue.wait(len(units), interval=0.1, timeout=60)
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+
+    for name, unit in zip(names, units):
+        unit["name"] = name
+    sharded = citiUsage.mergeUnits(units, lambda unit: (queue.readPartitions("accountUsage", [unit["name"]]),
+                                                       queue.readPartitions("instancesUsage", [unit["name"]])))
+    (accountUsage, instancesUsage), aggregate = sequentialUsage([dict(unit) for unit in units])
+    pd.testing.assert_frame_equal(sharded[0], accountUsage)
+    pd.testing.assert_frame_equal(sharded[1], instancesUsage)
+    pd.testing.assert_frame_equal(citiUsage.usageAggregate.frame(), aggregate)
+
+
+def testStaleClaimIsRequeued(tmp_path):
+    queue = WorkQueue(str(tmp_path / "shards"))
+    queue.create([{"account": 0, "month": "2022-06"}])
+    unit = queue.claim()
+    """ The worker holding the claim died an hour ago """
+    os.utime(unit["claimed"], (time.time() - 3600, time.time() - 3600))
+    assert queue.requeueStale() == 1
+    assert queue.counts() == {"queue": 1, "claimed": 0, "done": 0}
+    assert queue.claim()["name"] == unit["name"]
+
+
+def testWaitTimesOutWithoutWorkers(tmp_path):
+    queue = WorkQueue(str(tmp_path / "shards"))
+    queue.create([{"account": 0, "month": "2022-06"}])
+    assert not queue.wait(1, interval=0.1, timeout=0.3)
+
+
+def testCreateRefusesDirectoryThatIsNotAQueue(tmp_path):
+    (tmp_path / "data.txt").write_text("keep")
+    with pytest.raises(SystemExit):
+        WorkQueue(str(tmp_path)).create([{"account": 0, "month": "2022-06"}])
+    assert (tmp_path / "data.txt").read_text() == "keep"
+
+    queue = WorkQueue(str(tmp_path / "shards"))
+    queue.create([{"account": 0, "month": "2022-06"}])
+    assert os.path.exists(queue.path(QUEUE_MARKER))
+    assert queue.create([{"account": 0, "month": "2022-07"}]) == ["unit-00000"]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os, re, sys, types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from accountusage.tags import buildTagIndex, getTagSet, EMPTY_TAGSET
+from accountusage.cache import updateTagCache
+
+
+class GlobalSearch:
+    """
+    Global search of tagged resources answering queries of tags:* or of OR joined CRNs
+    """
+    def __init__(self, tags):
+        self.tags = tags
+        self.queries = []
+
+    def search(self, query, search_cursor=None, fields=None, limit=None):
+        self.queries.append(query)
+        crns = self.tags if query == "tags:*" else re.findall(r'crn:"([^"]*)"', query)
+        items = [{"crn": crn, "tags": self.tags[crn]} for crn in crns if self.tags.get(crn)]
+        return types.SimpleNamespace(get_result=lambda: {"items": items})
+
+
+def testUpdateSearchesOnlyChangedResources():
+    search = GlobalSearch({"crn-1": ["role:symphony-worker"], "crn-2": ["role:scale-storage"], "crn-3": ["audit:on"]})
+    clients = types.SimpleNamespace(global_search=search)
+    tag_index = buildTagIndex(search.search("tags:*").get_result()["items"])
+
+    search.tags["crn-1"] = ["role:symphony-master", "audit:on"]
+    search.tags["crn-4"] = ["role:symphony-worker"]
+    del search.tags["crn-2"]
+    assert updateTagCache(clients, tag_index, ["crn-1", "crn-2", "crn-4"]) == 2
+
+    assert search.queries[-1] == 'crn:"crn-1" OR crn:"crn-2" OR crn:"crn-4"'
+    assert getTagSet(tag_index, "crn-1")["role"] == "symphony-master"
+    assert getTagSet(tag_index, "crn-2") is EMPTY_TAGSET
+    assert getTagSet(tag_index, "crn-3")["audit"] == "on"
+    assert getTagSet(tag_index, "crn-4")["role"] == "symphony-worker"